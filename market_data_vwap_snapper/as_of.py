@@ -0,0 +1,182 @@
+"""Historical book of an instrument at a point in time.
+
+`book_as_of(provider, internal_pair, timestamp, depth)` starts from the last snapshot of the
+instrument at or before `timestamp` (the (provider, base, counter, external_time) index) and applies
+only the overrides of that snapshot up to `timestamp` (the (orderbook_snapshot_id, external_time)
+index), streamed like replay.py does.
+
+the books materialised this way are kept in a `cachetools.LRUCache`, one per snapshot with the
+position of the last override applied. a later query on the same snapshot advances the cached book
+from there instead of starting over, so walking forward in time costs only the overrides in between.
+a query before the cached position rebuilds the book from its snapshot.
+
+not thread safe: use one AsOfBooks per thread.
+"""
+import heapq
+
+import numpy as np
+from cachetools import LRUCache
+from config import AS_OF_CACHE_BOOKS, REPLAY_CHUNK_ROWS
+from database import get_engine
+from level_codec import row_levels
+from live_books import LiveBook
+from models import OrderbookLevelOverride, OrderbookSnapshot
+from sqlalchemy import and_, bindparam, or_, select
+from timestamps import ns_to_datetime
+
+
+class _MaterialisedBook:
+    __slots__ = ("book", "external_time", "override_id")
+
+    def __init__(self, book):
+        self.book = book
+        self.external_time = None  # external_time and id of the last override applied. None if none
+        self.override_id = None
+
+
+def top_levels(levels, depth, is_bid):
+    """(depth, 2) float [price, size] array of the best `depth` levels of a LiveBook side (all if
+    `depth` is None), best first"""
+
+    if depth is None:
+        ticks = sorted(levels, reverse=is_bid)
+    elif is_bid:
+        ticks = heapq.nlargest(depth, levels)
+    else:
+        ticks = heapq.nsmallest(depth, levels)
+    return np.array([levels[tick] for tick in ticks], dtype=np.float64).reshape(-1, 2)
+
+
+class AsOfBooks:
+    """book_as_of queries on one engine, with the last `max_books` books materialised kept in an LRU.
+    `hits` counts queries answered from a cached book (advanced if needed), `misses` the ones that
+    started from a snapshot row"""
+
+    def __init__(self, engine, max_books=AS_OF_CACHE_BOOKS, chunk_rows=REPLAY_CHUNK_ROWS):
+        self._engine = engine
+        # (provider, internal pair, snapshot id) -> _MaterialisedBook
+        self._books = LRUCache(maxsize=max_books)
+        self.hits = 0
+        self.misses = 0
+
+        # statements are built once, queries only bind their parameters
+        snapshots_table = OrderbookSnapshot.__table__
+        self._snapshot_before = (
+            select(snapshots_table.c.id)
+            .where(
+                (snapshots_table.c.provider == bindparam("provider"))
+                & (snapshots_table.c.base == bindparam("base"))
+                & (snapshots_table.c.counter == bindparam("counter"))
+                & (snapshots_table.c.external_time <= bindparam("timestamp"))
+            )
+            .order_by(snapshots_table.c.external_time.desc(), snapshots_table.c.id.desc())
+            .limit(1)
+        )
+        self._snapshot_levels = select(
+            snapshots_table.c.bids,
+            snapshots_table.c.asks,
+            snapshots_table.c.levels_packed,
+            snapshots_table.c.external_time_ns,
+        ).where(snapshots_table.c.id == bindparam("orderbook_snapshot_id"))
+        overrides_table = OrderbookLevelOverride.__table__
+        overrides = (
+            select(
+                overrides_table.c.id,
+                overrides_table.c.bids_overrides,
+                overrides_table.c.asks_overrides,
+                overrides_table.c.overrides_packed,
+                overrides_table.c.external_time,
+                overrides_table.c.external_time_ns,
+            )
+            .where(
+                (overrides_table.c.orderbook_snapshot_id == bindparam("orderbook_snapshot_id"))
+                & (overrides_table.c.external_time <= bindparam("timestamp"))
+            )
+            .order_by(overrides_table.c.external_time, overrides_table.c.id)
+            .execution_options(yield_per=chunk_rows)
+        )
+        self._overrides = overrides
+        # overrides after the last one applied, by (external_time, id)
+        self._overrides_after = overrides.where(
+            or_(
+                overrides_table.c.external_time > bindparam("last_external_time"),
+                and_(
+                    overrides_table.c.external_time == bindparam("last_external_time"),
+                    overrides_table.c.id > bindparam("last_override_id"),
+                ),
+            )
+        )
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "books": len(self._books)}
+
+    def _advance(self, conn, materialised, orderbook_snapshot_id, timestamp):
+        """Applies the overrides of the snapshot after the last one applied, up to `timestamp`"""
+
+        params = {"orderbook_snapshot_id": orderbook_snapshot_id, "timestamp": timestamp}
+        if materialised.external_time is None:
+            rows = conn.execute(self._overrides, params)
+        else:
+            params["last_external_time"] = materialised.external_time
+            params["last_override_id"] = materialised.override_id
+            rows = conn.execute(self._overrides_after, params)
+        for row in rows:
+            bids_overrides, asks_overrides = row_levels(row, OrderbookLevelOverride)
+            materialised.book.apply_overrides(bids_overrides, asks_overrides, row.external_time_ns)
+            materialised.external_time, materialised.override_id = row.external_time, row.id
+
+    def materialise(self, provider, internal_pair, timestamp):
+        """LiveBook of the instrument after every update with an external_time at or before
+        `timestamp` (naive UTC datetime or epoch ns). None if there is no snapshot by then.
+        the book stays cached: read it, do not modify it"""
+
+        if isinstance(timestamp, int):
+            timestamp = ns_to_datetime(timestamp)
+        base, counter = internal_pair.split("-")
+        with self._engine.connect() as conn:
+            orderbook_snapshot_id = conn.execute(
+                self._snapshot_before,
+                {"provider": provider, "base": base, "counter": counter, "timestamp": timestamp},
+            ).scalar()
+            if orderbook_snapshot_id is None:
+                return None
+            key = (provider, internal_pair, orderbook_snapshot_id)
+            materialised = self._books.get(key)
+            if materialised is not None and (
+                materialised.external_time is None or materialised.external_time <= timestamp
+            ):
+                self.hits += 1
+            else:  # not cached, or cached past `timestamp`: the book can not go back
+                self.misses += 1
+                snapshot = conn.execute(
+                    self._snapshot_levels, {"orderbook_snapshot_id": orderbook_snapshot_id}
+                ).one()
+                bids, asks = row_levels(snapshot, OrderbookSnapshot)
+                book = LiveBook(provider, internal_pair)
+                book.apply_snapshot(bids, asks, orderbook_snapshot_id, snapshot.external_time_ns)
+                materialised = self._books[key] = _MaterialisedBook(book)
+            self._advance(conn, materialised, orderbook_snapshot_id, timestamp)
+        return materialised.book
+
+    def book_as_of(self, provider, internal_pair, timestamp, depth=None):
+        """(bids, asks) of the instrument at `timestamp`, as (n, 2) float [price, size] arrays of the
+        best `depth` levels (all if None), best first. None if there is no snapshot by then"""
+
+        book = self.materialise(provider, internal_pair, timestamp)
+        if book is None:
+            return None
+        return top_levels(book.bids, depth, True), top_levels(book.asks, depth, False)
+
+
+_AS_OF_BOOKS = {}  # database url -> AsOfBooks of book_as_of
+
+
+def book_as_of(provider, internal_pair, timestamp, depth=None, database_url=None):
+    """AsOfBooks.book_as_of on the `get_engine(database_url)` database, with a cache shared by the
+    calls on the same database"""
+
+    as_of_books = _AS_OF_BOOKS.get(database_url)
+    if as_of_books is None:
+        engine = get_engine() if database_url is None else get_engine(database_url)
+        as_of_books = _AS_OF_BOOKS[database_url] = AsOfBooks(engine)
+    return as_of_books.book_as_of(provider, internal_pair, timestamp, depth)
@@ -0,0 +1,31 @@
+import random
+
+from config import BACKOFF_INITIAL_SECONDS, BACKOFF_MAX_SECONDS, BACKOFF_MULTIPLIER
+
+
+class ExponentialBackoff:
+    """Delay generator for reconnections/restarts: initial, initial*multiplier, ... capped at max.
+    a +-10% jitter avoids venues hammering in lockstep after a shared network blip"""
+
+    def __init__(
+        self,
+        initial_seconds=BACKOFF_INITIAL_SECONDS,
+        max_seconds=BACKOFF_MAX_SECONDS,
+        multiplier=BACKOFF_MULTIPLIER,
+    ):
+        self._initial_seconds = initial_seconds
+        self._max_seconds = max_seconds
+        self._multiplier = multiplier
+        self._attempts = 0
+
+    def next_delay(self):
+        delay = min(self._initial_seconds * self._multiplier**self._attempts, self._max_seconds)
+        self._attempts += 1
+        return delay * random.uniform(0.9, 1.1)
+
+    def reset(self):
+        self._attempts = 0
+
+    @property
+    def attempts(self):
+        return self._attempts
@@ -0,0 +1,109 @@
+"""Latency of as-of book queries (as_of.py) on a synthetic sqlite database (or --database-url).
+
+    replay from start: the notebook way, every update of the instrument up to the timestamp
+    as-of, cold: nearest snapshot + overrides in between, new cache for every query
+    as-of, LRU random: random timestamps, one AsOfBooks (cached books advanced when possible)
+    as-of, LRU forward: increasing timestamps a few seconds apart, like stepping through a chart
+
+run from this directory: python benchmark_as_of.py [--instruments 2] [--snapshots 4]
+    [--overrides 20000] [--queries 500] [--depth 10] [--database-url URL]
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+from as_of import AsOfBooks
+from benchmark_replay import synthetic_instruments, write_synthetic_book
+from database import get_engine
+from models import OrderbookLevelOverride
+from replay import recorded_instruments, replay_events
+from sqlalchemy import func, select
+from timestamps import datetime_to_ns, ns_to_datetime
+
+
+def time_range_ns(engine):
+    table = OrderbookLevelOverride.__table__
+    with engine.connect() as conn:
+        first, last = conn.execute(
+            select(func.min(table.c.external_time), func.max(table.c.external_time))
+        ).one()
+    return datetime_to_ns(first), datetime_to_ns(last)
+
+
+def latencies_ms(queries, query):
+    latencies = []
+    for provider, internal_pair, timestamp in queries:
+        tick = time.perf_counter()
+        query(provider, internal_pair, timestamp)
+        latencies.append((time.perf_counter() - tick) * 1e3)
+    return np.array(latencies)
+
+
+def replay_from_start(engine, provider, internal_pair, timestamp):
+    for _ in replay_events(engine, [(provider, internal_pair)], end=ns_to_datetime(timestamp)):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instruments", type=int, default=2)
+    parser.add_argument("--snapshots", type=int, default=4, help="snapshots per instrument")
+    parser.add_argument("--overrides", type=int, default=20_000, help="override rows per snapshot")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--depth", type=int, default=10)
+    parser.add_argument("--database-url", default=None, help="query this database, not a synthetic one")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_url = args.database_url
+        if database_url is None:
+            database_url = f"sqlite:///{os.path.join(tmp_dir, 'as_of.sqlite')}"
+            instruments = synthetic_instruments(args.instruments)
+            with get_engine(database_url).begin() as conn:
+                for seed, (provider, internal_pair) in enumerate(instruments):
+                    write_synthetic_book(conn, provider, internal_pair, args.snapshots, args.overrides, seed)
+        else:
+            instruments = recorded_instruments(get_engine(database_url))
+        engine = get_engine(database_url)
+        first_ns, last_ns = time_range_ns(engine)
+
+        rng = random.Random(0)
+        random_queries = [
+            (*rng.choice(instruments), rng.randint(first_ns, last_ns)) for _ in range(args.queries)
+        ]
+        forward_queries = []
+        timestamp = first_ns
+        for _ in range(args.queries):
+            timestamp = min(timestamp + rng.randint(1, 5) * 1_000_000_000, last_ns)
+            forward_queries.append((*instruments[0], timestamp))
+
+        as_of_books = AsOfBooks(engine)
+        forward_books = AsOfBooks(engine)
+
+        def cold(*query):
+            return AsOfBooks(engine).book_as_of(*query, args.depth)
+
+        cases = [
+            ("replay from start", random_queries[:20], lambda *query: replay_from_start(engine, *query)),
+            ("as-of, cold", random_queries, cold),
+            ("as-of, LRU random", random_queries, lambda *query: as_of_books.book_as_of(*query, args.depth)),
+            ("as-of, LRU forward", forward_queries, lambda *q: forward_books.book_as_of(*q, args.depth)),
+        ]
+        print(f"{len(instruments)} instruments, {args.snapshots} snapshots x {args.overrides:,} overrides")
+        print(f"{'case':<20} {'queries':>8} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for name, queries, query in cases:
+            latencies = latencies_ms(queries, query)
+            print(
+                f"{name:<20} {len(queries):>8} {latencies.mean():>9.2f} {np.percentile(latencies, 50):>9.2f}"
+                f" {np.percentile(latencies, 99):>9.2f}"
+            )
+        print(f"LRU random {as_of_books.stats()}, LRU forward {forward_books.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Per-venue decode throughput: classic path vs fast decode path.
+
+classic: json.loads + classify_*_ws_message + json.dumps of the level lists (what persist used to do)
+fast: fast_classify_*_frame, level arrays kept as raw text
+
+run from this directory: python benchmark_decode.py [--messages 50000] [--levels 10]
+"""
+import argparse
+import json
+import logging
+import random
+import time
+
+from coinbase import classify_coinbase_ws_message, fast_classify_coinbase_frame
+from kraken import classify_kraken_ws_message, fast_classify_kraken_frame
+from bitstamp import classify_bitstamp_ws_message, fast_classify_bitstamp_frame
+from fast_decode import JSON_BACKEND, json_loads
+
+
+def _price(rng):
+    return f"{rng.uniform(41_000, 43_000):.2f}"
+
+
+def _size(rng):
+    return f"{rng.uniform(0, 2):.8f}"
+
+
+def coinbase_frames(rng, messages, levels):
+    return [
+        json.dumps(
+            {
+                "type": "l2update",
+                "product_id": "BTC-USD",
+                "changes": [
+                    [rng.choice(["buy", "sell"]), _price(rng), _size(rng)] for _ in range(levels)
+                ],
+                "time": "2023-12-14T13:39:01.337123Z",
+            }
+        )
+        for _ in range(messages)
+    ]
+
+
+def kraken_frames(rng, messages, levels):
+    return [
+        json.dumps(
+            [
+                336,
+                {
+                    "a": [[_price(rng), _size(rng), f"{1702561141 + i:.6f}"] for i in range(levels // 2)],
+                    "b": [[_price(rng), _size(rng), f"{1702561141 + i:.6f}"] for i in range(levels // 2)],
+                    "c": "974942666",
+                },
+                "book-100",
+                "XBT/USD",
+            ],
+            separators=(",", ":"),
+        )
+        for _ in range(messages)
+    ]
+
+
+def bitstamp_frames(rng, messages, levels):
+    return [
+        json.dumps(
+            {
+                "data": {
+                    "timestamp": "1702561141",
+                    "microtimestamp": "1702561141337123",
+                    "bids": [[_price(rng), _size(rng)] for _ in range(levels // 2)],
+                    "asks": [[_price(rng), _size(rng)] for _ in range(levels // 2)],
+                },
+                "channel": "diff_order_book_btcusd",
+                "event": "data",
+            }
+        )
+        for _ in range(messages)
+    ]
+
+
+def classic_coinbase(frame):
+    msg = classify_coinbase_ws_message(json.loads(frame))
+    json.dumps([i[1:] for i in msg["changes"] if i[0] == "buy"])
+    json.dumps([i[1:] for i in msg["changes"] if i[0] == "sell"])
+
+
+def classic_kraken(frame):
+    msg = classify_kraken_ws_message(json.loads(frame))
+    json.dumps(msg["changes"]["bids_overrides"])
+    json.dumps(msg["changes"]["asks_overrides"])
+
+
+def classic_bitstamp(frame):
+    msg = classify_bitstamp_ws_message(json.loads(frame))
+    json.dumps(msg["changes"]["bids_overrides"])
+    json.dumps(msg["changes"]["asks_overrides"])
+
+
+# venue -> (frames generator, classifier, classic path, fast path)
+VENUES = {
+    "coinbase": (coinbase_frames, classify_coinbase_ws_message, classic_coinbase, fast_classify_coinbase_frame),
+    "kraken": (kraken_frames, classify_kraken_ws_message, classic_kraken, fast_classify_kraken_frame),
+    "bitstamp": (bitstamp_frames, classify_bitstamp_ws_message, classic_bitstamp, fast_classify_bitstamp_frame),
+}
+
+
+def msgs_per_second(decode, frames):
+    tick = time.perf_counter()
+    for frame in frames:
+        decode(frame)
+    return len(frames) / (time.perf_counter() - tick)
+
+
+def check_same_levels(venue, classic_msg, fast_msg):
+    """The fast path must store the same levels as the classic one"""
+
+    if venue == "coinbase":
+        classic_bids = [i[1:] for i in classic_msg["changes"] if i[0] == "buy"]
+        classic_asks = [i[1:] for i in classic_msg["changes"] if i[0] == "sell"]
+    else:
+        classic_bids = classic_msg["changes"]["bids_overrides"]
+        classic_asks = classic_msg["changes"]["asks_overrides"]
+    assert json_loads(fast_msg["bids_overrides_raw"]) == classic_bids, venue
+    assert json_loads(fast_msg["asks_overrides_raw"]) == classic_asks, venue
+    assert (fast_msg["bids_overrides"], fast_msg["asks_overrides"]) == (classic_bids, classic_asks), venue
+    assert fast_msg["external_time"] == classic_msg["external_time"], venue
+    assert fast_msg["internal_pair"] == classic_msg["internal_pair"], venue
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--levels", type=int, default=10, help="levels changed per message")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    rng = random.Random(0)
+    print(f"json backend for the fast path: {JSON_BACKEND}")
+    print(f"{'venue':<10} {'classic msg/s':>15} {'fast msg/s':>15} {'speedup':>8}")
+    for venue, (make_frames, classify, classic, fast) in VENUES.items():
+        frames = make_frames(rng, args.messages, args.levels)
+        check_same_levels(venue, classify(json.loads(frames[0])), fast(frames[0]))
+
+        classic_rate = msgs_per_second(classic, frames)
+        fast_rate = msgs_per_second(fast, frames)
+        print(f"{venue:<10} {classic_rate:>15,.0f} {fast_rate:>15,.0f} {fast_rate / classic_rate:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""SimpleOrderBook (bintrees FastAVLTree) vs market_data_vwap_snapper.l2_book.L2Book.
+
+replays the same synthetic override stream (a random walk mid, most updates near the touch, some
+level removals) on both books and times:
+- updates/s, reading the best bid and ask after every update
+- building the (price, size) array of the best `--depth` bid levels that the VWAP code consumes
+
+simple_order_book.py lives at the repository root (the notebooks import it from there), so it is
+imported from the parent directory.
+
+run from this directory: python benchmark_l2_book.py [--updates 200000] [--depth 500]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from itertools import islice
+
+import numpy as np
+
+from l2_book import L2Book
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from simple_order_book import SimpleOrderBook  # noqa: E402
+
+TICK_SIZE = 0.01
+
+
+def override_stream(updates, seed=0):
+    """[(side, size, price)] where size 0 only ever removes an existing level"""
+
+    rng = random.Random(seed)
+    mid_tick = 4_200_000
+    levels = {"bid": set(), "ask": set()}
+    stream = []
+    for _ in range(updates):
+        if rng.random() < 0.01:
+            mid_tick += rng.randint(-20, 20)
+        side = "bid" if rng.random() < 0.5 else "ask"
+        if levels[side] and rng.random() < 0.3:
+            tick = rng.choice(tuple(levels[side]))
+            levels[side].discard(tick)
+            stream.append((side, 0, tick * TICK_SIZE))
+            continue
+        distance = int(rng.expovariate(1 / 50)) + 1
+        tick = mid_tick - distance if side == "bid" else mid_tick + distance
+        other_side = "ask" if side == "bid" else "bid"
+        if tick in levels[other_side]:  # keep the book uncrossed
+            continue
+        levels[side].add(tick)
+        stream.append((side, round(rng.uniform(0.001, 2), 8), tick * TICK_SIZE))
+    return stream
+
+
+def simple_order_book_best(book):
+    best_bid = book._bids.max_key() if book._bids else None
+    best_ask = book._asks.min_key() if book._asks else None
+    return best_bid, best_ask
+
+
+def l2_book_best(book):
+    return book.bid, book.ask
+
+
+def run(book, stream, best):
+    """Seconds to apply the stream reading the best prices after each update"""
+
+    tick = time.perf_counter()
+    for side, size, price in stream:
+        book.apply_update(side, size, price)
+        best(book)
+    return time.perf_counter() - tick
+
+
+def simple_order_book_depth(book, depth):
+    return np.array(list(islice(book._bids.items(reverse=True), depth)))
+
+
+def l2_book_depth(book, depth):
+    # the whole window below the best bid, a view. rows of empty levels have size 0 and do not move
+    # the VWAP cumsum, so there is no need to cut it at `depth` levels
+    return book.bids_view()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=200_000)
+    parser.add_argument("--depth", type=int, default=500, help="bid levels handed to the VWAP code")
+    parser.add_argument("--repeat", type=int, default=1_000, help="depth arrays built")
+    args = parser.parse_args()
+
+    stream = override_stream(args.updates)
+    simple_book, l2_book = SimpleOrderBook(), L2Book(TICK_SIZE)
+    cases = [
+        ("SimpleOrderBook", simple_book, simple_order_book_best, simple_order_book_depth),
+        ("L2Book", l2_book, l2_book_best, l2_book_depth),
+    ]
+    print(f"{len(stream):,} updates, depth arrays of {args.depth} levels")
+    print(f"{'book':<16} {'updates/s':>12} {'depth array us':>15}")
+    results = {}
+    for name, book, best, depth in cases:
+        elapsed = run(book, stream, best)
+        tick = time.perf_counter()
+        for _ in range(args.repeat):
+            depth_array = depth(book, args.depth)
+        depth_us = (time.perf_counter() - tick) / args.repeat * 1e6
+        results[name] = (best(book), depth_array)
+        print(f"{name:<16} {len(stream) / elapsed:>12,.0f} {depth_us:>15.1f}")
+
+    # both books must end in the same state
+    (simple_best, simple_depth), (l2_best, _) = results["SimpleOrderBook"], results["L2Book"]
+    assert np.allclose(simple_best, l2_best), (simple_best, l2_best)
+    l2_levels = l2_book.levels("bid")[: args.depth]
+    assert np.allclose(simple_depth[: len(l2_levels)], l2_levels)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""order_book.OrderBook matching engine vs the recursive one it replaced.
+
+replays the same synthetic order flow (limit orders around a random walk mid, a share of them
+crossing the spread, market orders and cancels of resting orders) on both books and prints orders/s
+and fills/s. the reference engine is reference_order_book.py, the recursive one kept as it was.
+
+with `--cancel-share 0` both engines must end with the same resting orders, which is checked. with
+cancels the books drift apart a little: the reference engine deletes filled orders from a level
+tree while iterating it, so it does not always fill a level in time priority and different orders
+are left to cancel.
+
+order_book.py lives at the repository root (the notebooks import it from there), so it is imported
+from the parent directory.
+
+run from this directory: python benchmark_order_book.py [--orders 200000] [--cancel-share 0.2]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from reference_order_book import OrderBook as ReferenceOrderBook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from order_book import OrderBook  # noqa: E402
+
+
+def order_flow(orders, cancel_share, seed=0):
+    """[(order_type, side, size, price, participant_id, lmt order to cancel)]. order_type "cancel"
+    refers to the n-th limit order of the flow"""
+
+    rng = random.Random(seed)
+    mid = 42_000
+    flow = []
+    lmt_orders = 0
+    for _ in range(orders):
+        if rng.random() < 0.01:
+            mid += rng.randint(-5, 5)
+        participant_id = rng.randint(0, 99)
+        side = "bid" if rng.random() < 0.5 else "ask"
+        kind = rng.random()
+        if kind < cancel_share and lmt_orders:
+            flow.append(("cancel", None, None, None, None, rng.randrange(lmt_orders)))
+        elif kind < cancel_share + 0.03:
+            flow.append(("mkt", side, rng.randint(1, 50), None, participant_id, None))
+        else:
+            # mostly passive, a few ticks through the touch for the aggressive ones
+            distance = int(rng.expovariate(1 / 10)) - 2
+            price = mid - distance if side == "bid" else mid + distance
+            flow.append(("lmt", side, rng.randint(1, 20), price, participant_id, None))
+            lmt_orders += 1
+    return flow
+
+
+def is_resting(book, order_id):
+    if hasattr(book, "has_order"):
+        return book.has_order(order_id)
+    return order_id in book._price_ids  # reference engine: cancel leaves the id behind, see run()
+
+
+def run(book, flow, count_fills):
+    """(seconds, fills) of replaying the flow"""
+
+    lmt_order_ids = []
+    fills = 0
+    tick = time.perf_counter()
+    for order_type, side, size, price, participant_id, cancel_idx in flow:
+        if order_type == "cancel":
+            order_id = lmt_order_ids[cancel_idx]
+            if order_id is not None and is_resting(book, order_id):
+                book.cancel(order_id)
+                lmt_order_ids[cancel_idx] = None
+            continue
+        order_id, trades = book.submit_order(order_type, side, size, price, participant_id)
+        if order_type == "lmt":
+            lmt_order_ids.append(order_id)
+        fills += count_fills(trades)
+    return time.perf_counter() - tick, fills
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=200_000)
+    parser.add_argument("--cancel-share", type=float, default=0.2, help="share of cancels in the flow")
+    args = parser.parse_args()
+
+    flow = order_flow(args.orders, args.cancel_share)
+    reference_book, book = ReferenceOrderBook(), OrderBook()
+    cases = [
+        # the reference engine reports a fill as one (0, size, price) entry plus one entry per side
+        ("recursive", reference_book, lambda trades: sum(1 for trade in trades if trade[0] == 0)),
+        ("iterative", book, len),
+    ]
+    print(f"{len(flow):,} orders")
+    print(f"{'engine':<10} {'orders/s':>12} {'fills/s':>12} {'fills':>10}")
+    for name, engine_book, count_fills in cases:
+        elapsed, fills = run(engine_book, flow, count_fills)
+        print(f"{name:<10} {len(flow) / elapsed:>12,.0f} {fills / elapsed:>12,.0f} {fills:>10,}")
+
+    if args.cancel_share == 0:  # both engines must leave the same resting orders behind
+        assert reference_book.get_mkt_depth(100) == book.get_mkt_depth(100)
+        assert reference_book.total_volume_traded == book.total_volume_traded
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""VWAP replay throughput, serial (replay.py) vs a process pool (parallel_replay.py).
+
+replays the instruments of a synthetic sqlite database (or of --database-url) once in this process
+and once per worker count, each run writing its VWAP rows to its own sqlite database, and prints
+updates/s and the speedup over one worker. the VWAP rows must be written in time order, and those of
+the instrument partitions must match the serial ones, which is checked.
+
+run from this directory: python benchmark_replay.py [--instruments 8] [--snapshots 2]
+    [--overrides 20000] [--workers 1,2,4,8] [--partition instrument] [--database-url URL]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from database import get_engine
+from instruments import REGISTRY, instrument_specs
+from models import LatestOrderbookSnapshot, OrderbookLevelOverride, OrderbookSnapshot, VwapSnapshot
+from parallel_replay import parallel_vwap_replay
+from replay import VwapReplayConsumer, recorded_instruments, replay
+from sinks import make_sink
+from sqlalchemy import select
+from ticks import ticks_to_str
+from timestamps import ns_to_datetime
+from writer import BatchedWriter
+
+START_NS = 1_703_692_800_000_000_000
+
+
+def synthetic_instruments(count):
+    """(provider, internal pair) of registered instruments with a price tick of 0.01 or coarser"""
+
+    instruments = [
+        (provider, internal_pair)
+        for provider, pairs in instrument_specs().items()
+        for internal_pair, (price_decimals, _) in pairs.items()
+        if price_decimals <= 2
+    ]
+    if len(instruments) < count:
+        raise ValueError(f"only {len(instruments)} instruments available")
+    return instruments[:count]
+
+
+def write_synthetic_book(conn, provider, internal_pair, snapshots, overrides, seed):
+    """`snapshots` snapshots of 200 levels a side, each followed by `overrides` override rows"""
+
+    rng = random.Random(seed)
+    price_decimals = REGISTRY.from_internal(provider, internal_pair).price_decimals
+    mid = 42_000 * 10**price_decimals
+    base, counter = internal_pair.split("-")
+    time_ns = START_NS + seed
+
+    def level(ticks):
+        return [ticks_to_str(ticks, price_decimals), f"{rng.uniform(0.01, 2):.8f}"]
+
+    snapshot_id = None
+    for _ in range(snapshots):
+        result = conn.execute(
+            OrderbookSnapshot.__table__.insert().values(
+                external_time=ns_to_datetime(time_ns),
+                received_at=ns_to_datetime(time_ns),
+                external_time_ns=time_ns,
+                received_at_ns=time_ns,
+                base=base,
+                counter=counter,
+                provider=provider,
+                levels=-1,
+                bids=json.dumps([level(mid - i) for i in range(1, 201)]),
+                asks=json.dumps([level(mid + i) for i in range(1, 201)]),
+            )
+        )
+        snapshot_id = result.inserted_primary_key[0]
+        rows = []
+        for _ in range(overrides):
+            time_ns += rng.randint(1_000_000, 50_000_000)
+            distance = rng.randint(1, 250)
+            bids_overrides = [level(mid - distance)] if rng.random() < 0.5 else []
+            asks_overrides = [] if bids_overrides else [level(mid + distance)]
+            for levels in (bids_overrides, asks_overrides):
+                if levels and rng.random() < 0.3:
+                    levels[0][1] = "0"
+            rows.append(
+                {
+                    "orderbook_snapshot_id": snapshot_id,
+                    "external_time": ns_to_datetime(time_ns),
+                    "received_at": ns_to_datetime(time_ns),
+                    "external_time_ns": time_ns,
+                    "received_at_ns": time_ns,
+                    "base": base,
+                    "counter": counter,
+                    "provider": provider,
+                    "bids_overrides": json.dumps(bids_overrides),
+                    "asks_overrides": json.dumps(asks_overrides),
+                }
+            )
+        conn.execute(OrderbookLevelOverride.__table__.insert(), rows)
+        time_ns += 1_000_000_000
+    conn.execute(
+        LatestOrderbookSnapshot.__table__.insert().values(
+            provider=provider, base=base, counter=counter, orderbook_snapshot_id=snapshot_id
+        )
+    )
+
+
+def serial_replay(database_url, instruments, sink_url):
+    """(seconds, updates, rows written) of replay.replay with a VwapReplayConsumer in this process"""
+
+    writer = BatchedWriter(make_sink(sink_url))
+
+    def emit(row):
+        writer.add(VwapSnapshot, row)
+        writer.maybe_flush()
+
+    consumer = VwapReplayConsumer(emit)
+    tick = time.perf_counter()
+    updates_count = replay(get_engine(database_url), instruments, [consumer])
+    writer.close()
+    return time.perf_counter() - tick, updates_count, consumer.snaps_count
+
+
+def written_rows(sink_url):
+    """vwap_snapshots rows of a sink database, as snapper.vwap_row dicts in the order written"""
+
+    table = VwapSnapshot.__table__
+    columns = [column for column in table.c if column.name not in ("id", "created_at")]
+    with get_engine(sink_url).connect() as conn:
+        return [dict(row._mapping) for row in conn.execute(select(*columns).order_by(table.c.id))]
+
+
+def row_key(row):
+    return row["snapped_at_ns"], row["provider"], row["base"], row["counter"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instruments", type=int, default=8)
+    parser.add_argument("--snapshots", type=int, default=2, help="snapshots per instrument")
+    parser.add_argument("--overrides", type=int, default=20_000, help="override rows per snapshot")
+    parser.add_argument("--workers", default=None, help="worker counts, e.g. 1,2,4")
+    parser.add_argument("--partition", default="instrument", choices=("instrument", "snapshot"))
+    parser.add_argument("--database-url", default=None, help="replay this database, not a synthetic one")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.workers is not None:
+        worker_counts = [int(workers) for workers in args.workers.split(",")]
+    else:
+        worker_counts = [1]
+        while worker_counts[-1] * 2 <= os.cpu_count():
+            worker_counts.append(worker_counts[-1] * 2)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_url = args.database_url
+        if database_url is None:
+            database_url = f"sqlite:///{os.path.join(tmp_dir, 'replay.sqlite')}"
+            instruments = synthetic_instruments(args.instruments)
+            with get_engine(database_url).begin() as conn:
+                for seed, (provider, internal_pair) in enumerate(instruments):
+                    write_synthetic_book(conn, provider, internal_pair, args.snapshots, args.overrides, seed)
+        else:
+            instruments = recorded_instruments(get_engine(database_url))
+
+        serial_url = f"sqlite:///{os.path.join(tmp_dir, 'vwap_serial.sqlite')}"
+        elapsed, updates_count, rows_count = serial_replay(database_url, instruments, serial_url)
+        serial_rows = sorted(written_rows(serial_url), key=row_key)
+        print(f"{len(instruments)} instruments, {updates_count:,} updates, {rows_count:,} VWAP ladders")
+        print(f"{os.cpu_count()} cpus, {args.partition} partitions")
+        print(f"{'run':<12} {'seconds':>9} {'updates/s':>12} {'speedup':>8}")
+        print(f"{'serial':<12} {elapsed:>9.2f} {updates_count / elapsed:>12,.0f} {'':>8}")
+        one_worker_elapsed = None
+        for workers in worker_counts:
+            sink_url = f"sqlite:///{os.path.join(tmp_dir, f'vwap_{workers}.sqlite')}"
+            tick = time.perf_counter()
+            parallel_vwap_replay(
+                database_url, instruments, max_workers=workers, partition=args.partition, sink_url=sink_url
+            )
+            elapsed = time.perf_counter() - tick
+            one_worker_elapsed = one_worker_elapsed or elapsed
+            speedup = one_worker_elapsed / elapsed
+            print(f"{f'{workers} workers':<12} {elapsed:>9.2f} {updates_count / elapsed:>12,.0f} {speedup:>7.2f}x")
+            rows = written_rows(sink_url)
+            assert all(a["snapped_at_ns"] <= b["snapped_at_ns"] for a, b in zip(rows, rows[1:])), "not in time order"
+            if args.partition == "instrument":  # same ladders as the serial replay
+                assert sorted(rows, key=row_key) == serial_rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Notebook VWAP functions vs market_data_vwap_snapper.vwap.
+
+builds a synthetic book (a SimpleOrderBook, like `OrderBook Vwap - Test.ipynb`) and times the VWAP
+depth ladder of both sides computed:
+- `generate_vwaps_list` of `Analyse book.ipynb`: `get_vwap` per depth and side on the top levels,
+  results as a list of dicts
+- `compute_vwaps_list` of `OrderBook Vwap - Test.ipynb`: walks the book trees level by level
+- `vwap_ladder_usd`: one cumsum and one searchsorted for the whole ladder, into a preallocated array
+
+the first and last must give the same VWAPs, which is checked.
+
+then times the ladders of `--books` books of random levels, one `vwap_ladder_usd` call per book vs
+one `batch_vwap_ladders` call for all of them (with and without packing the levels), checking they
+agree, and prints the book sides handled per second.
+
+finally replays a synthetic override stream (see benchmark_l2_book.py) on an L2Book, snapping the
+ladder every `--snap-every` updates with `vwap_ladder_usd` of all the book levels and with a
+`VwapCache`, checks they agree (also with most levels outside a small L2Book window), and prints the
+time per snap and the cache hit rate.
+
+simple_order_book.py lives at the repository root (the notebooks import it from there), so it is
+imported from the parent directory.
+
+run from this directory: python benchmark_vwap.py [--levels 2000] [--depth-levels 200] [--updates 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from itertools import islice
+
+import numpy as np
+
+from benchmark_l2_book import TICK_SIZE, override_stream
+from config import VWAP_DEPTHS_USD
+from l2_book import L2Book
+from vwap import (
+    VwapCache,
+    batch_vwap_ladders,
+    batch_vwap_ladders_packed,
+    pack_books,
+    vwap_ladder_usd,
+)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from simple_order_book import SimpleOrderBook  # noqa: E402
+
+
+def synthetic_book(levels, seed=0):
+    rng = random.Random(seed)
+    book = SimpleOrderBook()
+    for side, direction in (("bid", -1), ("ask", 1)):
+        tick = 4_200_000 + (direction > 0)
+        for _ in range(levels):
+            book.apply_update(side, round(rng.expovariate(2), 8) + 1e-8, tick / 100)
+            tick += direction * rng.randint(1, 5)
+    return book
+
+
+def depth_arrays(book, depth_levels):
+    bids = np.array(list(islice(book._bids.items(reverse=True), depth_levels)))
+    asks = np.array(list(islice(book._asks.items(), depth_levels)))
+    return bids, asks
+
+
+# Analyse book.ipynb
+def get_vwap(book, vwap_depth):
+    vwap_lb = book[book[:, 1].cumsum() < vwap_depth]
+    vwap_ub = book[book[:, 1].cumsum() >= vwap_depth]
+    if vwap_ub.size == 0:  # vwap could not be resolved due to insufficient depth
+        return np.nan
+    vwap_lb_val = np.dot(vwap_lb[:, 1], vwap_lb[:, 0])
+    vwap_ub_val = (vwap_depth - vwap_lb[:, 1].sum()) * vwap_ub[0, 0]
+    vwap = (vwap_lb_val + vwap_ub_val) / vwap_depth
+    return vwap
+
+
+def generate_vwaps_list(bids_np, asks_np, vwap_depths_usd):
+    mid_rate = (bids_np[0, 0] + asks_np[0, 0]) / 2
+    current_vwap_snaps = []
+    for vwap_depth_usd in vwap_depths_usd:
+        vwap_depth_ccy = vwap_depth_usd / mid_rate
+        current_vwap_snaps.append(
+            {
+                "vwap_depth_usd": vwap_depth_usd,
+                "bid_vwap": get_vwap(bids_np, vwap_depth_ccy),
+                "ask_vwap": get_vwap(asks_np, vwap_depth_ccy),
+            }
+        )
+    return current_vwap_snaps
+
+
+# OrderBook Vwap - Test.ipynb, with the mid rate passed in instead of read from a global
+def compute_vwaps_list(order_book, VWAP_DEPTHS_USD, mid_rate_book):
+    vwaps_computed_list = []
+    sides = {}
+    asks_items, bids_items = order_book._asks.iter_items(), order_book._bids.iter_items(reverse=True)
+    for side, items in (("ask", asks_items), ("bid", bids_items)):
+        vwaps_computed = {i: 0 for i in VWAP_DEPTHS_USD}
+        vwap_left = {i: i for i in VWAP_DEPTHS_USD}
+        for price, qty in items:
+            qty_usd = qty * mid_rate_book
+            for depth_usd, depth_still_to_fill in vwap_left.copy().items():
+                if depth_usd == 0:
+                    vwap_left.pop(depth_usd)
+                    vwaps_computed[depth_usd] = price
+                else:
+                    prev_qty = vwap_left[depth_usd]
+                    vwap_left[depth_usd] -= qty_usd
+                    if vwap_left[depth_usd] <= 0:
+                        vwap_left.pop(depth_usd)
+                        vwaps_computed[depth_usd] += prev_qty * price
+                        vwaps_computed[depth_usd] = vwaps_computed[depth_usd] / depth_usd
+                    else:
+                        vwaps_computed[depth_usd] += qty_usd * price
+            if not vwap_left:
+                break
+        sides[side] = vwaps_computed
+    for depth_usd in VWAP_DEPTHS_USD:
+        vwap_ask = sides["ask"].get(depth_usd)
+        vwap_bid = sides["bid"].get(depth_usd)
+        if vwap_ask or vwap_bid:
+            vwaps_computed_list.append({"bid": vwap_bid, "ask": vwap_ask, "depth_usd": depth_usd})
+    return vwaps_computed_list
+
+
+def timed(function, repeat):
+    """(microseconds per call, last result)"""
+
+    tick = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - tick) / repeat * 1e6, result
+
+
+def random_books(books, levels, seed=0):
+    """[(bids, asks)] (levels, 2) arrays around mid rates spread over a few orders of magnitude"""
+
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for mid_rate in 10 ** rng.uniform(-2, 5, books):
+        tick = mid_rate * 1e-4
+        sides = []
+        for direction in (-1, 1):
+            prices = mid_rate + direction * tick * np.cumsum(rng.integers(1, 5, levels))
+            sides.append(np.column_stack((prices, rng.exponential(2e4 / mid_rate, levels))))
+        pairs.append(tuple(sides))
+    return pairs
+
+
+def replay(stream, snap_every, snap, capacity=8_192):
+    """Seconds spent in `snap(book)`, called every `snap_every` updates of the stream"""
+
+    book = L2Book(TICK_SIZE, capacity)
+    elapsed = 0.0
+    for idx, (side, size, price) in enumerate(stream):
+        book.apply_update(side, size, price)
+        if idx % snap_every == 0:
+            tick = time.perf_counter()
+            snap(book)
+            elapsed += time.perf_counter() - tick
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", type=int, default=2_000, help="levels per side in the book")
+    parser.add_argument("--depth-levels", type=int, default=200, help="levels per side for the VWAP code")
+    parser.add_argument("--repeat", type=int, default=2_000)
+    parser.add_argument("--books", type=int, default=1_000, help="books of the batched ladders")
+    parser.add_argument("--updates", type=int, default=100_000, help="overrides replayed on the L2Book")
+    parser.add_argument("--snap-every", type=int, default=10, help="updates between two ladders")
+    args = parser.parse_args()
+
+    book = synthetic_book(args.levels)
+    bids, asks = depth_arrays(book, args.depth_levels)
+    mid_rate = (bids[0, 0] + asks[0, 0]) / 2
+    ladder = np.empty((2, len(VWAP_DEPTHS_USD)))
+    cases = [
+        ("generate_vwaps_list", lambda: generate_vwaps_list(bids, asks, VWAP_DEPTHS_USD)),
+        ("compute_vwaps_list", lambda: compute_vwaps_list(book, VWAP_DEPTHS_USD, mid_rate)),
+        ("vwap_ladder_usd", lambda: vwap_ladder_usd(bids, asks, VWAP_DEPTHS_USD, out=ladder)),
+    ]
+    print(f"{len(VWAP_DEPTHS_USD)} depths, {args.depth_levels} of {args.levels} levels per side")
+    print(f"{'function':<20} {'us / ladder':>12}")
+    results = {}
+    for name, function in cases:
+        elapsed_us, results[name] = timed(function, args.repeat)
+        print(f"{name:<20} {elapsed_us:>12.1f}")
+
+    reference = np.array([[snap["bid_vwap"] for snap in results["generate_vwaps_list"]],
+                          [snap["ask_vwap"] for snap in results["generate_vwaps_list"]]])
+    assert np.allclose(reference, results["vwap_ladder_usd"], equal_nan=True), (reference, ladder)
+
+
+    books = random_books(args.books, args.depth_levels)
+    depths_usd = np.asarray(VWAP_DEPTHS_USD, dtype=np.float64)
+    ladders = np.empty((len(books), 2, depths_usd.size))
+    packed = pack_books(books, args.depth_levels)
+    repeat = max(args.repeat // 100, 1)
+    cases = [
+        ("vwap_ladder_usd loop", lambda: [
+            vwap_ladder_usd(bids, asks, depths_usd, out=ladders[i]) for i, (bids, asks) in enumerate(books)
+        ]),
+        ("batch_vwap_ladders", lambda: batch_vwap_ladders(books, depths_usd, args.depth_levels, out=ladders)),
+        ("  of packed levels", lambda: batch_vwap_ladders_packed(*packed, depths_usd, out=ladders)),
+    ]
+    print(f"\n{len(books):,} books, {args.depth_levels} levels per side")
+    print(f"{'function':<20} {'ms / call':>12} {'sides / s':>12}")
+    results = {}
+    for name, function in cases:
+        elapsed_us, _ = timed(function, repeat)
+        results[name] = ladders.copy()
+        print(f"{name:<20} {elapsed_us / 1e3:>12.2f} {2 * len(books) / elapsed_us * 1e6:>12,.0f}")
+    assert np.allclose(results["vwap_ladder_usd loop"], results["batch_vwap_ladders"], equal_nan=True)
+
+    stream = override_stream(args.updates)
+    snaps = len(range(0, len(stream), args.snap_every))
+
+    def full_ladder(book):
+        return vwap_ladder_usd(book.levels("bid"), book.levels("ask"), depths_usd)
+
+    for capacity in (8_192, 64):  # 64 ticks: most levels outside the window
+        check_cache = VwapCache(depths_usd)
+
+        def check(book):
+            expected = full_ladder(book)
+            assert np.allclose(check_cache.ladder(book), expected, equal_nan=True), (capacity, expected)
+
+        replay(stream, args.snap_every, check, capacity)
+
+    cache = VwapCache(depths_usd)
+    cases = [
+        ("vwap_ladder_usd", full_ladder),
+        ("VwapCache", cache.ladder),
+    ]
+    print(f"\n{len(stream):,} overrides on an L2Book, a ladder every {args.snap_every} updates")
+    print(f"{'function':<20} {'us / ladder':>12}")
+    for name, snap in cases:
+        elapsed = replay(stream, args.snap_every, snap)
+        print(f"{name:<20} {elapsed / snaps * 1e6:>12.1f}")
+    print(
+        f"cache: {cache.hits:,} hits, {cache.misses:,} misses. hit rate {cache.hit_rate:.1%}"
+    )
+
+
+if __name__ == "__main__":
+    main()
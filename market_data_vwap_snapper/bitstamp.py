@@ -1,18 +1,15 @@
 import json
-import time
-from utils import to_external_pair, to_internal_pair
+from utils import to_external_pair
+from instruments import REGISTRY
 import logging
-from config import (
-    WEBSOCKET_URLS,
-    EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT,
-    COMMIT_EVERY_X_SECONDS,
-    COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT,
-)
-from websockets import connect
-from datetime import datetime
-from models import OrderbookSnapshot, OrderbookLevelOverride, OrderbookLevelDiff, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from config import WEBSOCKET_URLS, FAST_DECODE
+from fast_decode import json_loads, field_re, string_field, levels_slice, price_size_levels
+from timestamps import microseconds_str_to_ns, ns_to_datetime, epoch_ns_columns
+from models import OrderbookSnapshot, OrderbookLevelOverride, OrderbookLevelDiff
+from level_codec import level_columns
+from sinks import make_sink
+from writer import BatchedWriter
+from pipeline import FeedPipeline
 
 
 # REMOVE
@@ -23,48 +20,35 @@ ssl_context = ssl.create_default_context()
 ssl_context.load_verify_locations(certifi.where())
 
 
-sqlite_filepath = "market_data.sqlite"
-engine = create_engine(f"sqlite:///{sqlite_filepath}")
-Session = sessionmaker()
-Session.configure(bind=engine)
-session = Session()
-
-Base.metadata.create_all(engine)
-
-
 def classify_bitstamp_ws_message(ws_message):
     if ws_message["event"] == "bts:subscription_succeeded":
         logging.info(ws_message)
         return {"external_time": None, "type": ws_message["event"]}
     elif (ws_message["event"] == "data") & (ws_message["channel"].startswith("order_book_")):
-        msg = f"received snapshot message for {ws_message['channel']}"
-        logging.info(msg)
-        external_pair = ws_message["channel"].split("_")[2]
-        internal_pair = to_internal_pair(external_pair, "bitstamp")
-        external_time = datetime.utcfromtimestamp(
-            float(ws_message["data"]["microtimestamp"]) / 1000000
-        )
+        instrument = REGISTRY.from_channel(ws_message["channel"])
+        external_pair = instrument.external_symbol
+        external_time_ns = microseconds_str_to_ns(ws_message["data"]["microtimestamp"])
         processed_msg = {
-            "external_time": external_time,
+            "external_time": ns_to_datetime(external_time_ns),
+            "external_time_ns": external_time_ns,
             "type": "snapshot",
-            "internal_pair": internal_pair,
+            "instrument": instrument,
+            "internal_pair": instrument.internal_pair,
             "pair": external_pair,
             "asks": ws_message["data"]["asks"],
             "bids": ws_message["data"]["bids"],
         }
         return processed_msg
     elif (ws_message["event"] == "data") & (ws_message["channel"].startswith("diff_order_book_")):
-        msg = f"received l2update [diff] message for {ws_message['channel']}"
-        logging.info(msg)
-        external_pair = ws_message["channel"].split("_")[3]
-        internal_pair = to_internal_pair(external_pair, "bitstamp")
-        external_time = datetime.utcfromtimestamp(
-            float(ws_message["data"]["microtimestamp"]) / 1000000
-        )
+        instrument = REGISTRY.from_channel(ws_message["channel"])
+        external_pair = instrument.external_symbol
+        external_time_ns = microseconds_str_to_ns(ws_message["data"]["microtimestamp"])
         processed_msg = {
-            "external_time": external_time,
+            "external_time": ns_to_datetime(external_time_ns),
+            "external_time_ns": external_time_ns,
             "type": "l2update",
-            "internal_pair": internal_pair,
+            "instrument": instrument,
+            "internal_pair": instrument.internal_pair,
             "pair": external_pair,
             "changes": {
                 "bids_overrides": ws_message["data"]["bids"],
@@ -73,21 +57,17 @@ def classify_bitstamp_ws_message(ws_message):
         }
         return processed_msg
     elif (ws_message["event"] in {"order_created","order_deleted","order_changed"}) & (ws_message["channel"].startswith("live_orders")):
-        msg = f"received live_orders message for {ws_message['channel']}"
-        if ws_message["event"] == 'order_deleted': logging.info(ws_message)# ONLY DEBUG
-            
-        logging.info(msg)
-        external_pair = ws_message["channel"].split("_")[2]
-        internal_pair = to_internal_pair(external_pair, "bitstamp")
-        external_time = datetime.utcfromtimestamp(
-            float(ws_message["data"]["microtimestamp"]) / 1000000
-        )
+        instrument = REGISTRY.from_channel(ws_message["channel"])
+        external_pair = instrument.external_symbol
+        external_time_ns = microseconds_str_to_ns(ws_message["data"]["microtimestamp"])
         assert ws_message["data"]["order_type"] in {0,1}
         # TODO TEMPORARY to get timestamps
         processed_msg = {
-            "external_time": external_time,
+            "external_time": ns_to_datetime(external_time_ns),
+            "external_time_ns": external_time_ns,
             "type": "live_book_change",
-            "internal_pair": internal_pair,
+            "instrument": instrument,
+            "internal_pair": instrument.internal_pair,
             "pair": external_pair,
             # "order_id": ws_message["data"]["id_str"],
             # "changes": {
@@ -105,167 +85,147 @@ def classify_bitstamp_ws_message(ws_message):
         return {"external_time": None, "type": "unknown",'message_payload':ws_message}
 
 
-async def bitstamp_orderbook_download(pairs_internal):
-    type_of_sub = "live_orders"  # diff_order_book # order_book #live_orders
-    url = WEBSOCKET_URLS["bitstamp"]
-    message_counter = 0
-    ws = await connect(url, ssl=ssl_context)
-
-    for pair in pairs_internal:
-        bitstamp_pair = to_external_pair(pair, "bitstamp")
-        subscribe_message = {
-            "event": "bts:subscribe",
-            "data": {"channel": f"{type_of_sub}_{bitstamp_pair}"},
-        }
-        await ws.send(json.dumps(subscribe_message))
-
-    last_commit_time = datetime.utcnow()
-    orderbook_snapshot_ids = {}
-    commit_exceptions_in_row_count = 0
-    websocket_closed_times = 0
-    commit_exceptions_total_count = 0
-    expections_in_receipt_count = 0
-    exceptions_in_reconnection_in_row = 0
-    while True:
-        try:
-            if not ws.open:
-                websocket_closed_times += 1
-                logging.warning("Websocket NOT connected. Trying to reconnect.")
-                ws = await connect(url, ssl=ssl_context)
-                await ws.send(json.dumps(subscribe_message))
-                # await ws.send(json.dumps(subscribe_message2))
-            data = await ws.recv()
-        except Exception as e:
-            expections_in_receipt_count += 1
-            logging.info(f"exception caught")
-            try:
-                logging.warning(f"got exception in receipt. \n{e}\n. trying to reconnect...")
-                ws = await connect(url, ssl=ssl_context)
-                await ws.send(json.dumps(subscribe_message))
-                logging.info(f"Reconnected")
-                exceptions_in_reconnection_in_row = 0
-            except Exception as e2:
-                exceptions_in_reconnection_in_row += 1
-                if exceptions_in_reconnection_in_row < EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT:
-                    logging.warning(f"got exception in reconnection. \n{e2}\n. continuing")
-                    time.sleep(3)
-                    continue
-                else:
-                    logging.error(
-                        f"too many exceptioins in reconnection. {exceptions_in_reconnection_in_row}/{EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT}"
-                    )
-                    raise ValueError(
-                        f"too many exceptioins in reconnection. {exceptions_in_reconnection_in_row}/{EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT}"
-                    )
-        received_at = datetime.utcnow()
-        if message_counter % 10_000 == 0:
-            logging.info(
-                f"now: {received_at.strftime('%Y-%m-%d %H:%M:%S')}. last commit: {last_commit_time.strftime('%Y-%m-%d %H:%M:%S')}. # msg: {message_counter}. #closed socket: {websocket_closed_times}. #commit exep: {commit_exceptions_total_count}. #receipt exep: {expections_in_receipt_count}"
-            )
-        message_counter += 1
-
-        json_data = json.loads(data)
-
-        # print(f"RAW MESSAGE FOR DEBUGGING {json_data}")
-        json_data["time_utc"] = time.time() * 1000
-        msg_classified = classify_bitstamp_ws_message(json_data)
-        should_commit_to_db = (
-            (datetime.utcnow() - last_commit_time).seconds
-        ) > COMMIT_EVERY_X_SECONDS
-
-        if msg_classified["type"] == "snapshot":
-            base_ccy, counter_ccy = msg_classified["internal_pair"].split("-")
-            external_time = msg_classified["external_time"]
-            current_orderbook_snapshot = OrderbookSnapshot(
-                external_time=external_time,
-                received_at=received_at,
-                base=base_ccy,
-                counter=counter_ccy,
-                provider="bitstamp",
-                levels=-1,
-                bids=json.dumps(msg_classified["bids"]),
-                asks=json.dumps(msg_classified["asks"]),
-            )
-            
-            session.add(current_orderbook_snapshot)
-            session.commit()
-            orderbook_snapshot_ids[f"{base_ccy}-{counter_ccy}"] = current_orderbook_snapshot.id
-        elif msg_classified["type"] == "l2update":
-            base_ccy, counter_ccy = msg_classified["internal_pair"].split("-")
-            external_time = msg_classified["external_time"]
-            bids_overrides = json.dumps(msg_classified["changes"]["bids_overrides"])
-            asks_overrides = json.dumps(msg_classified["changes"]["asks_overrides"])
+_EVENT_RE = field_re("event")
+_CHANNEL_RE = field_re("channel")
+_MICROTIMESTAMP_RE = field_re("microtimestamp")
+
+
+def fast_classify_bitstamp_frame(frame):
+    """Fast decode path for diff_order_book frames: bids/asks are sliced out of the frame as they are.
+    any other message goes through `classify_bitstamp_ws_message`"""
+
+    channel = string_field(frame, _CHANNEL_RE)
+    if (
+        channel is None
+        or not channel.startswith("diff_order_book_")
+        or string_field(frame, _EVENT_RE) != "data"
+    ):
+        return classify_bitstamp_ws_message(json_loads(frame))
+
+    instrument = REGISTRY.from_channel(channel)
+    external_time_ns = microseconds_str_to_ns(string_field(frame, _MICROTIMESTAMP_RE))
+    bids = levels_slice(frame, "bids")
+    asks = levels_slice(frame, "asks")
+    return {
+        "external_time": ns_to_datetime(external_time_ns),
+        "external_time_ns": external_time_ns,
+        "type": "l2update",
+        "instrument": instrument,
+        "internal_pair": instrument.internal_pair,
+        "pair": instrument.external_symbol,
+        "bids_overrides_raw": bids,
+        "asks_overrides_raw": asks,
+        "bids_overrides": price_size_levels(bids) if bids else [],
+        "asks_overrides": price_size_levels(asks) if asks else [],
+    }
+
+
+def persist_bitstamp_message(msg_classified, received_at, writer, orderbook_snapshot_ids):
+    """Turns a classified message into rows for the writer. runs on the DB thread of the pipeline"""
+
+    if msg_classified["type"] == "snapshot":
+        instrument = msg_classified["instrument"]
+        base_ccy, counter_ccy = instrument.base, instrument.counter
+        external_time = msg_classified["external_time"]
+        orderbook_snapshot_ids[instrument.internal_pair] = writer.insert_snapshot(
+            {
+                "external_time": external_time,
+                "received_at": received_at,
+                **epoch_ns_columns(msg_classified),
+                "base": base_ccy,
+                "counter": counter_ccy,
+                "provider": "bitstamp",
+                "levels": -1,
+                **level_columns(
+                    OrderbookSnapshot, json.dumps(msg_classified["bids"]), json.dumps(msg_classified["asks"])
+                ),
+            },
+        )
+    elif msg_classified["type"] == "l2update":
+        instrument = msg_classified["instrument"]
+        base_ccy, counter_ccy = instrument.base, instrument.counter
+        external_time = msg_classified["external_time"]
+        if "bids_overrides_raw" in msg_classified:
+            bids_overrides = msg_classified["bids_overrides_raw"]
+            asks_overrides = msg_classified["asks_overrides_raw"]
+            levels = msg_classified["bids_overrides"], msg_classified["asks_overrides"]
+        else:
+            levels = msg_classified["changes"]["bids_overrides"], msg_classified["changes"]["asks_overrides"]
+            bids_overrides, asks_overrides = json.dumps(levels[0]), json.dumps(levels[1])
+
+        writer.add(
+            OrderbookLevelOverride,
+            {
+                "orderbook_snapshot_id": orderbook_snapshot_ids.get(instrument.internal_pair),
+                "external_time": external_time,
+                "received_at": received_at,
+                **epoch_ns_columns(msg_classified),
+                "base": base_ccy,
+                "counter": counter_ccy,
+                "provider": "bitstamp",
+                **level_columns(OrderbookLevelOverride, bids_overrides, asks_overrides, levels=levels),
+            },
+        )
 
-            current_orderbook_update = OrderbookLevelOverride(
-                orderbook_snapshot_id=orderbook_snapshot_ids.get(f"{base_ccy}-{counter_ccy}"),
-                external_time=external_time,
-                received_at=received_at,
-                base=base_ccy,
-                counter=counter_ccy,
-                provider="bitstamp",
-                bids_overrides=bids_overrides,
-                asks_overrides=asks_overrides,
-            )
-            session.add(current_orderbook_update)
-            
+    elif msg_classified["type"] == "live_book_change":
+        instrument = msg_classified["instrument"]
+        base_ccy, counter_ccy = instrument.base, instrument.counter
+        external_time = msg_classified["external_time"]
+
+        writer.add(
+            OrderbookLevelDiff,
+            {
+                "orderbook_snapshot_id": orderbook_snapshot_ids.get(instrument.internal_pair),
+                "external_time": external_time,
+                "received_at": received_at,
+                **epoch_ns_columns(msg_classified),
+                "base": base_ccy,
+                "counter": counter_ccy,
+                "provider": "bitstamp",
+                "bids_changes": "[]", # TODO fix after understanding how to process these messages in book updates
+                "asks_changes": str([{'amount':msg_classified['amount'], # TODO fix after understanding how to process these messages in book updates
+                           'price':msg_classified['price'],
+                           'action_type':msg_classified['action_type'],
+
+                           }]),
+            },
+        )
 
-            if should_commit_to_db:
-                try:
-                    session.commit()
-                    last_commit_time = datetime.utcnow()
-                    commit_exceptions_in_row_count = 0
-                except Exception as e:
-                    commit_exceptions_total_count += 1
-                    commit_exceptions_in_row_count += 1
-                    logging.warning(
-                        f"exception while committing to DB. {commit_exceptions_in_row_count} in a row: \n{e}\n"
-                    )
-                    if commit_exceptions_in_row_count > COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT:
-                        raise ValueError(
-                            f"Too many commit exceptions in a row. crashing. {commit_exceptions_in_row_count}/{COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT}"
-                        )
-                        
-        elif msg_classified["type"] == "live_book_change":
-            base_ccy, counter_ccy = msg_classified["internal_pair"].split("-")
-            external_time = msg_classified["external_time"]
+    elif msg_classified["type"] == "bts:subscription_succeeded":
+        logging.info("subscription")
+        # we need to call the full book endpoint when we get this message subscription succeeded message. as Bitstamp does not send the full book when we first subscribe
+    else:
+        logging.warning(f"received unclassified message: {msg_classified}")
 
 
-            current_orderbook_update = OrderbookLevelDiff(
-                orderbook_snapshot_id=orderbook_snapshot_ids.get(f"{base_ccy}-{counter_ccy}"),
-                external_time=external_time,
-                received_at=received_at,
-                base=base_ccy,
-                counter=counter_ccy,
-                provider="bitstamp",
-                bids_changes="[]", # TODO fix after understanding how to process these messages in book updates
-                asks_changes=str([{'amount':msg_classified['amount'], # TODO fix after understanding how to process these messages in book updates
-                               'price':msg_classified['price'],
-                               'action_type':msg_classified['action_type'],
-                               
-                               }]),
-            )
-            session.add(current_orderbook_update)
-            
+async def bitstamp_orderbook_download(pairs_internal, writer=None, db_executor=None, live_books=None):
+    """Downloads the books of `pairs_internal` until the feed fails.
+    `writer`/`db_executor`/`live_books` are shared by the supervisor. when omitted the feed gets its
+    own writer and keeps no live books"""
 
-            if should_commit_to_db:
-                try:
-                    session.commit()
-                    last_commit_time = datetime.utcnow()
-                    commit_exceptions_in_row_count = 0
-                except Exception as e:
-                    commit_exceptions_total_count += 1
-                    commit_exceptions_in_row_count += 1
-                    logging.warning(
-                        f"exception while committing to DB. {commit_exceptions_in_row_count} in a row: \n{e}\n"
-                    )
-                    if commit_exceptions_in_row_count > COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT:
-                        raise ValueError(
-                            f"Too many commit exceptions in a row. crashing. {commit_exceptions_in_row_count}/{COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT}"
-                        )
+    type_of_sub = "live_orders"  # diff_order_book # order_book #live_orders
+    subscribe_messages = []
+    for pair in pairs_internal:
+        bitstamp_pair = to_external_pair(pair, "bitstamp")
+        subscribe_messages.append(
+            {
+                "event": "bts:subscribe",
+                "data": {"channel": f"{type_of_sub}_{bitstamp_pair}"},
+            }
+        )
 
-        elif msg_classified["type"] == "bts:subscription_succeeded":
-            print("subscription")
-            logging.info("subscription")
-            # we need to call the full book endpoint when we get this message subscription succeeded message. as Bitstamp does not send the full book when we first subscribe
-        else:
-            logging.warning(f"received unclassified message: {msg_classified}")
+    if writer is None:
+        writer = BatchedWriter(make_sink())
+    pipeline = FeedPipeline(
+        provider="bitstamp",
+        url=WEBSOCKET_URLS["bitstamp"],
+        subscribe_messages=subscribe_messages,
+        classify=classify_bitstamp_ws_message,
+        persist=persist_bitstamp_message,
+        writer=writer,
+        decode=fast_classify_bitstamp_frame if FAST_DECODE else None,
+        ssl=ssl_context,
+        db_executor=db_executor,
+        live_books=live_books,
+    )
+    await pipeline.run()
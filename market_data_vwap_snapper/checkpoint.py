@@ -0,0 +1,291 @@
+"""Warm-restart checkpoints of the live books.
+
+a checkpoint file is a header followed by one record per book:
+
+    header: magic b"CKP1", version (uint16), book count (uint32)
+    book:   provider length (uint16), pair length (uint16), orderbook_snapshot_id (int64, -1 if none),
+            external_time_ns (int64, -1 if unknown), id of the last override applied (int64, -1 if
+            unknown), packed levels length (uint32),
+            then the provider and pair (utf-8) and the packed level array (see level_codec.py)
+
+it is written to a temporary file, fsynced and renamed over the previous checkpoint, so a crash
+never leaves a partial file behind. on startup `restore_live_books` reads it and `resync_live_books`
+replays only the gap: the overrides persisted after the checkpoint, by (external_time, id) like
+replay.py orders them, starting from a newer snapshot of the instrument if one was persisted in the
+meantime.
+
+the id of an override is only known once the writer has flushed it, so `write_checkpoint` flushes
+the writer and looks the ids up. when the id is unknown the resync starts at the external_time of
+the book instead: overrides set absolute sizes, so applying again the ones of that time already
+applied (and every later one) leaves the book as it was.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+
+from config import CHECKPOINT_INTERVAL_SECONDS
+from database import get_engine
+from level_codec import decode_levels_to_strings, encode_levels, packed_size, row_levels
+from live_books import LiveBook, LiveBooks
+from metrics import METRICS
+from models import LatestOrderbookSnapshot, OrderbookLevelOverride, OrderbookSnapshot
+from sqlalchemy import bindparam, func, select
+from timestamps import ns_to_datetime
+
+MAGIC = b"CKP1"
+VERSION = 2
+HEADER = struct.Struct("<4sHI")
+BOOK_HEADER = struct.Struct("<HHqqqI")
+
+CHECKPOINT_WRITE_SECONDS = METRICS.histogram(
+    "checkpoint_write_seconds", "time to encode and write a checkpoint of the live books"
+).labels()
+CHECKPOINT_BYTES = METRICS.gauge("checkpoint_bytes", "size of the last checkpoint written").labels()
+CHECKPOINT_BOOKS = METRICS.gauge("checkpoint_books", "books in the last checkpoint written").labels()
+CHECKPOINT_RESTORE_SECONDS = METRICS.gauge(
+    "checkpoint_restore_seconds", "time to read the checkpoint and resync the books on startup"
+).labels()
+CHECKPOINT_RESYNC_ROWS = METRICS.counter(
+    "checkpoint_resync_rows_total", "snapshot and override rows replayed to close the restart gap"
+).labels()
+
+
+def encode_checkpoint(live_books, override_ids=None):
+    """`override_ids`: {(provider, internal pair): id of the last override applied}"""
+
+    override_ids = override_ids or {}
+    chunks = []
+    books = list(live_books)
+    for book in books:
+        provider, pair = book.provider.encode(), book.internal_pair.encode()
+        packed = encode_levels(*book.levels())
+        chunks.append(
+            BOOK_HEADER.pack(
+                len(provider),
+                len(pair),
+                -1 if book.orderbook_snapshot_id is None else book.orderbook_snapshot_id,
+                -1 if book.external_time_ns is None else book.external_time_ns,
+                override_ids.get((book.provider, book.internal_pair), -1),
+                len(packed),
+            )
+        )
+        chunks += [provider, pair, packed]
+    return HEADER.pack(MAGIC, VERSION, len(books)) + b"".join(chunks)
+
+
+def decode_checkpoint(buffer):
+    """(LiveBooks, {(provider, internal pair): id of the last override applied}) of a checkpoint"""
+
+    magic, version, book_count = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError(f"not a live books checkpoint (magic {magic!r})")
+    if version != VERSION:
+        raise ValueError(f"unsupported checkpoint version {version}")
+    live_books = LiveBooks()
+    override_ids = {}
+    offset = HEADER.size
+    for _ in range(book_count):
+        fields = BOOK_HEADER.unpack_from(buffer, offset)
+        provider_len, pair_len, snapshot_id, external_time_ns, override_id, packed_len = fields
+        offset += BOOK_HEADER.size
+        provider = bytes(buffer[offset : offset + provider_len]).decode()
+        offset += provider_len
+        internal_pair = bytes(buffer[offset : offset + pair_len]).decode()
+        offset += pair_len
+        if packed_size(buffer, offset) != packed_len:
+            raise ValueError(f"corrupted checkpoint record for {provider} {internal_pair}")
+        bids, asks = decode_levels_to_strings(buffer, offset)
+        offset += packed_len
+        book = LiveBook(provider, internal_pair)
+        book.apply_snapshot(
+            bids,
+            asks,
+            None if snapshot_id == -1 else snapshot_id,
+            None if external_time_ns == -1 else external_time_ns,
+        )
+        live_books.add(book)
+        if override_id != -1:
+            override_ids[(provider, internal_pair)] = override_id
+    return live_books, override_ids
+
+
+def last_override_ids(conn, live_books):
+    """{(provider, internal pair): id} of the last persisted override of every book at the external_time
+    of the book. once the writer has flushed what was applied, that is the last override applied"""
+
+    table = OrderbookLevelOverride.__table__
+    statement = select(func.max(table.c.id)).where(
+        (table.c.orderbook_snapshot_id == bindparam("orderbook_snapshot_id"))
+        & (table.c.external_time == bindparam("external_time"))
+    )
+    override_ids = {}
+    for book in live_books:
+        if book.orderbook_snapshot_id is None or book.external_time_ns is None:
+            continue
+        override_id = conn.execute(
+            statement,
+            {
+                "orderbook_snapshot_id": book.orderbook_snapshot_id,
+                "external_time": ns_to_datetime(book.external_time_ns),
+            },
+        ).scalar()
+        if override_id is not None:
+            override_ids[(book.provider, book.internal_pair)] = override_id
+    return override_ids
+
+
+def write_checkpoint(live_books, path, writer=None, engine=None):
+    """Atomically replaces the checkpoint at `path`. returns the bytes written.
+    with the `writer` of the feeds and its `engine`, the writer is flushed and the id of the last
+    override applied to every book is checkpointed too (see last_override_ids). if that fails the ids
+    are left unknown.
+    must run on the thread that applies messages to the books (the DB thread)"""
+
+    tick = time.perf_counter()
+    override_ids = None
+    if engine is not None:
+        try:
+            if writer is not None:
+                writer.flush()
+            with engine.connect() as conn:
+                override_ids = last_override_ids(conn, live_books)
+        except Exception:
+            logging.exception("could not look up the last overrides applied. checkpointed without them")
+    buffer = encode_checkpoint(live_books, override_ids)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(buffer)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    CHECKPOINT_WRITE_SECONDS.observe(time.perf_counter() - tick)
+    CHECKPOINT_BYTES.set(len(buffer))
+    CHECKPOINT_BOOKS.set(len(live_books))
+    return len(buffer)
+
+
+def read_checkpoint(path):
+    """decode_checkpoint of the file at `path`"""
+
+    with open(path, "rb") as file:
+        return decode_checkpoint(file.read())
+
+
+def resync_book(conn, book, last_override_id=None):
+    """Brings a restored book up to what was persisted after the checkpoint. `last_override_id` is
+    the id of the last override applied to it, None if unknown. returns the rows used"""
+
+    base, counter = book.internal_pair.split("-")
+    latest_table = LatestOrderbookSnapshot.__table__
+    snapshots_table = OrderbookSnapshot.__table__
+    overrides_table = OrderbookLevelOverride.__table__
+    rows_used = 0
+    from_snapshot = False
+
+    latest = conn.execute(
+        select(latest_table.c.orderbook_snapshot_id, latest_table.c.external_time_ns).where(
+            (latest_table.c.provider == book.provider)
+            & (latest_table.c.base == base)
+            & (latest_table.c.counter == counter)
+        )
+    ).first()
+    if latest is not None and latest.orderbook_snapshot_id != book.orderbook_snapshot_id:
+        # a snapshot newer than the checkpoint: start from it
+        snapshot = conn.execute(
+            select(
+                snapshots_table.c.bids,
+                snapshots_table.c.asks,
+                snapshots_table.c.levels_packed,
+                snapshots_table.c.external_time_ns,
+            ).where(snapshots_table.c.id == latest.orderbook_snapshot_id)
+        ).first()
+        if snapshot is not None and (
+            book.external_time_ns is None
+            or snapshot.external_time_ns is None
+            or snapshot.external_time_ns >= book.external_time_ns
+        ):
+            bids, asks = row_levels(snapshot, OrderbookSnapshot)
+            book.apply_snapshot(bids, asks, latest.orderbook_snapshot_id, snapshot.external_time_ns)
+            rows_used += 1
+            last_override_id = None
+            from_snapshot = True  # every override of the new snapshot came after it
+    if book.orderbook_snapshot_id is None:
+        return rows_used
+
+    statement = select(
+        overrides_table.c.bids_overrides,
+        overrides_table.c.asks_overrides,
+        overrides_table.c.overrides_packed,
+        overrides_table.c.external_time_ns,
+    ).where(overrides_table.c.orderbook_snapshot_id == book.orderbook_snapshot_id)
+    if book.external_time_ns is not None and not from_snapshot:
+        last_time = ns_to_datetime(book.external_time_ns)
+        if last_override_id is None:  # the ones of last_time applied again, see the module docstring
+            statement = statement.where(overrides_table.c.external_time >= last_time)
+        else:  # after the last one applied, by (external_time, id)
+            statement = statement.where(
+                (overrides_table.c.external_time > last_time)
+                | (
+                    (overrides_table.c.external_time == last_time)
+                    & (overrides_table.c.id > last_override_id)
+                )
+            )
+    statement = statement.order_by(overrides_table.c.external_time, overrides_table.c.id)
+    for row in conn.execute(statement):
+        bids_overrides, asks_overrides = row_levels(row, OrderbookLevelOverride)
+        book.apply_overrides(bids_overrides, asks_overrides, row.external_time_ns)
+        rows_used += 1
+    return rows_used
+
+
+def resync_live_books(live_books, engine, override_ids=None):
+    """resync_book for every book. `override_ids` as decode_checkpoint returns them. returns the rows
+    used"""
+
+    override_ids = override_ids or {}
+    rows_used = 0
+    with engine.connect() as conn:
+        for book in live_books:
+            rows_used += resync_book(conn, book, override_ids.get((book.provider, book.internal_pair)))
+    CHECKPOINT_RESYNC_ROWS.inc(rows_used)
+    return rows_used
+
+
+def restore_live_books(path, engine=None):
+    """LiveBooks of the checkpoint at `path` resynced from the database (`get_engine()` if no
+    engine is given). empty LiveBooks if there is no checkpoint or it can not be read"""
+
+    tick = time.perf_counter()
+    if not os.path.exists(path):
+        logging.info(f"no live books checkpoint at {path}. books start empty")
+        return LiveBooks()
+    try:
+        live_books, override_ids = read_checkpoint(path)
+    except (OSError, ValueError, struct.error):
+        logging.exception(f"could not read the live books checkpoint {path}. books start empty")
+        return LiveBooks()
+    rows_used = resync_live_books(live_books, engine if engine is not None else get_engine(), override_ids)
+    elapsed = time.perf_counter() - tick
+    CHECKPOINT_RESTORE_SECONDS.set(elapsed)
+    logging.info(
+        f"restored {len(live_books)} live books from {path} in {elapsed * 1e3:.1f}ms. {rows_used} rows replayed"
+    )
+    return live_books
+
+
+async def checkpoint_periodically(
+    live_books, path, db_executor, writer=None, engine=None, interval_seconds=CHECKPOINT_INTERVAL_SECONDS
+):
+    """Writes a checkpoint every `interval_seconds` on the DB thread, where the books are updated
+    (see write_checkpoint for `writer` and `engine`).
+    a failed checkpoint is logged and retried on the next tick, the feeds keep running"""
+
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await loop.run_in_executor(db_executor, write_checkpoint, live_books, path, writer, engine)
+        except Exception:
+            logging.exception(f"could not write the live books checkpoint {path}")
@@ -1,19 +1,16 @@
 import json
-import time
-from utils import to_external_pair, to_internal_pair
-import dateutil.parser
+import re
+from utils import to_external_pair
+from instruments import REGISTRY
+from timestamps import iso8601_to_ns, ns_to_datetime, epoch_ns_columns
 import logging
-from config import (
-    WEBSOCKET_URLS,
-    EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT,
-    COMMIT_EVERY_X_SECONDS,
-    COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT,
-)
-from websockets import connect
-from datetime import datetime
-from models import OrderbookSnapshot, OrderbookLevelOverride, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from config import WEBSOCKET_URLS, FAST_DECODE
+from fast_decode import json_loads, field_re, string_field
+from models import OrderbookSnapshot, OrderbookLevelOverride
+from level_codec import level_columns
+from sinks import make_sink
+from writer import BatchedWriter
+from pipeline import FeedPipeline
 
 
 # REMOVE
@@ -24,15 +21,6 @@ ssl_context = ssl.create_default_context()
 ssl_context.load_verify_locations(certifi.where())
 
 
-sqlite_filepath = "market_data.sqlite"
-engine = create_engine(f"sqlite:///{sqlite_filepath}")
-Session = sessionmaker()
-Session.configure(bind=engine)
-session = Session()
-
-Base.metadata.create_all(engine)
-
-
 def classify_coinbase_ws_message(ws_message):
     if ws_message["type"] == "error":
         msg = f"{ws_message['error']} - {ws_message['message']}"
@@ -47,26 +35,28 @@ def classify_coinbase_ws_message(ws_message):
     elif ws_message["type"] == "snapshot":
         msg = f"received snapshot message for {ws_message['product_id']}"
         logging.info(msg)
-        internal_pair = to_internal_pair(ws_message["product_id"], "coinbase")
-        external_time = dateutil.parser.isoparse(ws_message["time"])
+        instrument = REGISTRY.from_external("coinbase", ws_message["product_id"])
+        external_time_ns = iso8601_to_ns(ws_message["time"])
         processed_msg = {
-            "external_time": external_time,
+            "external_time": ns_to_datetime(external_time_ns),
+            "external_time_ns": external_time_ns,
             "type": ws_message["type"],
-            "internal_pair": internal_pair,
+            "instrument": instrument,
+            "internal_pair": instrument.internal_pair,
             "pair": ws_message["product_id"],
             "asks": ws_message["asks"],
             "bids": ws_message["bids"],
         }
         return processed_msg
     elif ws_message["type"] == "l2update":
-        msg = f"received l2update message for {ws_message['product_id']}"
-        external_time = dateutil.parser.isoparse(ws_message["time"])
-
-        # logging.debug(msg)
+        external_time_ns = iso8601_to_ns(ws_message["time"])
+        instrument = REGISTRY.from_external("coinbase", ws_message["product_id"])
         return {
-            "external_time": external_time,
+            "external_time": ns_to_datetime(external_time_ns),
+            "external_time_ns": external_time_ns,
             "type": ws_message["type"],
-            "internal_pair": to_internal_pair(ws_message["product_id"], "coinbase"),
+            "instrument": instrument,
+            "internal_pair": instrument.internal_pair,
             "pair": ws_message["product_id"],
             "changes": ws_message["changes"],
         }
@@ -76,7 +66,107 @@ def classify_coinbase_ws_message(ws_message):
         return {"external_time": None, "type": "unknown",'message_payload':ws_message}
 
 
-async def coinbase_orderbook_download(pairs_internal):
+_TYPE_RE = field_re("type")
+_PRODUCT_ID_RE = field_re("product_id")
+_TIME_RE = field_re("time")
+_CHANGE_RE = re.compile(r'\[\s*"(buy|sell)"\s*,\s*("([^"]*)"\s*,\s*"([^"]*)")\s*\]')
+
+
+def fast_classify_coinbase_frame(frame):
+    """Fast decode path for l2update frames. the level arrays are never parsed:
+    each change is sliced out of the frame without its side and re-joined per side, its price and
+    size strings kept as the parsed overrides. any other message type goes through
+    `classify_coinbase_ws_message`"""
+
+    if string_field(frame, _TYPE_RE) != "l2update":
+        return classify_coinbase_ws_message(json_loads(frame))
+
+    product_id = string_field(frame, _PRODUCT_ID_RE)
+    instrument = REGISTRY.from_external("coinbase", product_id)
+    bids = []
+    asks = []
+    bids_overrides = []
+    asks_overrides = []
+    for side, level, price, size in _CHANGE_RE.findall(frame, frame.find('"changes"')):
+        if side == "buy":
+            bids.append(level)
+            bids_overrides.append([price, size])
+        else:
+            asks.append(level)
+            asks_overrides.append([price, size])
+    external_time_ns = iso8601_to_ns(string_field(frame, _TIME_RE))
+    return {
+        "external_time": ns_to_datetime(external_time_ns),
+        "external_time_ns": external_time_ns,
+        "type": "l2update",
+        "instrument": instrument,
+        "internal_pair": instrument.internal_pair,
+        "pair": product_id,
+        "bids_overrides_raw": f"[[{'],['.join(bids)}]]" if bids else "[]",
+        "asks_overrides_raw": f"[[{'],['.join(asks)}]]" if asks else "[]",
+        "bids_overrides": bids_overrides,
+        "asks_overrides": asks_overrides,
+    }
+
+
+def persist_coinbase_message(msg_classified, received_at, writer, orderbook_snapshot_ids):
+    """Turns a classified message into rows for the writer. runs on the DB thread of the pipeline"""
+
+    if msg_classified["type"] == "snapshot":
+        instrument = msg_classified["instrument"]
+        base_ccy, counter_ccy = instrument.base, instrument.counter
+        external_time = msg_classified["external_time"]
+        orderbook_snapshot_ids[instrument.internal_pair] = writer.insert_snapshot(
+            {
+                "external_time": external_time,
+                "received_at": received_at,
+                **epoch_ns_columns(msg_classified),
+                "base": base_ccy,
+                "counter": counter_ccy,
+                "provider": "coinbase",
+                "levels": -1,
+                **level_columns(
+                    OrderbookSnapshot, json.dumps(msg_classified["bids"]), json.dumps(msg_classified["asks"])
+                ),
+            },
+        )
+    elif msg_classified["type"] == "l2update":
+        instrument = msg_classified["instrument"]
+        base_ccy, counter_ccy = instrument.base, instrument.counter
+        external_time = msg_classified["external_time"]
+        if "bids_overrides_raw" in msg_classified:
+            bids_overrides = msg_classified["bids_overrides_raw"]
+            asks_overrides = msg_classified["asks_overrides_raw"]
+            levels = msg_classified["bids_overrides"], msg_classified["asks_overrides"]
+        else:
+            levels = (
+                [i[1:] for i in msg_classified["changes"] if i[0] == "buy"],
+                [i[1:] for i in msg_classified["changes"] if i[0] == "sell"],
+            )
+            bids_overrides, asks_overrides = json.dumps(levels[0]), json.dumps(levels[1])
+
+        writer.add(
+            OrderbookLevelOverride,
+            {
+                "orderbook_snapshot_id": orderbook_snapshot_ids.get(instrument.internal_pair),
+                "external_time": external_time,
+                "received_at": received_at,
+                **epoch_ns_columns(msg_classified),
+                "base": base_ccy,
+                "counter": counter_ccy,
+                "provider": "coinbase",
+                **level_columns(OrderbookLevelOverride, bids_overrides, asks_overrides, levels=levels),
+            },
+        )
+    else:
+        logging.warning(f"received unclassified message: {msg_classified}")
+
+
+async def coinbase_orderbook_download(pairs_internal, writer=None, db_executor=None, live_books=None):
+    """Downloads the books of `pairs_internal` until the feed fails.
+    `writer`/`db_executor`/`live_books` are shared by the supervisor. when omitted the feed gets its
+    own writer and keeps no live books"""
+
     subscribe_message = {
         "type": "subscribe",
         "product_ids": [
@@ -85,105 +175,18 @@ async def coinbase_orderbook_download(pairs_internal):
         "channels": ["level2_batch"],
     }
 
-    url = WEBSOCKET_URLS["coinbase"]
-    message_counter = 0
-    ws = await connect(url, ssl=ssl_context)
-    await ws.send(json.dumps(subscribe_message))
-    last_commit_time = datetime.now()
-    orderbook_snapshot_ids = {}
-    commit_exceptions_in_row_count = 0
-    websocket_closed_times = 0
-    commit_exceptions_total_count = 0
-    expections_in_receipt_count = 0
-    exceptions_in_reconnection_in_row = 0
-    while True:
-        try:
-            if not ws.open:
-                websocket_closed_times += 1
-                logging.warning("Websocket NOT connected. Trying to reconnect.")
-                ws = await connect(url, ssl=ssl_context)
-                await ws.send(json.dumps(subscribe_message))
-            data = await ws.recv()
-        except Exception as e:
-            expections_in_receipt_count += 1
-            try:
-                logging.warning(f"got exception in receipt. \n{e}\n. trying to reconnect...")
-                ws = await connect(url, ssl=ssl_context)
-                await ws.send(json.dumps(subscribe_message))
-                logging.info(f"Reconnected")
-                exceptions_in_reconnection_in_row = 0
-            except Exception as e2:
-                exceptions_in_reconnection_in_row += 1
-                if exceptions_in_reconnection_in_row < EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT:
-                    logging.warning(f"got exception in reconnection. \n{e2}\n. continuing")
-                    time.sleep(3)
-                    continue
-                else:
-                    raise ValueError(
-                        f"too many exceptioins in reconnection. {exceptions_in_reconnection_in_row}/{EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT}"
-                    )
-        received_at = datetime.now()
-        if message_counter % 10_000 == 0:
-            logging.info(
-                f"now: {received_at.strftime('%Y-%m-%d %H:%M:%S')}. last commit: {last_commit_time.strftime('%Y-%m-%d %H:%M:%S')}. # msg: {message_counter}. #closed socket: {websocket_closed_times}. #commit exep: {commit_exceptions_total_count}. #receipt exep: {expections_in_receipt_count}"
-            )
-        message_counter += 1
-
-        json_data = json.loads(data)
-        json_data["time_utc"] = time.time() * 1000
-        msg_classified = classify_coinbase_ws_message(json_data)
-        logging.info(msg_classified)
-        should_commit_to_db = (
-            (datetime.now() - last_commit_time).seconds
-        ) >= COMMIT_EVERY_X_SECONDS
-
-        if msg_classified["type"] == "snapshot":
-            base_ccy, counter_ccy = msg_classified["internal_pair"].split("-")
-            external_time = msg_classified["external_time"]
-            current_orderbook_snapshot = OrderbookSnapshot(
-                external_time=external_time,
-                received_at=received_at,
-                base=base_ccy,
-                counter=counter_ccy,
-                provider="coinbase",
-                levels=-1,
-                bids=json.dumps(msg_classified["bids"]),
-                asks=json.dumps(msg_classified["asks"]),
-            )
-            session.add(current_orderbook_snapshot)
-            session.commit()
-            orderbook_snapshot_ids[f"{base_ccy}-{counter_ccy}"] = current_orderbook_snapshot.id
-        elif msg_classified["type"] == "l2update":
-            base_ccy, counter_ccy = msg_classified["internal_pair"].split("-")
-            external_time = msg_classified["external_time"]
-            bids_overrides = json.dumps([i[1:] for i in msg_classified["changes"] if i[0] == "buy"])
-            asks_overrides = json.dumps([i[1:] for i in msg_classified["changes"] if i[0] == "sell"])
-
-            current_orderbook_update = OrderbookLevelOverride(
-                orderbook_snapshot_id=orderbook_snapshot_ids.get(f"{base_ccy}-{counter_ccy}"),
-                external_time=external_time,
-                received_at=received_at,
-                base=base_ccy,
-                counter=counter_ccy,
-                provider="coinbase",
-                bids_overrides=bids_overrides,
-                asks_overrides=asks_overrides,
-            )
-            session.add(current_orderbook_update)
-            if should_commit_to_db:
-                try:
-                    session.commit()
-                    last_commit_time = datetime.now()
-                    commit_exceptions_in_row_count = 0
-                except Exception as e:
-                    commit_exceptions_total_count += 1
-                    commit_exceptions_in_row_count += 1
-                    logging.warning(
-                        f"exception while committing to DB. {commit_exceptions_in_row_count} in a row: \n{e}\n"
-                    )
-                    if commit_exceptions_in_row_count > COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT:
-                        raise ValueError(
-                            f"Too many commit exceptions in a row. crashing. {commit_exceptions_in_row_count}/{COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT}"
-                        )
-        else:
-            logging.warning(f"received unclassified message: {msg_classified}")
+    if writer is None:
+        writer = BatchedWriter(make_sink())
+    pipeline = FeedPipeline(
+        provider="coinbase",
+        url=WEBSOCKET_URLS["coinbase"],
+        subscribe_messages=[subscribe_message],
+        classify=classify_coinbase_ws_message,
+        persist=persist_coinbase_message,
+        writer=writer,
+        decode=fast_classify_coinbase_frame if FAST_DECODE else None,
+        ssl=ssl_context,
+        db_executor=db_executor,
+        live_books=live_books,
+    )
+    await pipeline.run()
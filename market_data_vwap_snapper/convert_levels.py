@@ -0,0 +1,102 @@
+"""Converts the JSON level columns of existing rows to packed level arrays.
+
+fills `levels_packed`/`overrides_packed` of rows that only have JSON levels, and optionally appends
+the packed arrays to per table/instrument segment files. every converted row is decoded back and
+compared with the JSON values, a mismatch raises ValueError and nothing of that batch is written.
+
+run from this directory: python convert_levels.py [--database-url URL] [--segment-dir DIR]
+    [--batch-size 10000] [--drop-json]
+"""
+import argparse
+import logging
+import os
+
+from config import DATABASE_URL
+from database import get_engine
+from fast_decode import json_loads
+from level_codec import LEVEL_COLUMNS, LevelSegmentWriter, encode_levels, same_levels, segment_path
+from models import OrderbookSnapshot, OrderbookLevelOverride
+from sqlalchemy import bindparam, select, update
+
+
+def convert_table(engine, model, batch_size=10_000, segment_dir=None, drop_json=False):
+    """Packs the JSON levels of every `model` row without a packed array. returns the rows converted"""
+
+    table = model.__table__
+    bids_column, asks_column, packed_column = LEVEL_COLUMNS[model]
+    segment_writers = {}  # segment path -> LevelSegmentWriter
+    has_snapshot_id = "orderbook_snapshot_id" in table.c
+
+    columns = [table.c.id, table.c.provider, table.c.base, table.c.counter]
+    columns += [table.c.received_at_ns, table.c.external_time_ns, table.c[bids_column], table.c[asks_column]]
+    if has_snapshot_id:
+        columns.append(table.c.orderbook_snapshot_id)
+    query = (
+        select(*columns)
+        .where(table.c[packed_column].is_(None), table.c[bids_column].is_not(None))
+        .order_by(table.c.id)
+        .limit(batch_size)
+    )
+    values = {packed_column: bindparam("packed")}
+    if drop_json:
+        values.update({bids_column: None, asks_column: None})
+    statement = update(table).where(table.c.id == bindparam("row_id")).values(values)
+
+    converted_count = 0
+    last_id = 0
+    try:
+        while True:
+            with engine.connect() as conn:
+                rows = conn.execute(query.where(table.c.id > last_id)).all()
+            if not rows:
+                break
+
+            params = []
+            for row in rows:
+                bids, asks = json_loads(row._mapping[bids_column]), json_loads(row._mapping[asks_column])
+                packed = encode_levels(bids, asks)
+                if not same_levels(bids, asks, packed):
+                    raise ValueError(f"{table.name} id {row.id}: packed levels differ from the JSON ones")
+                params.append({"row_id": row.id, "packed": packed})
+                if segment_dir is not None:
+                    path = segment_path(segment_dir, table.name, row.provider, row.base, row.counter)
+                    if path not in segment_writers:
+                        segment_writers[path] = LevelSegmentWriter(path)
+                    segment_writers[path].append(
+                        row.id,
+                        packed,
+                        orderbook_snapshot_id=row.orderbook_snapshot_id if has_snapshot_id else None,
+                        received_at_ns=row.received_at_ns,
+                        external_time_ns=row.external_time_ns,
+                    )
+
+            with engine.begin() as conn:
+                conn.execute(statement, params)
+            converted_count += len(rows)
+            last_id = rows[-1].id
+            logging.info(f"{table.name}: {converted_count} rows converted. last id {last_id}")
+    finally:
+        for segment_writer in segment_writers.values():
+            segment_writer.close()
+    return converted_count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    parser.add_argument("--segment-dir", default=None, help="also append packed arrays to segment files here")
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--drop-json", action="store_true", help="null the JSON columns of converted rows")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.segment_dir is not None:
+        os.makedirs(args.segment_dir, exist_ok=True)
+    engine = get_engine(args.database_url)
+    for model in (OrderbookSnapshot, OrderbookLevelOverride):
+        converted_count = convert_table(engine, model, args.batch_size, args.segment_dir, args.drop_json)
+        print(f"{model.__tablename__}: {converted_count} rows converted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+from config import DATABASE_URL, SQLITE_TUNING, SQLITE_PRAGMAS
+from models import Base, OrderbookSnapshot, LatestOrderbookSnapshot
+from sqlalchemy import create_engine, event, func, insert, inspect, make_url, or_, select, text, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+_ENGINES = {}
+_READONLY_ENGINES = {}
+_UPSERT_INSERTS = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}
+LATEST_SNAPSHOT_COLUMNS = ("orderbook_snapshot_id", "external_time", "external_time_ns", "received_at")
+
+
+def get_engine(database_url=DATABASE_URL, sqlite_tuning=SQLITE_TUNING):
+    """Engine shared by everything running in the process, so all feeds go through one pool.
+    tables, indexes and the latest snapshot table are created / filled on first use.
+    `sqlite_tuning` applies SQLITE_PRAGMAS to every connection of a sqlite engine"""
+
+    engine = _ENGINES.get(database_url)
+    if engine is None:
+        engine = _ENGINES[database_url] = create_engine(database_url)
+        if sqlite_tuning and engine.dialect.name == "sqlite":
+            apply_sqlite_pragmas(engine)
+        Base.metadata.create_all(engine)
+        add_missing_columns(engine)
+        add_missing_indexes(engine)
+        backfill_latest_snapshots(engine)
+    return engine
+
+
+def get_readonly_engine(database_url=DATABASE_URL):
+    """Engine for a process that only reads (e.g. replay workers). sqlite files are opened read-only,
+    postgresql transactions are READ ONLY. nothing is created: the database must exist"""
+
+    engine = _READONLY_ENGINES.get(database_url)
+    if engine is None:
+        url = make_url(database_url)
+        if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+            engine = create_engine(f"sqlite:///file:{url.database}?mode=ro&uri=true")
+        elif url.get_backend_name() == "postgresql":
+            engine = create_engine(url, execution_options={"postgresql_readonly": True})
+        else:
+            engine = create_engine(url)
+        _READONLY_ENGINES[database_url] = engine
+    return engine
+
+
+def apply_sqlite_pragmas(engine, pragmas=SQLITE_PRAGMAS):
+    """Runs `PRAGMA name = value` for every pragma on each new connection of `engine`"""
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def add_missing_columns(engine):
+    """create_all does not touch existing tables. columns added to the models later (all nullable)
+    are added to databases created before them"""
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def add_missing_indexes(engine):
+    """Same as add_missing_columns for the indexes declared in the models"""
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def upsert_latest_snapshot(conn, orderbook_snapshot_id, snapshot_row):
+    """Points the latest_orderbook_snapshots row of the instrument of `snapshot_row` to
+    `orderbook_snapshot_id`, unless the row already points to a snapshot with a later external_time"""
+
+    table = LatestOrderbookSnapshot.__table__
+    values = {
+        "provider": snapshot_row["provider"],
+        "base": snapshot_row["base"],
+        "counter": snapshot_row["counter"],
+        "orderbook_snapshot_id": orderbook_snapshot_id,
+        "external_time": snapshot_row.get("external_time"),
+        "external_time_ns": snapshot_row.get("external_time_ns"),
+        "received_at": snapshot_row.get("received_at"),
+    }
+    dialect_insert = _UPSERT_INSERTS.get(conn.dialect.name)
+    if dialect_insert is not None:
+        statement = dialect_insert(table).values(values)
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.provider, table.c.base, table.c.counter],
+            set_={column: excluded[column] for column in LATEST_SNAPSHOT_COLUMNS},
+            where=or_(
+                table.c.external_time.is_(None),
+                excluded.external_time.is_(None),
+                table.c.external_time <= excluded.external_time,
+            ),
+        )
+        conn.execute(statement)
+        return
+
+    # no native upsert. the insert only fails if another writer created the row in between
+    instrument_filter = (
+        (table.c.provider == values["provider"])
+        & (table.c.base == values["base"])
+        & (table.c.counter == values["counter"])
+    )
+    current = conn.execute(select(table.c.external_time).where(instrument_filter)).first()
+    if current is None:
+        conn.execute(insert(table).values(values))
+        return
+    current_time, new_time = current.external_time, values["external_time"]
+    if current_time is None or new_time is None or current_time <= new_time:
+        latest_values = {column: values[column] for column in LATEST_SNAPSHOT_COLUMNS}
+        conn.execute(update(table).where(instrument_filter).values(latest_values))
+
+
+def backfill_latest_snapshots(engine):
+    """Fills latest_orderbook_snapshots from orderbook_snapshots if it is empty (new table on an
+    existing database). uses the (provider, base, counter, external_time) index"""
+
+    latest_table = LatestOrderbookSnapshot.__table__
+    snapshots_table = OrderbookSnapshot.__table__
+    with engine.begin() as conn:
+        if conn.execute(select(latest_table.c.provider).limit(1)).first() is not None:
+            return
+        ranked_snapshots = select(
+            snapshots_table.c.provider,
+            snapshots_table.c.base,
+            snapshots_table.c.counter,
+            snapshots_table.c.id.label("orderbook_snapshot_id"),
+            snapshots_table.c.external_time,
+            snapshots_table.c.external_time_ns,
+            snapshots_table.c.received_at,
+            func.row_number()
+            .over(
+                partition_by=(snapshots_table.c.provider, snapshots_table.c.base, snapshots_table.c.counter),
+                order_by=(snapshots_table.c.external_time.desc().nulls_last(), snapshots_table.c.id.desc()),
+            )
+            .label("rnum"),
+        ).subquery()
+        columns = ["provider", "base", "counter", *LATEST_SNAPSHOT_COLUMNS]
+        conn.execute(
+            insert(latest_table).from_select(
+                columns,
+                select(*(ranked_snapshots.c[column] for column in columns)).where(ranked_snapshots.c.rnum == 1),
+            )
+        )
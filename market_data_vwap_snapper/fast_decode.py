@@ -0,0 +1,74 @@
+"""Helpers for the fast decode path of the venue adapters.
+
+the fast path never runs a JSON parser on the level arrays: adapters locate the few scalar fields
+they need and slice the level arrays straight out of the websocket frame, so the stored
+`bids_overrides`/`asks_overrides` strings are the venue's own JSON text. the [price, size] strings
+of the levels come out of the same regex matches, for the live books and the packed level columns,
+so nothing parses the levels again on the DB thread.
+"""
+import json
+import re
+
+try:
+    import orjson
+
+    JSON_BACKEND = "orjson"
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    JSON_BACKEND = "json"
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+
+EMPTY_LEVELS = "[]"
+_PRICE_SIZE_RE = re.compile(r'\[\s*"([^"]*)"\s*,\s*"([^"]*)"\s*\]')
+
+
+def string_field(frame, compiled_field_re):
+    """Value of a string field matched by a `"name":"(value)"` compiled regex. None if missing"""
+
+    match = compiled_field_re.search(frame)
+    return match.group(1) if match else None
+
+
+def field_re(name):
+    return re.compile(r'"%s"\s*:\s*"([^"]*)"' % name)
+
+
+def levels_slice(frame, key, start=0):
+    """Raw text of a `"key":[[...],[...]]` array of level arrays, found from `start`.
+    level arrays never nest deeper than two, so the array ends at the first ']]' after its start.
+    returns None if the key is not in the frame"""
+
+    key_idx = frame.find(f'"{key}":', start)
+    if key_idx == -1:
+        return None
+    array_start = frame.find("[", key_idx + len(key) + 3)
+    if frame.startswith("[]", array_start):
+        return EMPTY_LEVELS
+    array_end = frame.find("]]", array_start)
+    if array_end == -1:
+        raise ValueError(f"unterminated levels array for '{key}' in frame: {frame[:200]}")
+    return frame[array_start : array_end + 2]
+
+
+def price_size_levels(raw_levels):
+    """[[price, size], ...] strings of a raw array of ["price","size"] level arrays"""
+
+    return [[price, size] for price, size in _PRICE_SIZE_RE.findall(raw_levels)]
+
+
+def concat_levels(first, second):
+    """Concatenates two raw level arrays without parsing them"""
+
+    if first == EMPTY_LEVELS:
+        return second
+    if second == EMPTY_LEVELS:
+        return first
+    return f"{first[:-1]},{second[1:]}"
@@ -0,0 +1,189 @@
+"""Instrument registry built once at startup.
+
+every venue symbol / channel name a feed can receive maps to an `Instrument` through a single dict
+lookup, so classifiers never split pair strings, decode assets or read parameter files per message.
+
+an instrument also carries the number of price and size decimals of the venue (tick and lot size),
+from bitstamp_trading_pairs.json (counter_decimals / base_decimals) and params/venue_instruments.json
+for the other venues, which is the scale of its fixed-point prices and sizes (see ticks.py). an
+instrument missing from the metadata is logged and gets DEFAULT_PRICE_DECIMALS / DEFAULT_SIZE_DECIMALS
+(`listed` False): its books take the price decimals of their first snapshot (see live_books.py).
+"""
+import logging
+import sys
+
+from config import DEFAULT_PRICE_DECIMALS, DEFAULT_SIZE_DECIMALS, SUPERVISOR_VENUE_PAIRS
+from ticks import ticks_to_str, to_ticks
+from utils import local_param, to_external_pair, to_internal_pair, decoders
+
+BITSTAMP_CHANNEL_PREFIXES = ("order_book_", "diff_order_book_", "live_orders_")
+
+
+class Instrument:
+    """One pair on one venue. all strings are interned"""
+
+    __slots__ = (
+        "provider",
+        "external_symbol",
+        "internal_pair",
+        "base",
+        "counter",
+        "price_decimals",
+        "size_decimals",
+        "listed",
+    )
+
+    def __init__(
+        self,
+        provider,
+        external_symbol,
+        internal_pair,
+        price_decimals=DEFAULT_PRICE_DECIMALS,
+        size_decimals=DEFAULT_SIZE_DECIMALS,
+        listed=True,
+    ):
+        base, counter = internal_pair.split("-")
+        self.provider = sys.intern(provider)
+        self.external_symbol = sys.intern(external_symbol)
+        self.internal_pair = sys.intern(internal_pair)
+        self.base = sys.intern(base)
+        self.counter = sys.intern(counter)
+        self.price_decimals = price_decimals
+        self.size_decimals = size_decimals
+        self.listed = listed  # decimals from the venue metadata, not the defaults
+
+    def __repr__(self):
+        return f"Instrument({self.provider}, {self.external_symbol} -> {self.internal_pair})"
+
+    @property
+    def tick_size(self):
+        return 10.0**-self.price_decimals
+
+    @property
+    def lot_size(self):
+        return 10.0**-self.size_decimals
+
+    def price_to_ticks(self, price):
+        """venue price string -> int ticks. ValueError if it is finer than the tick size"""
+
+        return to_ticks(price, self.price_decimals)
+
+    def size_to_lots(self, size):
+        return to_ticks(size, self.size_decimals)
+
+    def ticks_to_price(self, ticks):
+        return ticks_to_str(ticks, self.price_decimals)
+
+    def lots_to_size(self, lots):
+        return ticks_to_str(lots, self.size_decimals)
+
+
+class InstrumentRegistry:
+    """external symbol <-> internal pair for every venue, plus bitstamp channel name -> pair.
+    lookups of symbols not registered at startup fall back to the `utils` conversions once and are
+    memoised, so every later message for them is a dict hit as well"""
+
+    def __init__(self, specs=None):
+        # provider -> {internal pair: (price decimals, size decimals)}
+        self._specs = {} if specs is None else specs
+        self._by_external = {}  # provider -> {external symbol: Instrument}
+        self._by_internal = {}  # provider -> {internal pair: Instrument}
+        self._by_channel = {}  # bitstamp channel name -> Instrument
+
+    def register(self, provider, internal_pair, external_symbol=None):
+        if external_symbol is None:
+            external_symbol = to_external_pair(internal_pair, provider)
+        spec = self._specs.get(provider, {}).get(internal_pair)
+        if spec is None:
+            if internal_pair not in self._by_internal.get(provider, {}):
+                logging.warning(
+                    f"{provider} {internal_pair} not in the venue metadata (params/venue_instruments.json). "
+                    f"{DEFAULT_PRICE_DECIMALS} price decimals until its first snapshot, "
+                    f"{DEFAULT_SIZE_DECIMALS} size decimals"
+                )
+            instrument = Instrument(provider, external_symbol, internal_pair, listed=False)
+        else:
+            instrument = Instrument(provider, external_symbol, internal_pair, *spec)
+        self._by_external.setdefault(instrument.provider, {})[instrument.external_symbol] = instrument
+        self._by_internal.setdefault(instrument.provider, {}).setdefault(
+            instrument.internal_pair, instrument
+        )
+        if provider == "bitstamp":
+            for prefix in BITSTAMP_CHANNEL_PREFIXES:
+                self._by_channel[sys.intern(f"{prefix}{external_symbol}")] = instrument
+        return instrument
+
+    def from_external(self, provider, external_symbol):
+        try:
+            return self._by_external[provider][external_symbol]
+        except KeyError:
+            logging.debug(f"{provider} symbol {external_symbol} not in the instrument registry. adding it")
+            return self.register(provider, to_internal_pair(external_symbol, provider), external_symbol)
+
+    def from_internal(self, provider, internal_pair):
+        try:
+            return self._by_internal[provider][internal_pair]
+        except KeyError:
+            return self.register(provider, internal_pair)
+
+    def from_channel(self, channel):
+        """Instrument of a bitstamp channel name, e.g. 'diff_order_book_btcusd'"""
+
+        try:
+            return self._by_channel[channel]
+        except KeyError:
+            for prefix in BITSTAMP_CHANNEL_PREFIXES:
+                if channel.startswith(prefix):
+                    return self.from_external("bitstamp", channel[len(prefix) :])
+            raise ValueError(f"Non implemented error. unknown bitstamp channel {channel}")
+
+    def instruments(self, provider):
+        return list(self._by_internal.get(provider, {}).values())
+
+
+def _venue_aliases(provider, asset):
+    """Venue spellings of an internal asset, e.g. kraken BTC -> {'BTC', 'XBT'}"""
+
+    return {asset} | {
+        external for external, internal in decoders.get(provider, {}).items() if internal == asset
+    }
+
+
+def instrument_specs():
+    """provider -> {internal pair: (price decimals, size decimals)} of the venue metadata"""
+
+    specs = {
+        provider: {
+            pair_internal: (spec["price_decimals"], spec["size_decimals"])
+            for pair_internal, spec in pairs.items()
+        }
+        for provider, pairs in local_param("venue_instruments").items()
+    }
+    specs["bitstamp"] = {
+        to_internal_pair(pair_info["url_symbol"], "bitstamp"): (
+            pair_info["counter_decimals"],
+            pair_info["base_decimals"],
+        )
+        for pair_info in local_param("bitstamp_trading_pairs")
+    }
+    return specs
+
+
+def build_registry(venue_pairs=SUPERVISOR_VENUE_PAIRS):
+    registry = InstrumentRegistry(instrument_specs())
+    for pair_info in local_param("bitstamp_trading_pairs"):
+        registry.register("bitstamp", to_internal_pair(pair_info["url_symbol"], "bitstamp"), pair_info["url_symbol"])
+
+    for provider, pairs_internal in venue_pairs.items():
+        for pair_internal in pairs_internal:
+            registry.register(provider, pair_internal)
+            if provider == "kraken":
+                # kraken answers with its own asset codes (XBT/USD) whatever we subscribed with
+                base, counter = pair_internal.split("-")
+                for base_alias in _venue_aliases(provider, base):
+                    for counter_alias in _venue_aliases(provider, counter):
+                        registry.register(provider, pair_internal, f"{base_alias}/{counter_alias}")
+    return registry
+
+
+REGISTRY = build_registry()
@@ -1,18 +1,16 @@
 import json
-import time
-from utils import to_external_pair, to_internal_pair
+import re
+from utils import to_external_pair
+from instruments import REGISTRY
 import logging
-from config import (
-    WEBSOCKET_URLS,
-    EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT,
-    COMMIT_EVERY_X_SECONDS,
-    COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT,
-)
-from websockets import connect
-from datetime import datetime
-from models import OrderbookSnapshot, OrderbookLevelOverride, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from config import WEBSOCKET_URLS, FAST_DECODE
+from fast_decode import json_loads, levels_slice
+from timestamps import seconds_str_to_ns, ns_to_datetime, epoch_ns_columns
+from models import OrderbookSnapshot, OrderbookLevelOverride
+from level_codec import level_columns
+from sinks import make_sink
+from writer import BatchedWriter
+from pipeline import FeedPipeline
 
 
 # REMOVE
@@ -23,15 +21,6 @@ ssl_context = ssl.create_default_context()
 ssl_context.load_verify_locations(certifi.where())
 
 
-sqlite_filepath = "market_data.sqlite"
-engine = create_engine(f"sqlite:///{sqlite_filepath}")
-Session = sessionmaker()
-Session.configure(bind=engine)
-session = Session()
-
-Base.metadata.create_all(engine)
-
-
 def classify_kraken_ws_message(ws_message):
     if type(ws_message) == dict:
         if ws_message["event"] == "systemStatus":
@@ -41,7 +30,6 @@ def classify_kraken_ws_message(ws_message):
             logging.info(ws_message)
             return {"external_time": None, "type": ws_message["event"]}
         elif ws_message["event"] == "heartbeat":
-            logging.info(ws_message)
             return {"external_time": None, "type": ws_message["event"]}
         else:
             msg = f"received unhandled message type {ws_message['event']}"
@@ -62,46 +50,39 @@ def classify_kraken_ws_message(ws_message):
             msg = f"received book snapshot message for {ws_message[-2]} {ws_message[-1]}"
             logging.info(msg)
             external_pair = ws_message[-1]
-            internal_pair = to_internal_pair(external_pair, "kraken")
+            instrument = REGISTRY.from_external("kraken", external_pair)
             asks_times = [i[2] for i in ws_message[1]['as']]
             asks = [i[:2] for i in ws_message[1]['as']]
             bids_times = [i[2] for i in ws_message[1]['bs']]
             bids = [i[:2] for i in ws_message[1]['bs']]
-            book_max_timestamp_sec = max([float(i) for i in bids_times + asks_times])
-            external_time = datetime.utcfromtimestamp(
-                float(book_max_timestamp_sec)
-            )
+            external_time_ns = max([seconds_str_to_ns(i) for i in bids_times + asks_times])
             processed_msg = {
-                "external_time": external_time,
+                "external_time": ns_to_datetime(external_time_ns),
+                "external_time_ns": external_time_ns,
                 "type": "snapshot",
-                "internal_pair": internal_pair,
+                "instrument": instrument,
+                "internal_pair": instrument.internal_pair,
                 "pair": external_pair,
                 "asks": asks,
                 "bids": bids,
             }
             return processed_msg            
         elif ((ws_message[-2].startswith('book')) and (is_book_update)):
-            msg = f"received update [diff] message for {ws_message[-2]} {ws_message[-1]}"
-            logging.debug(msg)
             merged_dicts = {k: v for d in all_dicts for k, v in d.items()}
-            # logging.info(merged_dicts)
-            if len(all_dicts) ==2:
-                logging.info(f"double dict info message: {all_dicts}")
             external_pair = ws_message[-1]
-            internal_pair = to_internal_pair(external_pair, "kraken")
+            instrument = REGISTRY.from_external("kraken", external_pair)
             asks_times = [i[2] for i in merged_dicts.get('a',[])]
             asks = [i[:2] for i in merged_dicts.get('a',[])]
             bids_times = [i[2] for i in merged_dicts.get('b',[])]
             bids = [i[:2] for i in merged_dicts.get('b',[])]
-            book_max_timestamp_sec = max([float(i) for i in bids_times + asks_times])
-            external_time = datetime.utcfromtimestamp(
-                float(book_max_timestamp_sec)
-            )
+            external_time_ns = max([seconds_str_to_ns(i) for i in bids_times + asks_times])
             processed_msg = {
                 'checksum': checksum,
-                "external_time": external_time,
+                "external_time": ns_to_datetime(external_time_ns),
+                "external_time_ns": external_time_ns,
                 "type": "update",
-                "internal_pair": internal_pair,
+                "instrument": instrument,
+                "internal_pair": instrument.internal_pair,
                 "pair": external_pair,
                 "changes": {
                     "bids_overrides": bids,
@@ -116,136 +97,140 @@ def classify_kraken_ws_message(ws_message):
             # return {"external_time": None, "type": "unknown"}
 
 
-async def kraken_orderbook_download(pairs_internal):
-    type_of_sub = "book" 
-    url = WEBSOCKET_URLS["kraken"]
-    message_counter = 0
-    ws = await connect(url, ssl=ssl_context)
+_LEVEL_RE = re.compile(r'\[\s*("([^"]*)"\s*,\s*"([^"]*)")\s*,\s*"([^"]*)"(?:\s*,\s*"r")?\s*\]')
+
+
+def _fast_levels(frame, key):
+    """Raw `["price","volume"]` levels of the `key` array (timestamps dropped), their [price, volume]
+    strings and their timestamps"""
+
+    raw_levels = levels_slice(frame, key)
+    if raw_levels is None:
+        return "[]", [], []
+    levels = _LEVEL_RE.findall(raw_levels)
+    if not levels:
+        return "[]", [], []
+    return (
+        f"[[{'],['.join(level[0] for level in levels)}]]",
+        [[price, volume] for _, price, volume, _ in levels],
+        [level[3] for level in levels],
+    )
+
+
+def fast_classify_kraken_frame(frame):
+    """Fast decode path for book update frames (the ones carrying a checksum).
+    price/volume pairs are sliced out of the frame, only the timestamps are converted.
+    snapshots and events go through `classify_kraken_ws_message`"""
+
+    if not frame.startswith("[") or '"c":' not in frame or '"book-' not in frame:
+        return classify_kraken_ws_message(json_loads(frame))
+
+    pair_end = frame.rindex('"')  # the pair is the last element of the frame
+    external_pair = frame[frame.rindex('"', 0, pair_end) + 1 : pair_end]
+    instrument = REGISTRY.from_external("kraken", external_pair)
+    asks, asks_overrides, asks_times = _fast_levels(frame, "a")
+    bids, bids_overrides, bids_times = _fast_levels(frame, "b")
+    external_time_ns = max(map(seconds_str_to_ns, bids_times + asks_times))
+    return {
+        "external_time": ns_to_datetime(external_time_ns),
+        "external_time_ns": external_time_ns,
+        "type": "update",
+        "instrument": instrument,
+        "internal_pair": instrument.internal_pair,
+        "pair": external_pair,
+        "bids_overrides_raw": bids,
+        "asks_overrides_raw": asks,
+        "bids_overrides": bids_overrides,
+        "asks_overrides": asks_overrides,
+    }
+
 
-    
+def persist_kraken_message(msg_classified, received_at, writer, orderbook_snapshot_ids):
+    """Turns a classified message into rows for the writer. runs on the DB thread of the pipeline"""
+
+    if msg_classified["type"] == "snapshot":
+        instrument = msg_classified["instrument"]
+        base_ccy, counter_ccy = instrument.base, instrument.counter
+        external_time = msg_classified["external_time"]
+        orderbook_snapshot_ids[instrument.internal_pair] = writer.insert_snapshot(
+            {
+                "external_time": external_time,
+                "received_at": received_at,
+                **epoch_ns_columns(msg_classified),
+                "base": base_ccy,
+                "counter": counter_ccy,
+                "provider": "kraken",
+                "levels": -1,
+                **level_columns(
+                    OrderbookSnapshot, json.dumps(msg_classified["bids"]), json.dumps(msg_classified["asks"])
+                ),
+            },
+        )
+        logging.info(f"current_orderbook_snapshot.id: {orderbook_snapshot_ids[instrument.internal_pair]}")
+        logging.info(f"orderbook_snapshot_ids: {orderbook_snapshot_ids}")
+    elif msg_classified["type"] == "update":
+        instrument = msg_classified["instrument"]
+        base_ccy, counter_ccy = instrument.base, instrument.counter
+        external_time = msg_classified["external_time"]
+        if "bids_overrides_raw" in msg_classified:
+            bids_overrides = msg_classified["bids_overrides_raw"]
+            asks_overrides = msg_classified["asks_overrides_raw"]
+            levels = msg_classified["bids_overrides"], msg_classified["asks_overrides"]
+        else:
+            levels = msg_classified["changes"]["bids_overrides"], msg_classified["changes"]["asks_overrides"]
+            bids_overrides, asks_overrides = json.dumps(levels[0]), json.dumps(levels[1])
+
+        writer.add(
+            OrderbookLevelOverride,
+            {
+                "orderbook_snapshot_id": orderbook_snapshot_ids.get(instrument.internal_pair),
+                "external_time": external_time,
+                "received_at": received_at,
+                **epoch_ns_columns(msg_classified),
+                "base": base_ccy,
+                "counter": counter_ccy,
+                "provider": "kraken",
+                **level_columns(OrderbookLevelOverride, bids_overrides, asks_overrides, levels=levels),
+            },
+        )
+
+    elif msg_classified["type"] == "systemStatus":
+        pass
+        # logging.info("systemStatus")
+    elif msg_classified["type"] == "subscriptionStatus":
+        pass
+        # logging.info("subscriptionStatus")
+    elif msg_classified["type"] == "heartbeat":
+        pass
+        # logging.info("heartbeat")
+    else:
+        logging.warning(f"received unclassified message: {msg_classified}")
+
+
+async def kraken_orderbook_download(pairs_internal, writer=None, db_executor=None, live_books=None):
+    """Downloads the books of `pairs_internal` until the feed fails.
+    `writer`/`db_executor`/`live_books` are shared by the supervisor. when omitted the feed gets its
+    own writer and keeps no live books"""
+
+    type_of_sub = "book" 
     subscribe_message = {
         "event": "subscribe",
         "pair" :[to_external_pair(pair, "kraken") for pair in pairs_internal],
         "subscription": {"name": type_of_sub},
     }
-    await ws.send(json.dumps(subscribe_message))
-
-    last_commit_time = datetime.now()
-    orderbook_snapshot_ids = {}
-    commit_exceptions_in_row_count = 0
-    websocket_closed_times = 0
-    commit_exceptions_total_count = 0
-    expections_in_receipt_count = 0
-    exceptions_in_reconnection_in_row = 0
-    while True:
-        try:
-            if not ws.open:
-                websocket_closed_times += 1
-                logging.warning("Websocket NOT connected. Trying to reconnect.")
-                ws = await connect(url, ssl=ssl_context)
-                await ws.send(json.dumps(subscribe_message))
-                # await ws.send(json.dumps(subscribe_message2))
-            data = await ws.recv()
-        except Exception as e:
-            expections_in_receipt_count += 1
-            logging.info(f"exception caught")
-            try:
-                logging.warning(f"got exception in receipt. \n{e}\n. trying to reconnect...")
-                ws = await connect(url, ssl=ssl_context)
-                await ws.send(json.dumps(subscribe_message))
-                logging.info(f"Reconnected")
-                exceptions_in_reconnection_in_row = 0
-            except Exception as e2:
-                exceptions_in_reconnection_in_row += 1
-                if exceptions_in_reconnection_in_row < EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT:
-                    logging.warning(f"got exception in reconnection. \n{e2}\n. continuing")
-                    time.sleep(3)
-                    continue
-                else:
-                    logging.error(
-                        f"too many exceptioins in reconnection. {exceptions_in_reconnection_in_row}/{EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT}"
-                    )
-                    raise ValueError(
-                        f"too many exceptioins in reconnection. {exceptions_in_reconnection_in_row}/{EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT}"
-                    )
-        received_at = datetime.now()
-        if message_counter % 10_000 == 0:
-            logging.info(
-                f"now: {received_at.strftime('%Y-%m-%d %H:%M:%S')}. last commit: {last_commit_time.strftime('%Y-%m-%d %H:%M:%S')}. # msg: {message_counter}. #closed socket: {websocket_closed_times}. #commit exep: {commit_exceptions_total_count}. #receipt exep: {expections_in_receipt_count}"
-            )
-        message_counter += 1
-
-        json_data = json.loads(data)
-
-        # print(f"RAW MESSAGE FOR DEBUGGING {json_data}")
-        # json_data["time_utc"] = time.time() * 1000
-        msg_classified = classify_kraken_ws_message(json_data)
-        should_commit_to_db = (
-            (datetime.now() - last_commit_time).seconds
-        ) > COMMIT_EVERY_X_SECONDS
-
-        if msg_classified["type"] == "snapshot":
-            base_ccy, counter_ccy = msg_classified["internal_pair"].split("-")
-            external_time = msg_classified["external_time"]
-            current_orderbook_snapshot = OrderbookSnapshot(
-                external_time=external_time,
-                received_at=received_at,
-                base=base_ccy,
-                counter=counter_ccy,
-                provider="kraken",
-                levels=-1,
-                bids=json.dumps(msg_classified["bids"]),
-                asks=json.dumps(msg_classified["asks"]),
-            )
-            
-            session.add(current_orderbook_snapshot)
-            session.commit()
-            orderbook_snapshot_ids[f"{base_ccy}-{counter_ccy}"] = current_orderbook_snapshot.id
-            logging.info(f"current_orderbook_snapshot.id: {current_orderbook_snapshot.id}")
-            logging.info(f"orderbook_snapshot_ids: {orderbook_snapshot_ids}")
-        elif msg_classified["type"] == "update":
-            logging.debug(f"update received: {msg_classified['internal_pair']}. 'kraken'")
-            base_ccy, counter_ccy = msg_classified["internal_pair"].split("-")
-            external_time = msg_classified["external_time"]
-            bids_overrides = json.dumps(msg_classified["changes"]["bids_overrides"])
-            asks_overrides = json.dumps(msg_classified["changes"]["asks_overrides"])
-
-            current_orderbook_update = OrderbookLevelOverride(
-                orderbook_snapshot_id=orderbook_snapshot_ids.get(f"{base_ccy}-{counter_ccy}"),
-                external_time=external_time,
-                received_at=received_at,
-                base=base_ccy,
-                counter=counter_ccy,
-                provider="kraken",
-                bids_overrides=bids_overrides,
-                asks_overrides=asks_overrides,
-            )
-            session.add(current_orderbook_update)
-
-            if should_commit_to_db:
-                try:
-                    session.commit()
-                    last_commit_time = datetime.now()
-                    commit_exceptions_in_row_count = 0
-                except Exception as e:
-                    commit_exceptions_total_count += 1
-                    commit_exceptions_in_row_count += 1
-                    logging.warning(
-                        f"exception while committing to DB. {commit_exceptions_in_row_count} in a row: \n{e}\n"
-                    )
-                    if commit_exceptions_in_row_count > COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT:
-                        raise ValueError(
-                            f"Too many commit exceptions in a row. crashing. {commit_exceptions_in_row_count}/{COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT}"
-                        )
-
-        elif msg_classified["type"] == "systemStatus":
-            pass
-            # logging.info("systemStatus")
-        elif msg_classified["type"] == "subscriptionStatus":
-            pass
-            # logging.info("subscriptionStatus")
-        elif msg_classified["type"] == "heartbeat":
-            pass
-            # logging.info("heartbeat")
-        else:
-            logging.warning(f"received unclassified message: {msg_classified}")
+
+    if writer is None:
+        writer = BatchedWriter(make_sink())
+    pipeline = FeedPipeline(
+        provider="kraken",
+        url=WEBSOCKET_URLS["kraken"],
+        subscribe_messages=[subscribe_message],
+        classify=classify_kraken_ws_message,
+        persist=persist_kraken_message,
+        writer=writer,
+        decode=fast_classify_kraken_frame if FAST_DECODE else None,
+        ssl=ssl_context,
+        db_executor=db_executor,
+        live_books=live_books,
+    )
+    await pipeline.run()
@@ -0,0 +1,350 @@
+"""Array-backed L2 price ladder.
+
+each side has its own window of `capacity` price ticks, a flat `array.array` of interleaved
+(price, size) doubles, so updates are plain index writes, and `np.frombuffer` exposes it as an
+(n, 2) array without copying. a level outside the window goes to a per side overflow dict. the window
+of a side is recentred on its best level (in place: it never grows, whatever the spread) whenever
+that level would fall outside it, so both best levels are always in their window and `bid`/`ask`
+are O(1).
+
+the book also keeps the shallowest level changed on each side since the last `take_dirty()` (the
+highest bid / lowest ask tick updated), so a VWAP cache knows whether the levels it used changed,
+and `levels_from` reads the non empty levels from a tick on only as deep as a size needs, past the
+window if it must (see vwap.VwapCache).
+
+no intra-package imports: usable from the feeds (`from l2_book import L2Book`) and from the
+notebooks (`from market_data_vwap_snapper.l2_book import L2Book`).
+"""
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+DEFAULT_CAPACITY = 8_192  # ticks in the window of a side. 81.92 USD at a 0.01 tick
+_SCAN_STEPS = 8  # levels walked in Python before searching the next best level with numpy
+_READ_ROWS = 256  # window rows `levels_from` filters at once, doubled on every read
+
+
+class L2Book:
+    """L2 book on a fixed price grid of `tick_size`.
+    `apply_update(side, size, price)` has the SimpleOrderBook semantics: size 0 removes the level
+    (KeyError if there is none), any other size replaces it. `apply_tick_update` takes the int price
+    ticks of a fixed-point price (see ticks.py) and skips the float -> tick conversion"""
+
+    def __init__(self, tick_size, capacity=DEFAULT_CAPACITY):
+        if tick_size <= 0:
+            raise ValueError(f"tick_size must be positive, got {tick_size}")
+        self.tick_size = tick_size
+        self._inv_tick_size = 1 / tick_size
+        self._capacity = capacity
+        self._bid_origin = self._ask_origin = 0  # tick of row 0 of the window of each side
+        self._rows = np.arange(capacity)
+        self._bids, self._asks = array("d", bytes(16 * capacity)), array("d", bytes(16 * capacity))
+        self._bids_view = np.frombuffer(self._bids, dtype=np.float64).reshape(capacity, 2)
+        self._asks_view = np.frombuffer(self._asks, dtype=np.float64).reshape(capacity, 2)
+        self._far_bids = {}  # tick -> size, below the window
+        self._far_asks = {}  # tick -> size, above the window
+        self._far_bid_ticks = None  # sorted ticks of _far_bids for levels_from, None until needed
+        self._far_ask_ticks = None
+        self._best_bid_idx = -1  # window row of the best bid. -1 if no bids
+        self._best_ask_idx = -1
+        self._total_bid_size = 0.0  # For monitoring purpose
+        self._total_ask_size = 0.0  # For monitoring purpose
+        self._dirty_bid_tick = None  # highest bid tick updated since the last take_dirty(). None if none
+        self._dirty_ask_tick = None  # lowest ask tick updated
+        self._place("bid", 0)
+        self._place("ask", 0)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def _place(self, side, origin):
+        """Empties the window of a side and moves its row 0 to tick `origin`. the price column is
+        filled in"""
+
+        view = self._asks_view if side == "ask" else self._bids_view
+        np.multiply(self._rows + origin, self.tick_size, out=view[:, 0])
+        view[:, 1] = 0.0
+        if side == "ask":
+            self._ask_origin = origin
+        else:
+            self._bid_origin = origin
+
+    def _to_tick(self, price):
+        tick = round(price * self._inv_tick_size)
+        if abs(tick * self.tick_size - price) > self.tick_size * 1e-6:
+            raise ValueError(f"price {price} is not on the {self.tick_size} tick grid")
+        return tick
+
+    def apply_update(self, side, size, price):
+        self.apply_tick_update(side, size, self._to_tick(price))
+
+    def apply_tick_update(self, side, size, tick):
+        if side == "ask":
+            idx = tick - self._ask_origin
+            if self._dirty_ask_tick is None or tick < self._dirty_ask_tick:
+                self._dirty_ask_tick = tick
+            if 0 <= idx < self._capacity:
+                old_size = self._asks[2 * idx + 1]
+                if size == 0:
+                    if old_size == 0:
+                        raise KeyError(tick)
+                    self._asks[2 * idx + 1] = 0.0
+                    self._total_ask_size -= old_size
+                    if idx == self._best_ask_idx:
+                        self._best_ask_idx = self._next_ask_idx(idx)
+                else:
+                    self._asks[2 * idx + 1] = size
+                    self._total_ask_size += size - old_size
+                    if self._best_ask_idx == -1 or idx < self._best_ask_idx:
+                        self._best_ask_idx = idx
+                return
+            if size == 0:
+                self._total_ask_size -= self._far_asks.pop(tick)  # KeyError if there is no level
+                self._far_ask_ticks = None
+                return
+            if idx < 0 or self._best_ask_idx == -1:  # new best ask outside the window
+                self._far_asks[tick] = size
+                self._total_ask_size += size
+                self._recentre("ask")
+                return
+            old_size = self._far_asks.get(tick)
+            if old_size is None:
+                old_size, self._far_ask_ticks = 0.0, None
+            self._total_ask_size += size - old_size
+            self._far_asks[tick] = size
+        else:  # bid
+            idx = tick - self._bid_origin
+            if self._dirty_bid_tick is None or tick > self._dirty_bid_tick:
+                self._dirty_bid_tick = tick
+            if 0 <= idx < self._capacity:
+                old_size = self._bids[2 * idx + 1]
+                if size == 0:
+                    if old_size == 0:
+                        raise KeyError(tick)
+                    self._bids[2 * idx + 1] = 0.0
+                    self._total_bid_size -= old_size
+                    if idx == self._best_bid_idx:
+                        self._best_bid_idx = self._next_bid_idx(idx)
+                else:
+                    self._bids[2 * idx + 1] = size
+                    self._total_bid_size += size - old_size
+                    if idx > self._best_bid_idx:
+                        self._best_bid_idx = idx
+                return
+            if size == 0:
+                self._total_bid_size -= self._far_bids.pop(tick)  # KeyError if there is no level
+                self._far_bid_ticks = None
+                return
+            if idx >= self._capacity or self._best_bid_idx == -1:  # new best bid outside the window
+                self._far_bids[tick] = size
+                self._total_bid_size += size
+                self._recentre("bid")
+                return
+            old_size = self._far_bids.get(tick)
+            if old_size is None:
+                old_size, self._far_bid_ticks = 0.0, None
+            self._total_bid_size += size - old_size
+            self._far_bids[tick] = size
+
+    def apply_overrides(self, side, levels):
+        """Applies (price, size) levels of one side in order. levels removed that are not in the book
+        are ignored, like the notebook replay does"""
+
+        for price, size in levels:
+            try:
+                self.apply_update(side, size, price)
+            except KeyError:
+                pass
+
+    def _next_bid_idx(self, idx):
+        """Best bid row once row `idx` is emptied. recentres if the window has no bids left"""
+
+        bids = self._bids
+        for next_idx in range(idx - 1, max(idx - 1 - _SCAN_STEPS, -1), -1):
+            if bids[2 * next_idx + 1]:
+                return next_idx
+        non_empty = np.flatnonzero(self._bids_view[: max(idx - _SCAN_STEPS, 0), 1])
+        if non_empty.size:
+            return int(non_empty[-1])
+        if self._far_bids:
+            self._recentre("bid")
+            return self._best_bid_idx
+        return -1
+
+    def _next_ask_idx(self, idx):
+        asks = self._asks
+        for next_idx in range(idx + 1, min(idx + 1 + _SCAN_STEPS, self._capacity)):
+            if asks[2 * next_idx + 1]:
+                return next_idx
+        start = min(idx + 1 + _SCAN_STEPS, self._capacity)
+        non_empty = np.flatnonzero(self._asks_view[start:, 1])
+        if non_empty.size:
+            return start + int(non_empty[0])
+        if self._far_asks:
+            self._recentre("ask")
+            return self._best_ask_idx
+        return -1
+
+    def _recentre(self, side):
+        """Moves the window of a side so that its best level is in the middle of it"""
+
+        if side == "ask":
+            ladder, view, levels, origin = self._asks, self._asks_view, self._far_asks, self._ask_origin
+        else:
+            ladder, view, levels, origin = self._bids, self._bids_view, self._far_bids, self._bid_origin
+        for idx in np.flatnonzero(view[:, 1]).tolist():
+            levels[origin + idx] = ladder[2 * idx + 1]
+        best_idx = -1
+        if levels:
+            best_tick = min(levels) if side == "ask" else max(levels)
+            origin = best_tick - self._capacity // 2
+            best_idx = best_tick - origin
+        self._place(side, origin)
+
+        far_levels = {}
+        for tick, size in levels.items():
+            idx = tick - origin
+            if 0 <= idx < self._capacity:
+                ladder[2 * idx + 1] = size
+            else:
+                far_levels[tick] = size
+        if side == "ask":
+            self._far_asks, self._far_ask_ticks, self._best_ask_idx = far_levels, None, best_idx
+        else:
+            self._far_bids, self._far_bid_ticks, self._best_bid_idx = far_levels, None, best_idx
+
+    def clear(self):
+        """Removes every level. the windows are kept"""
+
+        self._far_bids, self._far_asks = {}, {}
+        self._far_bid_ticks = self._far_ask_ticks = None
+        self._best_bid_idx = self._best_ask_idx = -1
+        self._total_bid_size = self._total_ask_size = 0.0
+        self._dirty_bid_tick, self._dirty_ask_tick = math.inf, -math.inf  # every level changed
+        self._bids_view[:, 1] = 0.0
+        self._asks_view[:, 1] = 0.0
+
+    def take_dirty(self):
+        """(highest bid tick, lowest ask tick) updated since the last call, None for a side without
+        updates, and resets them. meant for a single consumer of the book"""
+
+        dirty = self._dirty_bid_tick, self._dirty_ask_tick
+        self._dirty_bid_tick = self._dirty_ask_tick = None
+        return dirty
+
+    @property
+    def best_bid_tick(self):
+        return self._bid_origin + self._best_bid_idx if self._best_bid_idx != -1 else None
+
+    @property
+    def best_ask_tick(self):
+        return self._ask_origin + self._best_ask_idx if self._best_ask_idx != -1 else None
+
+    @property
+    def bid(self):
+        """Best bid price. None if there are no bids"""
+
+        return self._bids[2 * self._best_bid_idx] if self._best_bid_idx != -1 else None
+
+    @property
+    def ask(self):
+        return self._asks[2 * self._best_ask_idx] if self._best_ask_idx != -1 else None
+
+    @property
+    def bid_size(self):
+        return self._bids[2 * self._best_bid_idx + 1] if self._best_bid_idx != -1 else None
+
+    @property
+    def ask_size(self):
+        return self._asks[2 * self._best_ask_idx + 1] if self._best_ask_idx != -1 else None
+
+    @property
+    def total_bid_size(self):
+        return self._total_bid_size
+
+    @property
+    def total_ask_size(self):
+        return self._total_ask_size
+
+    def bids_view(self):
+        """(n, 2) [price, size] rows from the best bid down to the bottom of the window, no copy.
+        rows of empty price levels have size 0. levels outside the window are not included"""
+
+        if self._best_bid_idx == -1:
+            return self._bids_view[:0]
+        return self._bids_view[self._best_bid_idx :: -1]
+
+    def asks_view(self):
+        """(n, 2) [price, size] rows from the best ask up to the top of the window, no copy"""
+
+        if self._best_ask_idx == -1:
+            return self._asks_view[:0]
+        return self._asks_view[self._best_ask_idx :]
+
+    def levels(self, side):
+        """All non empty levels of a side as a (n, 2) [price, size] array, best first (copy)"""
+
+        if side == "ask":
+            view, far_levels = self.asks_view(), self._far_asks
+        else:
+            view, far_levels = self.bids_view(), self._far_bids
+        window_levels = view[view[:, 1] != 0]
+        if not far_levels:
+            return window_levels.copy()
+        far_ticks = sorted(far_levels, reverse=side != "ask")
+        far = np.array([[tick * self.tick_size, far_levels[tick]] for tick in far_ticks])
+        return np.concatenate([window_levels, far])
+
+    def levels_from(self, side, tick, min_size=None):
+        """(levels, complete): the non empty levels of a side from `tick` away from the best (`tick`
+        and below for bids) as a (n, 2) [price, size] array, best first, read until their sizes add
+        up to `min_size` (all of them if None). levels outside the window come after the window ones.
+        `complete` is True if no level of the side is left after them"""
+
+        if side == "ask":
+            best_idx, far_levels = self._best_ask_idx, self._far_asks
+            start = max(tick - self._ask_origin, best_idx)
+            rows = self._asks_view[start:] if best_idx != -1 and start < self._capacity else None
+        else:
+            best_idx, far_levels = self._best_bid_idx, self._far_bids
+            start = min(tick - self._bid_origin, best_idx)
+            rows = self._bids_view[start::-1] if best_idx != -1 and start >= 0 else None
+        if best_idx == -1:  # no levels in the window means no levels at all
+            return self._bids_view[:0].copy(), True
+
+        target = math.inf if min_size is None else min_size
+        chunks, size, complete = [], 0.0, True
+        if rows is not None:
+            position, step = 0, _READ_ROWS
+            while position < len(rows) and size < target:
+                chunk = rows[position : position + step]
+                chunk = chunk[chunk[:, 1] != 0]
+                chunks.append(chunk)
+                size += chunk[:, 1].sum()
+                position += step
+                step *= 2
+            complete = position >= len(rows)
+        if complete and far_levels:
+            if side == "ask":
+                if self._far_ask_ticks is None:
+                    self._far_ask_ticks = sorted(far_levels)
+                far_ticks = self._far_ask_ticks[bisect_left(self._far_ask_ticks, tick) :]
+            else:
+                if self._far_bid_ticks is None:
+                    self._far_bid_ticks = sorted(far_levels)
+                far_ticks = self._far_bid_ticks[: bisect_right(self._far_bid_ticks, tick)][::-1]
+            far = []
+            for far_tick in far_ticks:
+                if size >= target:
+                    break
+                far_size = far_levels[far_tick]
+                far.append((far_tick * self.tick_size, far_size))
+                size += far_size
+            complete = len(far) == len(far_ticks)
+            chunks.append(np.array(far).reshape(-1, 2))
+        if not chunks:
+            return self._bids_view[:0].copy(), complete
+        return (chunks[0] if len(chunks) == 1 else np.concatenate(chunks)), complete
@@ -0,0 +1,248 @@
+"""Packed binary encoding of orderbook levels.
+
+a packed level array is a small header followed by one fixed size record per level:
+
+    header: magic b"LVL1", price scale (uint8), size scale (uint8), level count (uint32)
+    level:  side (int8, BID/ASK), price ticks (int64), size ticks (int64)
+
+price = price_ticks / 10**price_scale and size = size_ticks / 10**size_scale, where the scales are
+the largest number of decimals in the array. the encoding is lossless: every level decodes to the
+same decimal value as the venue string (trailing zeros are normalised to the array scale).
+`np.frombuffer` gives a zero copy view of the records, so replay does no parsing at all.
+
+packed arrays are stored in the `levels_packed`/`overrides_packed` BLOB columns and/or appended to
+segment files (`LevelSegmentWriter`) that `LevelSegment` memory-maps.
+"""
+import mmap
+import os
+import struct
+from decimal import Decimal
+
+import numpy as np
+from config import LEVELS_STORAGE_FORMAT
+from fast_decode import json_loads
+from models import OrderbookSnapshot, OrderbookLevelOverride
+from ticks import MAX_SCALE, decimals, significant_decimals, ticks_to_str, to_ticks
+
+MAGIC = b"LVL1"
+HEADER = struct.Struct("<4sBBI")
+LEVEL_DTYPE = np.dtype([("side", "i1"), ("price", "<i8"), ("size", "<i8")])
+BID = 0
+ASK = 1
+
+# model -> (bids json column, asks json column, packed column)
+LEVEL_COLUMNS = {
+    OrderbookSnapshot: ("bids", "asks", "levels_packed"),
+    OrderbookLevelOverride: ("bids_overrides", "asks_overrides", "overrides_packed"),
+}
+
+
+def _array_scale(values):
+    scale = 0
+    for value in values:
+        if "e" in value or "E" in value:
+            value_scale = significant_decimals(value)
+        else:
+            value_scale = decimals(value)
+        if value_scale > scale:
+            scale = value_scale
+    if scale > MAX_SCALE:
+        raise ValueError(f"can not pack values with {scale} decimals (max {MAX_SCALE})")
+    return scale
+
+
+def encode_levels(bids, asks):
+    """Packs lists of [price, size, ...] decimal strings (extra fields are ignored)"""
+
+    levels = bids + asks
+    prices = [level[0] for level in levels]
+    sizes = [level[1] for level in levels]
+    price_scale = _array_scale(prices)
+    size_scale = _array_scale(sizes)
+
+    records = np.empty(len(levels), dtype=LEVEL_DTYPE)
+    records["side"][: len(bids)] = BID
+    records["side"][len(bids) :] = ASK
+    try:
+        records["price"] = [to_ticks(price, price_scale) for price in prices]
+        records["size"] = [to_ticks(size, size_scale) for size in sizes]
+    except OverflowError as e:
+        raise ValueError(f"level does not fit int64 ticks: {e}")
+    return HEADER.pack(MAGIC, price_scale, size_scale, len(levels)) + records.tobytes()
+
+
+def encode_levels_json(bids_json, asks_json):
+    """Packs the JSON text stored in the bids/asks columns"""
+
+    return encode_levels(json_loads(bids_json), json_loads(asks_json))
+
+
+def decode_header(buffer, offset=0):
+    """(price_scale, size_scale, level_count) of the packed array at `offset`"""
+
+    magic, price_scale, size_scale, level_count = HEADER.unpack_from(buffer, offset)
+    if magic != MAGIC:
+        raise ValueError(f"not a packed level array (magic {magic!r})")
+    return price_scale, size_scale, level_count
+
+
+def decode_levels(buffer, offset=0):
+    """(records, price_scale, size_scale). `records` is a LEVEL_DTYPE view on `buffer`, no copy"""
+
+    price_scale, size_scale, level_count = decode_header(buffer, offset)
+    records = np.frombuffer(buffer, dtype=LEVEL_DTYPE, count=level_count, offset=offset + HEADER.size)
+    return records, price_scale, size_scale
+
+
+def packed_size(buffer, offset=0):
+    """Bytes taken by the packed array at `offset`"""
+
+    return HEADER.size + decode_header(buffer, offset)[2] * LEVEL_DTYPE.itemsize
+
+
+def levels_as_float(buffer, offset=0):
+    """(bids, asks) as float64 (n, 2) arrays of [price, size]"""
+
+    records, price_scale, size_scale = decode_levels(buffer, offset)
+    prices_sizes = np.empty((len(records), 2))
+    prices_sizes[:, 0] = records["price"] / 10**price_scale
+    prices_sizes[:, 1] = records["size"] / 10**size_scale
+    is_bid = records["side"] == BID
+    return prices_sizes[is_bid], prices_sizes[~is_bid]
+
+
+def decode_levels_to_strings(buffer, offset=0):
+    """(bids, asks) as [[price, size], ...] decimal strings, the inverse of `encode_levels`"""
+
+    records, price_scale, size_scale = decode_levels(buffer, offset)
+    bids, asks = [], []
+    for side, price, size in records.tolist():
+        level = [ticks_to_str(price, price_scale), ticks_to_str(size, size_scale)]
+        (bids if side == BID else asks).append(level)
+    return bids, asks
+
+
+def row_levels(row, model):
+    """(bids, asks) as [[price, size], ...] decimal strings of a row of `model` (see LEVEL_COLUMNS),
+    from its JSON columns if it has them, else from its packed array"""
+
+    bids_column, asks_column, packed_column = LEVEL_COLUMNS[model]
+    mapping = row._mapping
+    if mapping[bids_column] is not None:
+        return json_loads(mapping[bids_column]), json_loads(mapping[asks_column])
+    return decode_levels_to_strings(mapping[packed_column])
+
+
+def same_levels(bids, asks, buffer):
+    """True if the packed array holds exactly the decimal values of bids/asks"""
+
+    packed_bids, packed_asks = decode_levels_to_strings(buffer)
+    if len(packed_bids) != len(bids) or len(packed_asks) != len(asks):
+        return False
+    for levels, packed_levels in ((bids, packed_bids), (asks, packed_asks)):
+        for level, packed_level in zip(levels, packed_levels):
+            if Decimal(level[0]) != Decimal(packed_level[0]) or Decimal(level[1]) != Decimal(packed_level[1]):
+                return False
+    return True
+
+
+def level_columns(model, bids_json, asks_json, storage_format=LEVELS_STORAGE_FORMAT, levels=None):
+    """bids/asks row values of `model` in the configured storage format: 'json', 'packed' or 'both'.
+    all three columns are always present (None when unused) so the writer bulk inserts uniform rows.
+    `levels` are the (bids, asks) of the JSON already parsed, packed without parsing it again"""
+
+    bids_column, asks_column, packed_column = LEVEL_COLUMNS[model]
+    if storage_format == "json":
+        return {bids_column: bids_json, asks_column: asks_json, packed_column: None}
+    packed = encode_levels_json(bids_json, asks_json) if levels is None else encode_levels(*levels)
+    if storage_format == "packed":
+        return {bids_column: None, asks_column: None, packed_column: packed}
+    if storage_format == "both":
+        return {bids_column: bids_json, asks_column: asks_json, packed_column: packed}
+    raise ValueError(f"unknown levels storage format {storage_format}")
+
+
+# segment record: row id, orderbook_snapshot_id (-1 if none), received_at_ns, external_time_ns
+# (-1 if unknown), then the packed level array
+SEGMENT_RECORD_HEADER = struct.Struct("<qqqq")
+SEGMENT_SUFFIX = ".lvlseg"
+
+
+def segment_path(segment_dir, table_name, provider, base, counter):
+    return os.path.join(segment_dir, f"{table_name}_{provider}_{base}-{counter}{SEGMENT_SUFFIX}")
+
+
+class LevelSegmentWriter:
+    """Append-only file of packed level arrays"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "ab")
+
+    def append(self, row_id, packed, orderbook_snapshot_id=None, received_at_ns=None, external_time_ns=None):
+        self._file.write(
+            SEGMENT_RECORD_HEADER.pack(
+                row_id,
+                -1 if orderbook_snapshot_id is None else orderbook_snapshot_id,
+                -1 if received_at_ns is None else received_at_ns,
+                -1 if external_time_ns is None else external_time_ns,
+            )
+        )
+        self._file.write(packed)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LevelSegment:
+    """Read-only memory map of a segment file.
+    `records()` yields (row_id, orderbook_snapshot_id, received_at_ns, external_time_ns, levels,
+    price_scale, size_scale) with `levels` a LEVEL_DTYPE view into the map"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+
+    def records(self):
+        offset = 0
+        while offset < len(self._map):
+            row_id, snapshot_id, received_at_ns, external_time_ns = SEGMENT_RECORD_HEADER.unpack_from(
+                self._map, offset
+            )
+            offset += SEGMENT_RECORD_HEADER.size
+            levels, price_scale, size_scale = decode_levels(self._map, offset)
+            offset += HEADER.size + len(levels) * LEVEL_DTYPE.itemsize
+            yield (
+                row_id,
+                None if snapshot_id == -1 else snapshot_id,
+                None if received_at_ns == -1 else received_at_ns,
+                None if external_time_ns == -1 else external_time_ns,
+                levels,
+                price_scale,
+                size_scale,
+            )
+
+    def close(self):
+        # views handed out by `records()` keep the map alive until they are released
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
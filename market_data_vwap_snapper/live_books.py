@@ -0,0 +1,255 @@
+"""In-memory books of the feeds, kept up to date from the classified messages.
+
+the persist stage of every FeedPipeline applies the snapshots and level overrides it persists to
+the `LiveBook` of the instrument, on the DB thread, so a book always matches what was handed to the
+writer. levels are kept as the venue decimal strings keyed by int price ticks at the price scale of
+the instrument (see ticks.py), so equal prices always hit the same level whatever their string form,
+and a book checkpoints losslessly through `level_codec` (see checkpoint.py).
+
+a book can also mirror its levels in an `L2Book` (`keep_l2_book`, or `LiveBooks.keep_l2_books` for
+every book), the array ladder the VWAP engine reads without copying (see vwap.VwapCache, snapper.py).
+
+bitstamp `live_book_change` messages (live_orders channel) are order events, not levels, and are
+not applied.
+"""
+import logging
+
+from config import LIVE_BOOK_L2_CAPACITY, LIVE_BOOK_L2_MAX_CAPACITY, LIVE_BOOK_L2_PRICE_SPAN
+from instruments import REGISTRY
+from l2_book import L2Book
+from ticks import rescale, significant_decimals, to_ticks
+
+# classified message types applied to the books. snapshots replace the book, the others override levels
+SNAPSHOT_TYPES = ("snapshot",)
+OVERRIDE_TYPES = ("l2update", "update")
+
+
+def l2_capacity(bid_tick, ask_tick, capacity=LIVE_BOOK_L2_CAPACITY):
+    """L2Book window of a book: LIVE_BOOK_L2_PRICE_SPAN of its mid price in ticks, so the VWAP depths
+    of a fine tick instrument stay in the window, rounded up to a power of 2 and at least `capacity`.
+    at most LIVE_BOOK_L2_MAX_CAPACITY"""
+
+    span_ticks = max(int((bid_tick + ask_tick) / 2 * LIVE_BOOK_L2_PRICE_SPAN), 1)
+    return max(capacity, min(1 << (span_ticks - 1).bit_length(), LIVE_BOOK_L2_MAX_CAPACITY))
+
+
+class LiveBook:
+    """L2 book of one instrument. `bids`/`asks` map int price ticks at `price_decimals` ->
+    [price, size] venue strings"""
+
+    __slots__ = (
+        "provider",
+        "internal_pair",
+        "bids",
+        "asks",
+        "orderbook_snapshot_id",
+        "external_time_ns",
+        "price_decimals",
+        "received_at_ns",
+        "version",
+        "l2_book",
+        "price_decimals_from_snapshot",
+    )
+
+    def __init__(self, provider, internal_pair, price_decimals=None):
+        self.provider = provider
+        self.internal_pair = internal_pair
+        price_decimals_from_snapshot = False
+        if price_decimals is None:
+            instrument = REGISTRY.from_internal(provider, internal_pair)
+            price_decimals, price_decimals_from_snapshot = instrument.price_decimals, not instrument.listed
+        self.price_decimals = price_decimals
+        # not in the venue metadata: the default decimals are replaced by those of the first snapshot
+        self.price_decimals_from_snapshot = price_decimals_from_snapshot
+        self.bids = {}
+        self.asks = {}
+        self.orderbook_snapshot_id = None  # snapshot the overrides applied since refer to
+        self.external_time_ns = None  # venue time of the last message applied
+        self.received_at_ns = None  # receive time of the last message applied. not checkpointed
+        self.version = 0  # messages applied, so a consumer can tell the book changed
+        self.l2_book = None  # L2Book mirror of the levels, see keep_l2_book
+
+    def price_key(self, price):
+        """int ticks of a venue price string. a price finer than the tick size of the instrument
+        widens the scale of the book (and is logged: the venue metadata is out of date)"""
+
+        try:
+            return to_ticks(price, self.price_decimals)
+        except ValueError:
+            price_decimals = significant_decimals(price)
+            logging.warning(
+                f"{self.provider} {self.internal_pair} price {price} is finer than {self.price_decimals} "
+                f"decimals. book rescaled to {price_decimals} decimals"
+            )
+            self.bids, self.asks = (
+                {rescale(key, self.price_decimals, price_decimals): level for key, level in levels.items()}
+                for levels in (self.bids, self.asks)
+            )
+            self.price_decimals = price_decimals
+            if self.l2_book is not None:
+                self.keep_l2_book(self.l2_book.capacity)  # new tick grid
+            return to_ticks(price, price_decimals)
+
+    def l2_capacity(self, capacity=LIVE_BOOK_L2_CAPACITY):
+        """L2Book window of the book, see l2_capacity"""
+
+        if not self.bids or not self.asks:
+            return capacity
+        return l2_capacity(max(self.bids), min(self.asks), capacity)
+
+    def keep_l2_book(self, capacity=LIVE_BOOK_L2_CAPACITY):
+        """Mirrors the levels in `l2_book`, an L2Book on the price tick grid of the book, from now on.
+        its windows are `l2_capacity(capacity)` ticks. the L2Book is cleared and reused if it is
+        already on that grid, with that capacity"""
+
+        tick_size, capacity = 10.0**-self.price_decimals, self.l2_capacity(capacity)
+        l2_book = self.l2_book
+        if l2_book is not None and l2_book.tick_size == tick_size and l2_book.capacity == capacity:
+            l2_book.clear()
+        else:
+            self.l2_book = L2Book(tick_size, capacity)
+        for side, levels in (("bid", self.bids), ("ask", self.asks)):
+            for tick, level in levels.items():
+                self.l2_book.apply_tick_update(side, float(level[1]), tick)
+
+    def apply_snapshot(self, bids, asks, orderbook_snapshot_id, external_time_ns, received_at_ns=None):
+        if self.price_decimals_from_snapshot:
+            self.price_decimals_from_snapshot = False
+            prices = [level[0] for snapshot_levels in (bids, asks) for level in snapshot_levels]
+            if prices:
+                self.price_decimals = max(significant_decimals(price) for price in prices)
+        self.bids, self.asks = {}, {}
+        for is_bid, snapshot_levels in ((True, bids), (False, asks)):
+            for level in snapshot_levels:
+                price = self.price_key(level[0])
+                levels = self.bids if is_bid else self.asks  # price_key may have rescaled the book
+                levels[price] = [level[0], level[1]]
+        self.orderbook_snapshot_id = orderbook_snapshot_id
+        self.external_time_ns = external_time_ns
+        self.received_at_ns = received_at_ns
+        self.version += 1
+        if self.l2_book is not None:
+            self.keep_l2_book(self.l2_book.capacity)
+
+    def apply_overrides(self, bids_overrides, asks_overrides, external_time_ns, received_at_ns=None):
+        """[price, size] levels applied in order. size 0 removes the level"""
+
+        for is_bid, overrides in ((True, bids_overrides), (False, asks_overrides)):
+            side = "bid" if is_bid else "ask"
+            for level in overrides:
+                price = self.price_key(level[0])
+                levels = self.bids if is_bid else self.asks  # price_key may have rescaled the book
+                size = float(level[1])
+                if size == 0:
+                    if levels.pop(price, None) is None:
+                        continue  # removal of a level the book does not have
+                else:
+                    levels[price] = [level[0], level[1]]
+                if self.l2_book is not None:
+                    self.l2_book.apply_tick_update(side, size, price)
+        if external_time_ns is not None:
+            self.external_time_ns = external_time_ns
+        if received_at_ns is not None:
+            self.received_at_ns = received_at_ns
+        self.version += 1
+
+    def levels(self):
+        """(bids, asks) as [[price, size], ...] venue strings, unsorted"""
+
+        return list(self.bids.values()), list(self.asks.values())
+
+
+def message_overrides(msg_classified):
+    """(bids overrides, asks overrides) of a classified l2update / update message, whatever the
+    decode path (levels parsed with the raw JSON slices, bids/asks overrides dict or coinbase
+    [side, price, size] changes)"""
+
+    if "bids_overrides" in msg_classified:  # fast decode path
+        return msg_classified["bids_overrides"], msg_classified["asks_overrides"]
+    changes = msg_classified["changes"]
+    if isinstance(changes, dict):
+        return changes["bids_overrides"], changes["asks_overrides"]
+    bids_overrides = [change[1:] for change in changes if change[0] == "buy"]
+    asks_overrides = [change[1:] for change in changes if change[0] == "sell"]
+    return bids_overrides, asks_overrides
+
+
+class LiveBooks:
+    """(provider, internal pair) -> LiveBook for every instrument of every feed of the process"""
+
+    def __init__(self):
+        self._books = {}
+        self._l2_capacity = None  # L2Book window of every book, None if the books keep no L2Book
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._books)
+
+    def __iter__(self):
+        return iter(list(self._books.values()))
+
+    def get(self, provider, internal_pair):
+        return self._books.get((provider, internal_pair))
+
+    def book(self, provider, internal_pair):
+        """LiveBook of the instrument, created empty on first use"""
+
+        book = self._books.get((provider, internal_pair))
+        if book is None:
+            book = LiveBook(provider, internal_pair)
+            self.add(book)
+        return book
+
+    def add(self, book):
+        if self._l2_capacity is not None and book.l2_book is None:
+            book.keep_l2_book(self._l2_capacity)
+        self._books[(book.provider, book.internal_pair)] = book
+
+    def keep_l2_books(self, capacity=LIVE_BOOK_L2_CAPACITY):
+        """Every book, current and future, mirrors its levels in an L2Book (see LiveBook.keep_l2_book)"""
+
+        self._l2_capacity = capacity
+        for book in self._books.values():
+            if book.l2_book is None:
+                book.keep_l2_book(capacity)
+
+    def add_listener(self, callback):
+        """`callback()` runs on the DB thread after every batch of messages a feed applied"""
+
+        self._listeners.append(callback)
+
+    def batch_applied(self):
+        for callback in self._listeners:
+            callback()
+
+    def apply_message(self, provider, msg_classified, orderbook_snapshot_ids):
+        """Applies a classified message once it went through the venue persist function, so
+        `orderbook_snapshot_ids` already holds the id of a snapshot message"""
+
+        message_type = msg_classified["type"]
+        if message_type in SNAPSHOT_TYPES:
+            internal_pair = msg_classified["internal_pair"]
+            self.book(provider, internal_pair).apply_snapshot(
+                msg_classified["bids"],
+                msg_classified["asks"],
+                orderbook_snapshot_ids.get(internal_pair),
+                msg_classified.get("external_time_ns"),
+                msg_classified.get("received_at_ns"),
+            )
+        elif message_type in OVERRIDE_TYPES:
+            bids_overrides, asks_overrides = message_overrides(msg_classified)
+            self.book(provider, msg_classified["internal_pair"]).apply_overrides(
+                bids_overrides,
+                asks_overrides,
+                msg_classified.get("external_time_ns"),
+                msg_classified.get("received_at_ns"),
+            )
+
+    def snapshot_ids(self, provider):
+        """{internal pair: orderbook snapshot id} of the provider books, to seed a restarted feed"""
+
+        return {
+            book.internal_pair: book.orderbook_snapshot_id
+            for (book_provider, _), book in self._books.items()
+            if book_provider == provider and book.orderbook_snapshot_id is not None
+        }
@@ -13,11 +13,12 @@ logger = logging.getLogger("websockets")
 logger.addHandler(logging.StreamHandler())
 
 
-from coinbase import coinbase_orderbook_download
-from kraken import kraken_orderbook_download
-from bitstamp import bitstamp_orderbook_download
+from supervisor import run_supervisor
+from config import SUPERVISOR_VENUE_PAIRS
 
 
-# asyncio.run(coinbase_orderbook_download(["BTC-USD"]))
+# single venue, e.g.:
+# from bitstamp import bitstamp_orderbook_download
 # asyncio.run(bitstamp_orderbook_download(["FLR-USD","AUDIO-USD"]))
-asyncio.run(bitstamp_orderbook_download(["BTC-USD"]))
+asyncio.run(run_supervisor(SUPERVISOR_VENUE_PAIRS))
+
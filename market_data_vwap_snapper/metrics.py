@@ -0,0 +1,244 @@
+"""In-process metrics of the ingestion hot path.
+
+counters, gauges and histograms are grouped in labelled families. `family.labels(...)` returns the
+child for a set of label values; callers keep the child and update it with a plain attribute
+increment (counters) or a bisect over the bucket bounds (histograms), a few hundred nanoseconds per
+message. children are updated from a single thread each (event loop or DB thread), no locking.
+
+the registry is exposed as Prometheus text (`METRICS.render()`, served by `start_metrics_server`) and
+as nested dicts (`METRICS.snapshot()`).
+"""
+import asyncio
+import logging
+import math
+import time
+from bisect import bisect_left
+
+from config import EVENT_LOOP_LAG_INTERVAL_SECONDS
+
+# seconds. from 10us (classify time) to 10s (venue latency, slow flushes)
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Cumulative buckets are only computed when rendering, `observe` touches one bucket"""
+
+    __slots__ = ("bounds", "bucket_counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        counts = []
+        total = 0
+        for bucket_count in self.bucket_counts:
+            total += bucket_count
+            counts.append(total)
+        return counts
+
+
+class MetricFamily:
+    """One metric name with its children, one per set of label values.
+    counters and gauges can also be read at render time from a callback registered per label values,
+    so values already tracked elsewhere (e.g. queue depths) cost nothing per message"""
+
+    def __init__(self, name, help_text, metric_type, labelnames, buckets=None):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if buckets is not None else None
+        self._children = {}  # label values tuple -> Counter / Gauge / Histogram
+        self._callbacks = {}  # label values tuple -> function returning the value
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+            if self.metric_type == "counter":
+                child = Counter()
+            elif self.metric_type == "gauge":
+                child = Gauge()
+            else:
+                child = Histogram(self.buckets)
+            self._children[labelvalues] = child
+        return child
+
+    def set_callback(self, labelvalues, callback):
+        """Value read from `callback()` at render time. replaces the callback of the same labels"""
+
+        if self.metric_type == "histogram":
+            raise ValueError(f"{self.name}: histograms can not be read from a callback")
+        self._callbacks[tuple(labelvalues)] = callback
+
+    def samples(self):
+        """(label values, value) pairs. histograms give their Histogram as value"""
+
+        samples = []
+        for labelvalues, child in list(self._children.items()):
+            samples.append((labelvalues, child if self.metric_type == "histogram" else child.value))
+        for labelvalues, callback in list(self._callbacks.items()):
+            try:
+                samples.append((labelvalues, callback()))
+            except Exception as e:
+                logging.warning(f"metric {self.name}{labelvalues} callback failed: {e}")
+        return samples
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = {}  # name -> MetricFamily
+
+    def _family(self, name, help_text, metric_type, labelnames, buckets=None):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = MetricFamily(name, help_text, metric_type, labelnames, buckets)
+        elif family.metric_type != metric_type or family.labelnames != tuple(labelnames):
+            raise ValueError(f"metric {name} already registered as {family.metric_type}{family.labelnames}")
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._family(name, help_text, "counter", labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._family(name, help_text, "gauge", labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._family(name, help_text, "histogram", labelnames, buckets)
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+
+        lines = []
+        for family in list(self._families.values()):
+            lines.append(f"# HELP {family.name} {family.help_text}")
+            lines.append(f"# TYPE {family.name} {family.metric_type}")
+            for labelvalues, value in family.samples():
+                if family.metric_type != "histogram":
+                    lines.append(f"{family.name}{_format_labels(family.labelnames, labelvalues)} {_format_value(value)}")
+                    continue
+                bounds = list(family.buckets) + [math.inf]
+                for bound, cumulative_count in zip(bounds, value.cumulative_counts()):
+                    labels = _format_labels(family.labelnames, labelvalues, [("le", _format_value(bound))])
+                    lines.append(f"{family.name}_bucket{labels} {cumulative_count}")
+                labels = _format_labels(family.labelnames, labelvalues)
+                lines.append(f"{family.name}_sum{labels} {_format_value(value.sum)}")
+                lines.append(f"{family.name}_count{labels} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """{metric name: {label values tuple: value}}. histograms give
+        {'count', 'sum', 'buckets': {upper bound: cumulative count}}"""
+
+        snapshot = {}
+        for family in list(self._families.values()):
+            values = {}
+            for labelvalues, value in family.samples():
+                if family.metric_type == "histogram":
+                    bounds = list(family.buckets) + [math.inf]
+                    value = {
+                        "count": value.count,
+                        "sum": value.sum,
+                        "buckets": dict(zip(bounds, value.cumulative_counts())),
+                    }
+                values[labelvalues] = value
+            snapshot[family.name] = values
+        return snapshot
+
+
+METRICS = MetricsRegistry()
+
+EVENT_LOOP_LAG = METRICS.histogram(
+    "event_loop_lag_seconds", "delay of a periodic event loop wake-up past its deadline"
+).labels()
+
+
+async def monitor_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL_SECONDS, histogram=EVENT_LOOP_LAG):
+    """Sleeps `interval` seconds in a loop and records how late each wake-up is.
+    a blocked event loop (long classify, sync DB call, ...) shows up as lag"""
+
+    while True:
+        deadline = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.perf_counter() - deadline))
+
+
+async def _handle_metrics_request(reader, writer, registry):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):  # headers are not used
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+        )
+        writer.write(body)
+        await writer.drain()
+    except Exception as e:
+        logging.warning(f"metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port, registry=METRICS):
+    """Serves `registry` in Prometheus text format on http://host:port/metrics from this event loop"""
+
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_metrics_request(reader, writer, registry), host, port
+    )
+    logging.info(f"metrics served on http://{host}:{port}/metrics")
+    return server
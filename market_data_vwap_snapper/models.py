@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table, DateTime, Float
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Table, DateTime, Float, LargeBinary, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 from sqlalchemy.dialects.postgresql import JSONB
@@ -9,6 +9,10 @@ Base = declarative_base()
 
 class OrderbookSnapshot(Base):
     __tablename__ = "orderbook_snapshots"
+    __table_args__ = (
+        # latest / as-of book per instrument
+        Index("ix_orderbook_snapshots_instrument_external_time", "provider", "base", "counter", "external_time"),
+    )
     id = Column(Integer, primary_key=True, comment="autoincrementing id")
     created_at = Column(
         DateTime, default=datetime.now, comment="created_at date. datetime in DB"
@@ -33,16 +37,31 @@ class OrderbookSnapshot(Base):
         String,
         comment="bids in a 2 levels json array [['price','size'],['price','size']]. 'price' and 'size' are kept as strings to avoid numerical problems",
     )
+    received_at_ns = Column(
+        BigInteger,
+        comment="received_at as UTC epoch nanoseconds (monotonic-anchored receive clock). null for rows written before it existed",
+    )
+    external_time_ns = Column(
+        BigInteger,
+        comment="external_time as UTC epoch nanoseconds. null if not provided by provider or for rows written before it existed",
+    )
+    levels_packed = Column(
+        LargeBinary,
+        comment="bids and asks as a packed level array (see level_codec.py). null if LEVELS_STORAGE_FORMAT is 'json'",
+    )
 
-    def __init__(self, external_time, received_at, base, counter, provider, levels, bids, asks):
+    def __init__(self, external_time, received_at, base, counter, provider, levels, bids=None, asks=None, external_time_ns=None, received_at_ns=None, levels_packed=None):
         self.external_time = external_time
         self.received_at = received_at
+        self.external_time_ns = external_time_ns
+        self.received_at_ns = received_at_ns
         self.base = base
         self.counter = counter
         self.provider = provider
         self.levels = levels
         self.bids = bids
         self.asks = asks
+        self.levels_packed = levels_packed
 
 
 class TickerInformation(Base):
@@ -73,6 +92,10 @@ class TickerInformation(Base):
 
 class OrderbookLevelOverride(Base):
     __tablename__ = "orderbook_level_overrides"
+    __table_args__ = (
+        # updates of a snapshot in replay order
+        Index("ix_orderbook_level_overrides_snapshot_external_time", "orderbook_snapshot_id", "external_time"),
+    )
     id = Column(Integer, primary_key=True, comment="autoincrementing id")
     orderbook_snapshot_id = Column(
         Integer,
@@ -100,6 +123,18 @@ class OrderbookLevelOverride(Base):
         String,
         comment="asks overrides in a 2 levels json array [['price','size'],['price','size']]. 'price' and 'size' are kept as strings to avoid numerical problems. the existing level for that price needs to be replaced with this new information. size =0 means that that level can be removed from book.",
     )
+    received_at_ns = Column(
+        BigInteger,
+        comment="received_at as UTC epoch nanoseconds (monotonic-anchored receive clock). null for rows written before it existed",
+    )
+    external_time_ns = Column(
+        BigInteger,
+        comment="external_time as UTC epoch nanoseconds. null if not provided by provider or for rows written before it existed",
+    )
+    overrides_packed = Column(
+        LargeBinary,
+        comment="bids and asks overrides as a packed level array (see level_codec.py). null if LEVELS_STORAGE_FORMAT is 'json'",
+    )
 
     def __init__(
         self,
@@ -109,20 +144,30 @@ class OrderbookLevelOverride(Base):
         base,
         counter,
         provider,
-        bids_overrides,
-        asks_overrides,
+        bids_overrides=None,
+        asks_overrides=None,
+        external_time_ns=None,
+        received_at_ns=None,
+        overrides_packed=None,
     ):
         self.orderbook_snapshot_id = orderbook_snapshot_id
         self.external_time = external_time
         self.received_at = received_at
+        self.external_time_ns = external_time_ns
+        self.received_at_ns = received_at_ns
         self.base = base
         self.counter = counter
         self.provider = provider
         self.bids_overrides = bids_overrides
         self.asks_overrides = asks_overrides
+        self.overrides_packed = overrides_packed
 
 class OrderbookLevelDiff(Base):
     __tablename__ = "orderbook_level_diffs"
+    __table_args__ = (
+        # updates of a snapshot in replay order
+        Index("ix_orderbook_level_diffs_snapshot_external_time", "orderbook_snapshot_id", "external_time"),
+    )
     id = Column(Integer, primary_key=True, comment="autoincrementing id")
     orderbook_snapshot_id = Column(
         Integer,
@@ -150,6 +195,14 @@ class OrderbookLevelDiff(Base):
         String,
         comment="asks changes in a 2 levels json array [['price','size','type'],['price','size','action_type']]. 'price' and 'size' are kept as strings to avoid numerical problems. 'action_type' can be 'ADD' or 'REMOVE'.the quantity needs to be added to the book if 'ADD' and removed from the book if 'REMOVE'",
     )
+    received_at_ns = Column(
+        BigInteger,
+        comment="received_at as UTC epoch nanoseconds (monotonic-anchored receive clock). null for rows written before it existed",
+    )
+    external_time_ns = Column(
+        BigInteger,
+        comment="external_time as UTC epoch nanoseconds. null if not provided by provider or for rows written before it existed",
+    )
 
     def __init__(
         self,
@@ -161,12 +214,108 @@ class OrderbookLevelDiff(Base):
         provider,
         bids_changes,
         asks_changes,
+        external_time_ns=None,
+        received_at_ns=None,
     ):
         self.orderbook_snapshot_id = orderbook_snapshot_id
         self.external_time = external_time
         self.received_at = received_at
+        self.external_time_ns = external_time_ns
+        self.received_at_ns = received_at_ns
         self.base = base
         self.counter = counter
         self.provider = provider
         self.bids_changes = bids_changes
         self.asks_changes = asks_changes
+
+
+class LatestOrderbookSnapshot(Base):
+    __tablename__ = "latest_orderbook_snapshots"
+    provider = Column(String, primary_key=True, comment="reference to the provider of the OrderbookSnapshot")
+    base = Column(String, primary_key=True, comment="internal representation of base asset")
+    counter = Column(String, primary_key=True, comment="internal representation of counter asset")
+    orderbook_snapshot_id = Column(
+        Integer, comment="id of the orderbook_snapshot with the latest external_time for this instrument"
+    )
+    external_time = Column(DateTime, comment="external_time of that orderbook_snapshot")
+    external_time_ns = Column(BigInteger, comment="external_time_ns of that orderbook_snapshot")
+    received_at = Column(DateTime, comment="received_at of that orderbook_snapshot")
+
+    def __init__(self, provider, base, counter, orderbook_snapshot_id, external_time, external_time_ns=None, received_at=None):
+        self.provider = provider
+        self.base = base
+        self.counter = counter
+        self.orderbook_snapshot_id = orderbook_snapshot_id
+        self.external_time = external_time
+        self.external_time_ns = external_time_ns
+        self.received_at = received_at
+
+
+class VwapSnapshot(Base):
+    __tablename__ = "vwap_snapshots"
+    __table_args__ = (
+        # VWAP series of an instrument
+        Index("ix_vwap_snapshots_instrument_external_time", "provider", "base", "counter", "external_time"),
+    )
+    id = Column(Integer, primary_key=True, comment="autoincrementing id")
+    created_at = Column(
+        DateTime, default=datetime.now, comment="created_at date. datetime in DB"
+    )
+    external_time = Column(
+        DateTime,
+        comment="external_time of the last message applied to the book. can be null if datetime is not provided by provider",
+    )
+    external_time_ns = Column(BigInteger, comment="external_time as UTC epoch nanoseconds")
+    received_at_ns = Column(
+        BigInteger, comment="received_at of the last message applied to the book, UTC epoch nanoseconds"
+    )
+    snapped_at_ns = Column(
+        BigInteger, comment="time the VWAPs were computed, UTC epoch nanoseconds. snapped_at_ns - received_at_ns is the snap latency"
+    )
+    base = Column(String, comment="internal representation of base asset")
+    counter = Column(String, comment="internal representation of counter asset")
+    provider = Column(String, comment="reference to the provider of the book")
+    orderbook_snapshot_id = Column(
+        Integer, comment="id of the orderbook_snapshot the book was built from. null if not persisted"
+    )
+    mid_rate = Column(Float, comment="(best bid + best ask) / 2. null if a side of the book is empty")
+    top_bid = Column(Float, comment="best bid price. null if there are no bids")
+    top_ask = Column(Float, comment="best ask price. null if there are no asks")
+    depths_usd_packed = Column(
+        LargeBinary,
+        comment="notional depths (counter currency) of the ladder as little endian float64 values",
+    )
+    vwaps_packed = Column(
+        LargeBinary,
+        comment="VWAP ladder as little endian float64 values: the bid VWAP of every depth of depths_usd_packed, then the ask VWAPs. NaN where the book side can not fill the depth",
+    )
+
+    def __init__(
+        self,
+        provider,
+        base,
+        counter,
+        snapped_at_ns,
+        depths_usd_packed,
+        vwaps_packed,
+        orderbook_snapshot_id=None,
+        external_time=None,
+        external_time_ns=None,
+        received_at_ns=None,
+        mid_rate=None,
+        top_bid=None,
+        top_ask=None,
+    ):
+        self.provider = provider
+        self.base = base
+        self.counter = counter
+        self.snapped_at_ns = snapped_at_ns
+        self.depths_usd_packed = depths_usd_packed
+        self.vwaps_packed = vwaps_packed
+        self.orderbook_snapshot_id = orderbook_snapshot_id
+        self.external_time = external_time
+        self.external_time_ns = external_time_ns
+        self.received_at_ns = received_at_ns
+        self.mid_rate = mid_rate
+        self.top_bid = top_bid
+        self.top_ask = top_ask
@@ -0,0 +1,157 @@
+"""VWAP replay of many instruments on a process pool.
+
+every book replays on its own (see replay.py), so the work is split in partitions fanned out to a
+`ProcessPoolExecutor`: one per instrument (`partition="instrument"`), or one per snapshot of the
+chain of every instrument (`partition="snapshot"`: a snapshot resets the book, so even a single
+instrument spreads over the cores). each worker opens its own read-only engine
+(database.get_readonly_engine), replays its partition with a `VwapReplayConsumer` and writes the
+vwap_snapshots rows through its own BatchedWriter to a temporary sqlite database of the partition, so
+no two processes write to the same database. the driver then streams them back, the partitions of an
+instrument one after the other and the instruments merged in `snapped_at_ns` order (`heapq.merge`, like
+replay.py merges the events), and writes them through a single BatchedWriter to `sink_url` (the
+replayed database by default, like replay.py does). memory holds one chunk of rows per instrument.
+
+with snapshot partitions the `interval_seconds` clock of a book restarts at every snapshot: the first
+ladder after a snapshot is always written, where a serial replay may skip it.
+
+    rows_count = parallel_vwap_replay(DATABASE_URL, [("coinbase", "BTC-USD"), ("kraken", "BTC-USD")], start, end)
+
+see benchmark_replay.py for the scaling with the number of workers.
+"""
+import heapq
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, groupby
+
+from config import VWAP_DEPTHS_USD, REPLAY_CHUNK_ROWS, REPLAY_VWAP_EVERY_X_SECONDS, REPLAY_MAX_WORKERS
+from database import get_readonly_engine
+from models import VwapSnapshot
+from replay import VwapReplayConsumer, instrument_events, snapshot_chain
+from sinks import make_sink
+from sqlalchemy import select
+from writer import BatchedWriter
+
+PARTITIONS = ("instrument", "snapshot")
+
+
+def replay_partitions(database_url, instruments, start=None, end=None, partition="instrument"):
+    """[(provider, internal pair, snapshot ids)], snapshot ids None for a whole instrument"""
+
+    if partition not in PARTITIONS:
+        raise ValueError(f"partition must be one of {PARTITIONS}, got {partition}")
+    if partition == "instrument":
+        return [(provider, internal_pair, None) for provider, internal_pair in instruments]
+    partitions = []
+    with get_readonly_engine(database_url).connect() as conn:
+        for provider, internal_pair in instruments:
+            for snapshot_id in snapshot_chain(conn, provider, internal_pair, start, end):
+                partitions.append((provider, internal_pair, [snapshot_id]))
+    return partitions
+
+
+def replay_partition(
+    database_url,
+    sink_url,
+    provider,
+    internal_pair,
+    snapshot_ids,
+    start=None,
+    end=None,
+    depths_usd=VWAP_DEPTHS_USD,
+    interval_seconds=REPLAY_VWAP_EVERY_X_SECONDS,
+    chunk_rows=REPLAY_CHUNK_ROWS,
+):
+    """Writes the vwap_snapshots rows of one partition to `sink_url`, in time order, and returns how
+    many. runs in a worker process"""
+
+    writer = BatchedWriter(make_sink(sink_url))
+
+    def emit(row):
+        writer.add(VwapSnapshot, row)
+        writer.maybe_flush()
+
+    consumer = VwapReplayConsumer(emit, depths_usd, interval_seconds)
+    try:
+        with get_readonly_engine(database_url).connect() as conn:
+            events = instrument_events(
+                conn, provider, internal_pair, start, end, chunk_rows, l2_books=True, snapshot_ids=snapshot_ids
+            )
+            for book, update in events:
+                consumer(book, update)
+    finally:
+        writer.close()
+    return consumer.snaps_count
+
+
+def partition_rows(sink_url, chunk_rows=REPLAY_CHUNK_ROWS):
+    """vwap_snapshots rows replay_partition wrote to `sink_url`, as snapper.vwap_row dicts in the order
+    written (time order)"""
+
+    table = VwapSnapshot.__table__
+    columns = [column for column in table.c if column.name not in ("id", "created_at")]
+    statement = select(*columns).order_by(table.c.id).execution_options(yield_per=chunk_rows)
+    engine = get_readonly_engine(sink_url)
+    try:
+        with engine.connect() as conn:
+            for row in conn.execute(statement):
+                yield dict(row._mapping)
+    finally:
+        engine.dispose()
+
+
+def parallel_vwap_replay(
+    database_url,
+    instruments,
+    start=None,
+    end=None,
+    max_workers=REPLAY_MAX_WORKERS,
+    partition="instrument",
+    depths_usd=VWAP_DEPTHS_USD,
+    interval_seconds=REPLAY_VWAP_EVERY_X_SECONDS,
+    chunk_rows=REPLAY_CHUNK_ROWS,
+    sink_url=None,
+):
+    """Writes the vwap_snapshots rows of the instruments ((provider, internal pair) pairs) between
+    `start` and `end` to `sink_url` (`database_url` if None) in time order, replayed on `max_workers`
+    processes (os.cpu_count() if None). returns the number of rows written"""
+
+    if sink_url is None:
+        sink_url = database_url
+    partitions = replay_partitions(database_url, instruments, start, end, partition)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        partition_urls = [
+            f"sqlite:///{os.path.join(tmp_dir, f'partition_{idx}.sqlite')}" for idx in range(len(partitions))
+        ]
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(
+                    replay_partition,
+                    database_url,
+                    partition_url,
+                    provider,
+                    internal_pair,
+                    snapshot_ids,
+                    start,
+                    end,
+                    depths_usd,
+                    interval_seconds,
+                    chunk_rows,
+                )
+                for partition_url, (provider, internal_pair, snapshot_ids) in zip(partition_urls, partitions)
+            ]
+            rows_count = sum(future.result() for future in futures)
+
+        # the snapshot partitions of an instrument follow its snapshot chain: read one after the other
+        streams = []
+        for _, group in groupby(zip(partition_urls, partitions), key=lambda item: item[1][:2]):
+            urls = [partition_url for partition_url, _ in group]
+            streams.append(chain.from_iterable(partition_rows(url, chunk_rows) for url in urls))
+        writer = BatchedWriter(make_sink(sink_url))
+        try:
+            for row in heapq.merge(*streams, key=lambda row: row["snapped_at_ns"]):
+                writer.add(VwapSnapshot, row)
+                writer.maybe_flush()
+        finally:
+            writer.close()
+    return rows_count
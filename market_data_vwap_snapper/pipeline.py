@@ -0,0 +1,444 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+from config import (
+    EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT,
+    PIPELINE_RAW_QUEUE_MAXSIZE,
+    PIPELINE_CLASSIFIED_QUEUE_MAXSIZE,
+    PIPELINE_BACKPRESSURE_POLICY,
+    PIPELINE_PERSIST_BATCH_MAX_ITEMS,
+    METRICS_HISTOGRAM_SAMPLE_EVERY,
+    WRITER_FLUSH_EVERY_X_SECONDS,
+)
+from websockets import connect
+from backoff import ExponentialBackoff
+from fast_decode import json_loads, concat_levels
+from timestamps import RECEIVE_CLOCK, ns_to_datetime
+from metrics import METRICS
+
+FEED_MESSAGES = METRICS.counter("feed_messages_total", "websocket messages classified", ("venue", "pair"))
+FEED_CLASSIFY_SECONDS = METRICS.histogram(
+    "feed_classify_seconds", "time spent decoding and classifying one message. sampled", ("venue",)
+)
+FEED_VENUE_LATENCY_SECONDS = METRICS.histogram(
+    "feed_venue_latency_seconds", "received_at - external_time of book messages. sampled", ("venue", "pair")
+)
+FEED_RECONNECTS = METRICS.counter("feed_reconnects_total", "websocket reconnections", ("venue",))
+FEED_RECEIVE_EXCEPTIONS = METRICS.counter(
+    "feed_receive_exceptions_total", "exceptions raised while receiving", ("venue",)
+)
+FEED_QUEUE_DEPTH = METRICS.gauge("feed_queue_depth", "items waiting in front of a stage", ("venue", "stage"))
+FEED_QUEUE_DROPPED = METRICS.counter(
+    "feed_queue_dropped_total", "items dropped by the DROP_OLDEST policy", ("venue", "stage")
+)
+FEED_QUEUE_CONFLATED = METRICS.counter(
+    "feed_queue_conflated_total", "items merged by the CONFLATE policy", ("venue", "stage")
+)
+
+
+class BackpressurePolicy(Enum):
+    BLOCK = "block"  # producer waits for room in the queue
+    DROP_OLDEST = "drop_oldest"  # oldest queued item (a snapshot never) is discarded to make room
+    CONFLATE = "conflate"  # item is merged into a queued item with the same key
+
+
+class StageQueue:
+    """Bounded FIFO between two pipeline stages.
+    when full, `put` applies the backpressure policy. DROP_OLDEST discards the oldest queued item
+    that is not a barrier (see below). CONFLATE merges (`conflate_merge(queued, new)`) an item with
+    a non-None `conflate_key(item)` into the last queued item with the same key, so a lagging
+    consumer sees fewer but equivalent items. other items fall back to BLOCK, as DROP_OLDEST does
+    when only barriers are queued.
+    an item with a non-None `barrier_key(item)` (the snapshot of a book) is never dropped, and
+    nothing is merged into the items with that conflate key queued before it: no item moves ahead
+    of a barrier.
+    """
+
+    def __init__(self, name, maxsize, policy, conflate_key=None, conflate_merge=None, barrier_key=None):
+        if policy == BackpressurePolicy.CONFLATE and (conflate_key is None or conflate_merge is None):
+            raise ValueError(f"stage '{name}': CONFLATE policy needs conflate_key and conflate_merge")
+        self.name = name
+        self._maxsize = maxsize
+        self._policy = policy
+        self._conflate_key = conflate_key if policy == BackpressurePolicy.CONFLATE else None
+        self._conflate_merge = conflate_merge
+        self._barrier_key = barrier_key
+
+        # [key, item, is barrier] entries. the key is None once the entry can not be merged into
+        self._items = deque()
+        self._pending_by_key = {}  # key -> last queued entry with that key
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+        self._high_watermark = 0  # For monitoring purpose
+        self._dropped_count = 0  # For monitoring purpose
+        self._conflated_count = 0  # For monitoring purpose
+
+    def __len__(self):
+        return len(self._items)
+
+    async def put(self, item):
+        key = None if self._conflate_key is None else self._conflate_key(item)
+        barrier_key = None if self._barrier_key is None else self._barrier_key(item)
+        if barrier_key is not None:
+            self._detach(self._pending_by_key.get(barrier_key))
+
+        while len(self._items) >= self._maxsize:
+            pending = None if key is None else self._pending_by_key.get(key)
+            if pending is not None:
+                pending[1] = self._conflate_merge(pending[1], item)
+                self._conflated_count += 1
+                return
+            if self._policy == BackpressurePolicy.DROP_OLDEST and self._drop_oldest():
+                self._dropped_count += 1
+                continue
+            self._not_full.clear()
+            await self._not_full.wait()
+
+        entry = [key, item, barrier_key is not None]
+        self._items.append(entry)
+        if key is not None:
+            self._detach(self._pending_by_key.get(key))
+            self._pending_by_key[key] = entry
+        self._high_watermark = max(self._high_watermark, len(self._items))
+        self._not_empty.set()
+
+    async def get(self):
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._pop()
+
+    def get_nowait_batch(self, max_items):
+        """Up to `max_items` queued items without waiting"""
+
+        batch = []
+        while self._items and len(batch) < max_items:
+            batch.append(self._pop())
+        return batch
+
+    def _pop(self):
+        entry = self._items.popleft()
+        self._removed(entry)
+        return entry[1]
+
+    def _drop_oldest(self):
+        """Discards the oldest queued item that is not a barrier. False if there is none"""
+
+        for idx, entry in enumerate(self._items):
+            if not entry[2]:
+                del self._items[idx]
+                self._removed(entry)
+                return True
+        return False
+
+    def _detach(self, entry):
+        """Nothing is merged into `entry` anymore"""
+
+        if entry is not None and entry[0] is not None:
+            del self._pending_by_key[entry[0]]
+            entry[0] = None
+
+    def _removed(self, entry):
+        self._detach(entry)
+        if len(self._items) < self._maxsize:
+            self._not_full.set()
+
+    @property
+    def stats(self):
+        return {
+            "depth": len(self._items),
+            "maxsize": self._maxsize,
+            "high_watermark": self._high_watermark,
+            "dropped_count": self._dropped_count,
+            "conflated_count": self._conflated_count,
+        }
+
+
+def l2update_conflate_key(classified_item):
+    """Only book updates are conflated. snapshots and control messages are kept as they are"""
+
+    msg_classified, _ = classified_item
+    if msg_classified["type"] in ("l2update", "update"):
+        return msg_classified["internal_pair"]
+    return None
+
+
+def snapshot_barrier_key(classified_item):
+    """A snapshot resets its book: the updates queued before it must stay before it"""
+
+    msg_classified, _ = classified_item
+    if msg_classified["type"] == "snapshot":
+        return msg_classified["internal_pair"]
+    return None
+
+
+def merge_l2updates(queued_item, new_item):
+    """Concatenates the level changes of two updates of the same book.
+    overrides are applied in order, so the merged message leaves the book in the same state"""
+
+    queued_msg, received_at = queued_item
+    new_msg, _ = new_item
+    merged_msg = dict(new_msg)
+    if "bids_overrides_raw" in new_msg:  # fast decode path, level arrays are raw JSON text
+        for key in ("bids_overrides_raw", "asks_overrides_raw"):
+            merged_msg[key] = concat_levels(queued_msg[key], new_msg[key])
+        for key in ("bids_overrides", "asks_overrides"):  # and their parsed levels
+            merged_msg[key] = queued_msg[key] + new_msg[key]
+    elif isinstance(new_msg["changes"], dict):
+        merged_msg["changes"] = {
+            side: queued_msg["changes"].get(side, []) + changes
+            for side, changes in new_msg["changes"].items()
+        }
+    else:
+        merged_msg["changes"] = queued_msg["changes"] + new_msg["changes"]
+    merged_msg["received_at_ns"] = queued_msg.get("received_at_ns")
+    return merged_msg, received_at
+
+
+class FeedPipeline:
+    """Receive -> classify -> persist pipeline for one websocket feed.
+
+    receive: only `await ws.recv()` and reconnection, frames go to the raw queue
+    classify: `decode(frame)` if given (venue fast decode path), else `classify(json_loads(frame))`.
+        results go to the classified queue
+    persist: drains the classified queue in batches and runs the venue `persist` function
+        and the writer flushes on a dedicated DB thread, so commits never stall the event loop
+
+    `persist(msg_classified, received_at, writer, orderbook_snapshot_ids)` is called on the DB thread.
+    every classified message also carries `received_at_ns`, the `RECEIVE_CLOCK` epoch ns of the frame,
+    and `received_at` is the same time as a naive UTC datetime.
+    when `db_executor` is given (a writer shared between feeds) the caller owns both the executor and
+    the writer: the pipeline only flushes on exit. otherwise it creates its own DB thread and closes
+    the writer on exit.
+    with `live_books` (see live_books.py) every persisted message is also applied to the in-memory
+    book of its instrument, and the feed starts from the snapshot ids of the books it already has,
+    so overrides received before the next snapshot still refer to one. the listeners of the books
+    (see LiveBooks.add_listener) run after every batch.
+    """
+
+    def __init__(
+        self,
+        provider,
+        url,
+        subscribe_messages,
+        classify,
+        persist,
+        writer,
+        decode=None,
+        ssl=None,
+        db_executor=None,
+        live_books=None,
+        backpressure_policy=PIPELINE_BACKPRESSURE_POLICY,
+        raw_queue_maxsize=PIPELINE_RAW_QUEUE_MAXSIZE,
+        classified_queue_maxsize=PIPELINE_CLASSIFIED_QUEUE_MAXSIZE,
+        persist_batch_max_items=PIPELINE_PERSIST_BATCH_MAX_ITEMS,
+    ):
+        self.provider = provider
+        self._url = url
+        self._subscribe_messages = subscribe_messages
+        self._classify = classify
+        self._decode = decode if decode is not None else lambda data: classify(json_loads(data))
+        self._persist = persist
+        self._writer = writer
+        self._ssl = ssl
+        self._persist_batch_max_items = persist_batch_max_items
+
+        policy = BackpressurePolicy(backpressure_policy)
+        # raw frames are not parsed yet: they can not be conflated, and a snapshot can not be told
+        # from an update, so only the classified queue drops or conflates
+        self.raw_queue = StageQueue("raw", raw_queue_maxsize, BackpressurePolicy.BLOCK)
+        self.classified_queue = StageQueue(
+            "classified",
+            classified_queue_maxsize,
+            policy,
+            conflate_key=l2update_conflate_key,
+            conflate_merge=merge_l2updates,
+            barrier_key=snapshot_barrier_key,
+        )
+
+        self._owns_db_executor = db_executor is None
+        if db_executor is None:
+            db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{provider}-db")
+        self._db_executor = db_executor
+        self._live_books = live_books
+        # only touched on the DB thread
+        self._orderbook_snapshot_ids = {} if live_books is None else live_books.snapshot_ids(provider)
+
+        self._message_counter = 0  # For monitoring purpose
+        self._websocket_closed_times = 0  # For monitoring purpose
+        self._expections_in_receipt_count = 0  # For monitoring purpose
+
+        self._metrics_by_pair = {}  # internal pair -> (messages counter, venue latency histogram)
+        self._classify_seconds = FEED_CLASSIFY_SECONDS.labels(provider)
+        self._reconnects = FEED_RECONNECTS.labels(provider)
+        self._receive_exceptions = FEED_RECEIVE_EXCEPTIONS.labels(provider)
+        for queue in (self.raw_queue, self.classified_queue):
+            # a restarted feed replaces the callbacks of the previous pipeline
+            FEED_QUEUE_DEPTH.set_callback((provider, queue.name), queue.__len__)
+            FEED_QUEUE_DROPPED.set_callback(
+                (provider, queue.name), lambda queue=queue: queue.stats["dropped_count"]
+            )
+            FEED_QUEUE_CONFLATED.set_callback(
+                (provider, queue.name), lambda queue=queue: queue.stats["conflated_count"]
+            )
+
+    async def _connect(self):
+        ws = await connect(self._url, ssl=self._ssl)
+        for subscribe_message in self._subscribe_messages:
+            await ws.send(json.dumps(subscribe_message))
+        return ws
+
+    async def _receive(self):
+        exceptions_in_reconnection_in_row = 0
+        backoff = ExponentialBackoff()
+        ws = await self._connect()
+        while True:
+            try:
+                if not ws.open:
+                    self._websocket_closed_times += 1
+                    logging.warning(f"{self.provider} Websocket NOT connected. Trying to reconnect.")
+                    ws = await self._connect()
+                    self._reconnects.inc()
+                data = await ws.recv()
+            except Exception as e:
+                self._expections_in_receipt_count += 1
+                self._receive_exceptions.inc()
+                try:
+                    logging.warning(f"{self.provider} got exception in receipt. \n{e}\n. trying to reconnect...")
+                    ws = await self._connect()
+                    logging.info(f"{self.provider} Reconnected")
+                    self._reconnects.inc()
+                    exceptions_in_reconnection_in_row = 0
+                    backoff.reset()
+                except Exception as e2:
+                    exceptions_in_reconnection_in_row += 1
+                    if exceptions_in_reconnection_in_row < EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT:
+                        delay = backoff.next_delay()
+                        logging.warning(f"{self.provider} got exception in reconnection. \n{e2}\n. retrying in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                        continue
+                    else:
+                        raise ValueError(
+                            f"too many exceptioins in reconnection. {exceptions_in_reconnection_in_row}/{EXCEPTIONS_IN_RECONNECTION_IN_ROW_LIMIT}"
+                        )
+                continue
+            await self.raw_queue.put((data, RECEIVE_CLOCK.now_ns()))
+
+    async def _classify_stage(self):
+        while True:
+            data, received_at_ns = await self.raw_queue.get()
+            received_at = ns_to_datetime(received_at_ns)  # naive UTC, like external_time
+            if self._message_counter % 10_000 == 0:
+                self._log_status(received_at)
+            self._message_counter += 1
+
+            if self._message_counter % METRICS_HISTOGRAM_SAMPLE_EVERY:
+                msg_classified = self._decode(data)
+                self._pair_metrics(msg_classified)[0].inc()
+            else:
+                tick = time.perf_counter()
+                msg_classified = self._decode(data)
+                self._classify_seconds.observe(time.perf_counter() - tick)
+                messages, venue_latency_seconds = self._pair_metrics(msg_classified)
+                messages.inc()
+                external_time_ns = msg_classified.get("external_time_ns")
+                if external_time_ns is not None:
+                    venue_latency_seconds.observe((received_at_ns - external_time_ns) / 1e9)
+            msg_classified["received_at_ns"] = received_at_ns
+            await self.classified_queue.put((msg_classified, received_at))
+
+    def _pair_metrics(self, msg_classified):
+        """(messages counter, venue latency histogram) of the pair of a message"""
+
+        pair = msg_classified.get("internal_pair", "")
+        pair_metrics = self._metrics_by_pair.get(pair)
+        if pair_metrics is None:
+            pair_metrics = self._metrics_by_pair[pair] = (
+                FEED_MESSAGES.labels(self.provider, pair),
+                FEED_VENUE_LATENCY_SECONDS.labels(self.provider, pair),
+            )
+        return pair_metrics
+
+    def _persist_batch(self, batch):
+        for msg_classified, received_at in batch:
+            self._persist(msg_classified, received_at, self._writer, self._orderbook_snapshot_ids)
+            if self._live_books is not None:
+                self._live_books.apply_message(self.provider, msg_classified, self._orderbook_snapshot_ids)
+        if self._live_books is not None:
+            self._live_books.batch_applied()
+        self._writer.maybe_flush()
+
+    async def _persist_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                first_item = await asyncio.wait_for(
+                    self.classified_queue.get(), timeout=WRITER_FLUSH_EVERY_X_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # nothing received for a while. let the writer flush on time
+                await loop.run_in_executor(self._db_executor, self._writer.maybe_flush)
+                continue
+            batch = [first_item]
+            batch += self.classified_queue.get_nowait_batch(self._persist_batch_max_items - 1)
+            await loop.run_in_executor(self._db_executor, self._persist_batch, batch)
+
+    def _log_status(self, received_at):
+        writer_stats = self._writer.stats
+        depths = self.queue_depths()
+        logging.info(
+            f"{self.provider} now: {received_at.strftime('%Y-%m-%d %H:%M:%S')}. # msg: {self._message_counter}. #closed socket: {self._websocket_closed_times}. #receipt exep: {self._expections_in_receipt_count}. #flush exep: {writer_stats['flush_exceptions_total_count']}. last batch: {writer_stats['last_batch_size']} rows in {writer_stats['last_flush_latency_ms']:.1f}ms. max flush: {writer_stats['max_flush_latency_ms']:.1f}ms. queue depths: {depths}"
+        )
+
+    def queue_depths(self):
+        """Current number of items waiting in front of each stage"""
+
+        return {
+            self.raw_queue.name: len(self.raw_queue),
+            self.classified_queue.name: len(self.classified_queue),
+        }
+
+    @property
+    def stats(self):
+        return {
+            "message_counter": self._message_counter,
+            "websocket_closed_times": self._websocket_closed_times,
+            "expections_in_receipt_count": self._expections_in_receipt_count,
+            self.raw_queue.name: self.raw_queue.stats,
+            self.classified_queue.name: self.classified_queue.stats,
+            "writer": self._writer.stats,
+        }
+
+    async def run(self):
+        """Runs the three stages until one of them fails. remaining rows are flushed on exit"""
+
+        tasks = [
+            asyncio.create_task(self._receive(), name=f"{self.provider}-receive"),
+            asyncio.create_task(self._classify_stage(), name=f"{self.provider}-classify"),
+            asyncio.create_task(self._persist_stage(), name=f"{self.provider}-persist"),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()  # re-raises the stage exception
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # whatever was classified still gets persisted, then the writer is flushed
+            loop = asyncio.get_running_loop()
+            batch = self.classified_queue.get_nowait_batch(len(self.classified_queue))
+            if batch:
+                await loop.run_in_executor(self._db_executor, self._persist_batch, batch)
+            if self._owns_db_executor:
+                await loop.run_in_executor(self._db_executor, self._writer.close)
+                self._db_executor.shutdown(wait=True)
+            else:
+                await loop.run_in_executor(self._db_executor, self._writer.flush)
@@ -0,0 +1,481 @@
+"""Streaming replay of the persisted books.
+
+the books of the instruments are rebuilt from their orderbook_snapshots and orderbook_level_overrides
+rows: for every instrument, the last snapshot at or before `start` (the first one after it if there
+is none), its overrides in external_time order, then every later snapshot up to `end` with its own
+overrides. rows are streamed `chunk_rows` at a time (`yield_per`: a server-side cursor on
+postgresql), and the streams of the instruments are k-way merged by external_time with a heap
+(`heapq.merge`), so memory holds one chunk per instrument whatever the time range.
+
+    instruments = [("coinbase", "BTC-USD"), ("kraken", "BTC-USD")]
+    for book, update in replay_events(engine, instruments, start, end):
+        ...
+
+yields `(book, update)` once the update is applied to the book, a LiveBook (see live_books.py), or
+with `l2_books` a `ReplayBook`: the L2Book and the metadata of a LiveBook, built straight from the
+packed level arrays of the rows (level_codec.decode_levels) and from the JSON levels of the rows
+without one, never keeping a venue string per level. updates before `start` only bring the books up
+to date and are not yielded. `replay` hands the events to consumers instead, callables
+`consumer(book, update)` with an optional `close()`, e.g. a `VwapReplayConsumer` writing the VWAP
+ladder of the books every `interval_seconds` of external time.
+
+writes the vwap_snapshots rows of a time range. run from this directory:
+    python replay.py [--database-url URL] [--start 2023-12-27T16:00:00] [--end ...]
+    [--pair coinbase:BTC-USD ...] [--every 1]
+"""
+import argparse
+import heapq
+import logging
+from datetime import datetime
+
+import numpy as np
+from config import (
+    DATABASE_URL,
+    LIVE_BOOK_L2_CAPACITY,
+    VWAP_DEPTHS_USD,
+    REPLAY_CHUNK_ROWS,
+    REPLAY_VWAP_EVERY_X_SECONDS,
+)
+from database import get_engine
+from fast_decode import json_loads
+from instruments import REGISTRY
+from l2_book import L2Book
+from level_codec import BID, LEVEL_COLUMNS, decode_levels, decode_levels_to_strings
+from live_books import LiveBook, l2_capacity
+from models import LatestOrderbookSnapshot, OrderbookLevelOverride, OrderbookSnapshot, VwapSnapshot
+from sinks import make_sink
+from snapper import vwap_row
+from sqlalchemy import select
+from ticks import significant_decimals, to_ticks
+from timestamps import NS_PER_SECOND, datetime_to_ns
+from vwap import VwapCache
+from vwap_store import pack_floats
+from writer import BatchedWriter
+
+SNAPSHOT = "snapshot"
+OVERRIDE = "override"
+
+
+class BookUpdate:
+    """A snapshot (`kind` SNAPSHOT, the whole book) or override (OVERRIDE, levels to replace, size 0
+    removes) row of an instrument. its levels are the packed level array of the row (`packed`, see
+    level_codec.py), else the [[price, size], ...] venue strings of its JSON columns (`bids`/`asks`,
+    decoded from `packed` on first use). `time_ns` is the replay order: external_time_ns, else
+    received_at_ns, never earlier than the previous update"""
+
+    __slots__ = (
+        "kind",
+        "orderbook_snapshot_id",
+        "external_time_ns",
+        "received_at_ns",
+        "packed",
+        "_bids",
+        "_asks",
+        "time_ns",
+    )
+
+    def __init__(
+        self, kind, orderbook_snapshot_id, external_time_ns, received_at_ns, packed, bids, asks, time_ns
+    ):
+        self.kind = kind
+        self.orderbook_snapshot_id = orderbook_snapshot_id
+        self.external_time_ns = external_time_ns
+        self.received_at_ns = received_at_ns
+        self.packed = packed
+        self._bids = bids
+        self._asks = asks
+        self.time_ns = time_ns
+
+    @property
+    def bids(self):
+        if self._bids is None:
+            self._bids, self._asks = decode_levels_to_strings(self.packed)
+        return self._bids
+
+    @property
+    def asks(self):
+        if self._asks is None:
+            self._bids, self._asks = decode_levels_to_strings(self.packed)
+        return self._asks
+
+
+def _row_levels(row, model):
+    """(packed, bids, asks) of a row of `model`: its packed level array if it has one, else the
+    levels of its JSON columns"""
+
+    bids_column, asks_column, packed_column = LEVEL_COLUMNS[model]
+    mapping = row._mapping
+    if mapping[packed_column] is not None:
+        return mapping[packed_column], None, None
+    return None, json_loads(mapping[bids_column]), json_loads(mapping[asks_column])
+
+
+def _row_time_ns(row):
+    """(external_time_ns, received_at_ns) of a row, from the datetime columns for rows written
+    without the epoch ns ones"""
+
+    external_time_ns = row.external_time_ns
+    if external_time_ns is None and row.external_time is not None:
+        external_time_ns = datetime_to_ns(row.external_time)
+    received_at_ns = row.received_at_ns
+    if received_at_ns is None and row.received_at is not None:
+        received_at_ns = datetime_to_ns(row.received_at)
+    return external_time_ns, received_at_ns
+
+
+def snapshot_chain(conn, provider, internal_pair, start=None, end=None):
+    """ids of the snapshots the replay of an instrument goes through, in external_time order: the
+    last one at or before `start`, then every one up to `end`"""
+
+    table = OrderbookSnapshot.__table__
+    base, counter = internal_pair.split("-")
+    instrument = (table.c.provider == provider) & (table.c.base == base) & (table.c.counter == counter)
+    snapshot_ids = []
+    statement = select(table.c.id).where(instrument)
+    if start is not None:
+        first = conn.execute(
+            select(table.c.id)
+            .where(instrument & (table.c.external_time <= start))
+            .order_by(table.c.external_time.desc(), table.c.id.desc())
+            .limit(1)
+        ).first()
+        if first is not None:
+            snapshot_ids.append(first.id)
+        statement = statement.where(table.c.external_time > start)
+    if end is not None:
+        statement = statement.where(table.c.external_time <= end)
+    snapshot_ids += conn.execute(statement.order_by(table.c.external_time, table.c.id)).scalars().all()
+    return snapshot_ids
+
+
+def instrument_updates(
+    conn, provider, internal_pair, start=None, end=None, chunk_rows=REPLAY_CHUNK_ROWS, snapshot_ids=None
+):
+    """BookUpdates of an instrument in replay order, overrides streamed `chunk_rows` at a time.
+    `snapshot_ids` replays those snapshots (and their overrides up to `end`) instead of the chain"""
+
+    snapshots_table = OrderbookSnapshot.__table__
+    overrides_table = OrderbookLevelOverride.__table__
+    time_columns = ("external_time", "external_time_ns", "received_at", "received_at_ns")
+    snapshot_columns = [
+        snapshots_table.c[name] for name in ("id", "bids", "asks", "levels_packed") + time_columns
+    ]
+    override_columns = [
+        overrides_table.c[name]
+        for name in ("bids_overrides", "asks_overrides", "overrides_packed") + time_columns
+    ]
+    time_ns = None
+    if snapshot_ids is None:
+        snapshot_ids = snapshot_chain(conn, provider, internal_pair, start, end)
+    for snapshot_id in snapshot_ids:
+        row = conn.execute(select(*snapshot_columns).where(snapshots_table.c.id == snapshot_id)).first()
+        packed, bids, asks = _row_levels(row, OrderbookSnapshot)
+        external_time_ns, received_at_ns = _row_time_ns(row)
+        time_ns = _next_time_ns(time_ns, external_time_ns, received_at_ns)
+        yield BookUpdate(SNAPSHOT, snapshot_id, external_time_ns, received_at_ns, packed, bids, asks, time_ns)
+
+        statement = select(*override_columns).where(overrides_table.c.orderbook_snapshot_id == snapshot_id)
+        if end is not None:
+            statement = statement.where(overrides_table.c.external_time <= end)
+        statement = statement.order_by(overrides_table.c.external_time, overrides_table.c.id)
+        for row in conn.execute(statement.execution_options(yield_per=chunk_rows)):
+            packed, bids, asks = _row_levels(row, OrderbookLevelOverride)
+            external_time_ns, received_at_ns = _row_time_ns(row)
+            time_ns = _next_time_ns(time_ns, external_time_ns, received_at_ns)
+            yield BookUpdate(
+                OVERRIDE, snapshot_id, external_time_ns, received_at_ns, packed, bids, asks, time_ns
+            )
+
+
+def _next_time_ns(previous_time_ns, external_time_ns, received_at_ns):
+    time_ns = external_time_ns if external_time_ns is not None else received_at_ns
+    if time_ns is None or (previous_time_ns is not None and time_ns < previous_time_ns):
+        return previous_time_ns if previous_time_ns is not None else 0
+    return time_ns
+
+
+def apply_update(book, update):
+    if update.kind == SNAPSHOT:
+        book.apply_snapshot(
+            update.bids,
+            update.asks,
+            update.orderbook_snapshot_id,
+            update.external_time_ns,
+            update.received_at_ns,
+        )
+    else:
+        book.apply_overrides(update.bids, update.asks, update.external_time_ns, update.received_at_ns)
+
+
+def _grid_decimals(price_ticks, price_scale, price_decimals):
+    """fewest decimals, at least `price_decimals`, of a tick grid the prices (int ticks at
+    `price_scale`) are all on"""
+
+    while price_decimals < price_scale:
+        factor = 10 ** (price_scale - price_decimals)
+        if not any(ticks % factor for ticks in price_ticks):
+            break
+        price_decimals += 1
+    return price_decimals
+
+
+class ReplayBook:
+    """Book of a replay with `l2_books`: what the VWAP consumers read of a LiveBook (its L2Book and
+    metadata, see snapper.vwap_row), built from the int price and size ticks of the packed level
+    arrays (the venue strings of rows without one) without keeping a venue string per level. a price
+    finer than the tick grid of the book moves it to a finer grid (logged, like LiveBook.price_key)"""
+
+    __slots__ = (
+        "provider",
+        "internal_pair",
+        "price_decimals",
+        "price_decimals_from_snapshot",
+        "orderbook_snapshot_id",
+        "external_time_ns",
+        "received_at_ns",
+        "version",
+        "l2_book",
+    )
+
+    def __init__(self, provider, internal_pair):
+        instrument = REGISTRY.from_internal(provider, internal_pair)
+        self.provider = provider
+        self.internal_pair = internal_pair
+        self.price_decimals = instrument.price_decimals
+        self.price_decimals_from_snapshot = not instrument.listed  # see LiveBook
+        self.orderbook_snapshot_id = None
+        self.external_time_ns = None
+        self.received_at_ns = None
+        self.version = 0
+        self.l2_book = None
+
+    def _rescale(self, price_decimals):
+        logging.warning(
+            f"{self.provider} {self.internal_pair} prices finer than {self.price_decimals} decimals. "
+            f"book rescaled to {price_decimals} decimals"
+        )
+        old_book, scale = self.l2_book, 10 ** (price_decimals - self.price_decimals)
+        self.price_decimals = price_decimals
+        if old_book is None:
+            return
+        self.l2_book = L2Book(10.0**-price_decimals, old_book.capacity)
+        for side in ("bid", "ask"):
+            levels = old_book.levels(side)
+            ticks = np.rint(levels[:, 0] / old_book.tick_size).astype(np.int64) * scale
+            for tick, size in zip(ticks.tolist(), levels[:, 1].tolist()):
+                self.l2_book.apply_tick_update(side, size, tick)
+
+    def _record_levels(self, records, price_scale, size_scale, first_snapshot):
+        """(is_bid, tick, size) lists of packed levels (level_codec.decode_levels records)"""
+
+        levels = records.tolist()  # [(side, price ticks, size ticks), ...]
+        prices = [level[1] for level in levels]
+        if first_snapshot and prices:
+            self.price_decimals = _grid_decimals(prices, price_scale, 0)
+        price_decimals = _grid_decimals(prices, price_scale, self.price_decimals)
+        if price_decimals > self.price_decimals:
+            self._rescale(price_decimals)
+        if price_scale >= price_decimals:
+            factor = 10 ** (price_scale - price_decimals)
+            ticks = [price // factor for price in prices]
+        else:
+            factor = 10 ** (price_decimals - price_scale)
+            ticks = [price * factor for price in prices]
+        size_unit = 10.0**size_scale
+        return [level[0] == BID for level in levels], ticks, [level[2] / size_unit for level in levels]
+
+    def _string_levels(self, bids, asks, first_snapshot):
+        """(is_bid, tick, size) lists of [price, size] venue string levels"""
+
+        levels = bids + asks
+        if first_snapshot and levels:
+            self.price_decimals = max(significant_decimals(level[0]) for level in levels)
+        try:
+            ticks = [to_ticks(level[0], self.price_decimals) for level in levels]
+        except ValueError:
+            self._rescale(max(significant_decimals(level[0]) for level in levels))
+            ticks = [to_ticks(level[0], self.price_decimals) for level in levels]
+        return [True] * len(bids) + [False] * len(asks), ticks, [float(level[1]) for level in levels]
+
+    def apply_update(self, update):
+        first_snapshot = update.kind == SNAPSHOT and self.price_decimals_from_snapshot
+        if first_snapshot:
+            self.price_decimals_from_snapshot = False
+        if update.packed is not None:
+            is_bid, ticks, sizes = self._record_levels(*decode_levels(update.packed), first_snapshot)
+        else:
+            is_bid, ticks, sizes = self._string_levels(update.bids, update.asks, first_snapshot)
+        if update.kind == SNAPSHOT:
+            self._reset_l2_book(is_bid, ticks)
+            for is_bid_level, tick, size in zip(is_bid, ticks, sizes):
+                if size:
+                    self.l2_book.apply_tick_update("bid" if is_bid_level else "ask", size, tick)
+            self.orderbook_snapshot_id = update.orderbook_snapshot_id
+            self.external_time_ns = update.external_time_ns
+            self.received_at_ns = update.received_at_ns
+        else:
+            for is_bid_level, tick, size in zip(is_bid, ticks, sizes):
+                try:
+                    self.l2_book.apply_tick_update("bid" if is_bid_level else "ask", size, tick)
+                except KeyError:
+                    pass  # removal of a level the book does not have
+            if update.external_time_ns is not None:
+                self.external_time_ns = update.external_time_ns
+            if update.received_at_ns is not None:
+                self.received_at_ns = update.received_at_ns
+        self.version += 1
+
+    def _reset_l2_book(self, is_bid, ticks):
+        """empty L2Book for a snapshot of `ticks`, sized like LiveBook.keep_l2_book sizes it"""
+
+        capacity = LIVE_BOOK_L2_CAPACITY if self.l2_book is None else self.l2_book.capacity
+        bid_ticks = [tick for is_bid_level, tick in zip(is_bid, ticks) if is_bid_level]
+        ask_ticks = [tick for is_bid_level, tick in zip(is_bid, ticks) if not is_bid_level]
+        if bid_ticks and ask_ticks:
+            capacity = l2_capacity(max(bid_ticks), min(ask_ticks), capacity)
+        tick_size = 10.0**-self.price_decimals
+        l2_book = self.l2_book
+        if l2_book is not None and l2_book.tick_size == tick_size and l2_book.capacity == capacity:
+            l2_book.clear()
+        else:
+            self.l2_book = L2Book(tick_size, capacity)
+
+
+def instrument_events(
+    conn,
+    provider,
+    internal_pair,
+    start=None,
+    end=None,
+    chunk_rows=REPLAY_CHUNK_ROWS,
+    l2_books=False,
+    snapshot_ids=None,
+):
+    """(book, update) events of one instrument, see replay_events and instrument_updates"""
+
+    book = ReplayBook(provider, internal_pair) if l2_books else LiveBook(provider, internal_pair)
+    start_ns = None if start is None else datetime_to_ns(start)
+    for update in instrument_updates(conn, provider, internal_pair, start, end, chunk_rows, snapshot_ids):
+        if l2_books:
+            book.apply_update(update)
+        else:
+            apply_update(book, update)
+        if start_ns is None or update.time_ns >= start_ns:
+            yield book, update
+
+
+def replay_events(engine, instruments, start=None, end=None, chunk_rows=REPLAY_CHUNK_ROWS, l2_books=False):
+    """(book, update) of every update of the instruments ((provider, internal pair) pairs) between
+    `start` and `end` (naive UTC datetimes, None for no bound) in time order, each book being the
+    LiveBook (ReplayBook with `l2_books`) the update was applied to"""
+
+    with engine.connect() as conn:
+        streams = [
+            instrument_events(conn, provider, internal_pair, start, end, chunk_rows, l2_books)
+            for provider, internal_pair in instruments
+        ]
+        yield from heapq.merge(*streams, key=lambda event: event[1].time_ns)
+
+
+def replay(
+    engine, instruments, consumers, start=None, end=None, chunk_rows=REPLAY_CHUNK_ROWS, l2_books=True
+):
+    """Hands every replay_events event to every consumer, then closes the consumers. returns the
+    number of updates replayed"""
+
+    updates_count = 0
+    try:
+        for book, update in replay_events(engine, instruments, start, end, chunk_rows, l2_books):
+            for consumer in consumers:
+                consumer(book, update)
+            updates_count += 1
+    finally:
+        for consumer in consumers:
+            close = getattr(consumer, "close", None)
+            if close is not None:
+                close()
+    return updates_count
+
+
+class _ReplayBookState:
+    __slots__ = ("l2_book", "cache", "snapped_at_ns")
+
+    def __init__(self):
+        self.l2_book = None  # the L2Book `cache` consumes the take_dirty() of
+        self.cache = None
+        self.snapped_at_ns = None
+
+
+class VwapReplayConsumer:
+    """Replay consumer computing the VWAP ladder of a book once at least `interval_seconds` of
+    external time passed since its last one, like the live snapper does on receive time. `emit(row)`
+    gets the vwap_snapshots rows (see snapper.vwap_row), `snapped_at_ns` being the time of the update.
+    needs the books to keep an L2Book"""
+
+    def __init__(self, emit, depths_usd=VWAP_DEPTHS_USD, interval_seconds=REPLAY_VWAP_EVERY_X_SECONDS):
+        self._emit = emit
+        self.depths_usd = np.asarray(depths_usd, dtype=np.float64)
+        self._depths_usd_packed = pack_floats(self.depths_usd)
+        self._interval_ns = int(interval_seconds * NS_PER_SECOND)
+        self._states = {}  # (provider, internal pair) -> _ReplayBookState
+        self.snaps_count = 0
+
+    def __call__(self, book, update):
+        state = self._states.get((book.provider, book.internal_pair))
+        if state is None:
+            state = self._states[(book.provider, book.internal_pair)] = _ReplayBookState()
+        if state.snapped_at_ns is not None and update.time_ns - state.snapped_at_ns < self._interval_ns:
+            return
+        if state.l2_book is not book.l2_book:  # first snap or L2Book rebuilt on a new tick grid
+            state.l2_book, state.cache = book.l2_book, VwapCache(self.depths_usd)
+        ladder = state.cache.ladder(state.l2_book)
+        self._emit(vwap_row(book, ladder, self._depths_usd_packed, update.time_ns))
+        state.snapped_at_ns = update.time_ns
+        self.snaps_count += 1
+
+
+def recorded_instruments(engine):
+    """(provider, internal pair) of every instrument with a snapshot"""
+
+    table = LatestOrderbookSnapshot.__table__
+    with engine.connect() as conn:
+        statement = select(table.c.provider, table.c.base, table.c.counter).order_by(table.c.provider)
+        return [(row.provider, f"{row.base}-{row.counter}") for row in conn.execute(statement)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    parser.add_argument("--start", type=datetime.fromisoformat, default=None, help="naive UTC datetime")
+    parser.add_argument("--end", type=datetime.fromisoformat, default=None, help="naive UTC datetime")
+    parser.add_argument("--pair", action="append", help="provider:internal pair, all instruments by default")
+    parser.add_argument(
+        "--every", type=float, default=REPLAY_VWAP_EVERY_X_SECONDS, help="seconds between VWAPs of a book"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = get_engine(args.database_url)
+    if args.pair:
+        instruments = [tuple(pair.split(":")) for pair in args.pair]
+    else:
+        instruments = recorded_instruments(engine)
+    writer = BatchedWriter(make_sink(args.database_url))
+
+    def emit(row):
+        writer.add(VwapSnapshot, row)
+        writer.maybe_flush()
+
+    consumer = VwapReplayConsumer(emit, interval_seconds=args.every)
+    try:
+        updates_count = replay(engine, instruments, [consumer], args.start, args.end)
+    finally:
+        writer.close()
+    print(
+        f"{updates_count} updates replayed for {len(instruments)} instruments. "
+        f"{consumer.snaps_count} VWAP ladders written"
+    )
+
+
+if __name__ == "__main__":
+    main()
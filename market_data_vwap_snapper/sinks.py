@@ -0,0 +1,135 @@
+"""Storage sinks the BatchedWriter writes through.
+
+a sink writes one batch (table -> list of row dicts) in a single transaction and inserts orderbook
+snapshots one by one (their id is needed straight away). the writer owns batching, retries and
+metrics, the sink only does the I/O.
+
+SqlAlchemySink: one Core executemany insert per table. any SQLAlchemy database (sqlite by default)
+PostgresCopySink: streams each table of the batch with `COPY ... FROM STDIN` on a connection of the
+    engine pool (psycopg2), skipping SQL parsing and per row round trips
+"""
+import io
+from datetime import datetime
+
+from config import DATABASE_URL, POSTGRES_USE_COPY
+from database import get_engine, upsert_latest_snapshot
+from models import OrderbookSnapshot
+from sqlalchemy import insert
+
+
+class SqlAlchemySink:
+    name = "sqlalchemy"
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    @property
+    def engine(self):
+        return self._engine
+
+    def insert_now(self, model, row):
+        """Writes a single row immediately and returns its primary key"""
+
+        with self._engine.begin() as conn:
+            result = conn.execute(insert(model.__table__), row)
+        return result.inserted_primary_key[0]
+
+    def insert_snapshot(self, row):
+        """insert_now for an orderbook snapshot. the latest snapshot of the instrument is updated in
+        the same transaction"""
+
+        with self._engine.begin() as conn:
+            result = conn.execute(insert(OrderbookSnapshot.__table__), row)
+            orderbook_snapshot_id = result.inserted_primary_key[0]
+            upsert_latest_snapshot(conn, orderbook_snapshot_id, row)
+        return orderbook_snapshot_id
+
+    def write(self, rows_by_table):
+        """Writes {table: [row dict, ...]} in one transaction"""
+
+        with self._engine.begin() as conn:
+            for table, rows in rows_by_table.items():
+                if rows:
+                    conn.execute(insert(table), rows)
+
+    def close(self):
+        pass
+
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_value(value):
+    """Text format COPY representation of a row value"""
+
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return value.translate(_COPY_ESCAPES)
+    if isinstance(value, bytes):
+        return "\\\\x" + value.hex()  # bytea hex format, the backslash is escaped for COPY
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return str(value)
+
+
+def _python_defaults(table, columns):
+    """{column name: value} of the client side defaults (e.g. created_at) missing from `columns`.
+    COPY bypasses SQLAlchemy, so they are filled in once per batch"""
+
+    defaults = {}
+    for column in table.columns:
+        default = column.default
+        if column.name in columns or default is None:
+            continue
+        if default.is_callable:
+            defaults[column.name] = default.arg(None)
+        elif default.is_scalar:
+            defaults[column.name] = default.arg
+    return defaults
+
+
+class PostgresCopySink(SqlAlchemySink):
+    name = "postgres_copy"
+
+    def __init__(self, engine):
+        if engine.dialect.name != "postgresql":
+            raise ValueError(f"PostgresCopySink needs a postgresql engine, got {engine.dialect.name}")
+        super().__init__(engine)
+
+    def write(self, rows_by_table):
+        connection = self._engine.raw_connection()  # checked out from the engine pool
+        try:
+            cursor = connection.cursor()
+            for table, rows in rows_by_table.items():
+                if rows:
+                    self._copy(cursor, table, rows)
+            cursor.close()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()  # back to the pool
+
+    @staticmethod
+    def _copy(cursor, table, rows):
+        columns = list(rows[0])
+        defaults = _python_defaults(table, columns)
+        default_values = [_copy_value(value) for value in defaults.values()]
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join([_copy_value(row[column]) for column in columns] + default_values))
+            buffer.write("\n")
+        buffer.seek(0)
+        column_list = ", ".join(columns + list(defaults))
+        cursor.copy_expert(f"COPY {table.name} ({column_list}) FROM STDIN", buffer)
+
+
+def make_sink(database_url=DATABASE_URL, use_copy=POSTGRES_USE_COPY):
+    """Sink for `database_url`: PostgresCopySink for postgresql if `use_copy`, else SqlAlchemySink"""
+
+    engine = get_engine(database_url)
+    if use_copy and engine.dialect.name == "postgresql":
+        return PostgresCopySink(engine)
+    return SqlAlchemySink(engine)
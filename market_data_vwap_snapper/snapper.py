@@ -0,0 +1,169 @@
+"""Live VWAP snapper: the VWAP_DEPTHS_USD ladder of every live book while the feeds run.
+
+the books are the LiveBooks the feed pipelines update on the DB thread (see live_books.py), each one
+mirrored in an L2Book, so the `VwapCache` of a book only recomputes its ladder when the last messages
+changed it (see vwap.py). snaps run on the DB thread too, between two batches of messages: they never
+see a half applied message and never hold up the websocket `recv()` of the event loop.
+
+    interval: `snap_periodically` snaps the books changed since their last snap every
+        SNAPPER_INTERVAL_SECONDS
+    on_change: the books changed are also snapped after every batch of messages applied, at most
+        once every SNAPPER_MIN_INTERVAL_SECONDS per book (the periodic snap picks up the rest)
+
+so a VWAP lags the message it reflects by at most the snap interval plus the DB thread queue, which
+`vwap_snap_latency_seconds` tracks (snap time - received_at of the last message of the book).
+a snap is a vwap_snapshots row (see models.VwapSnapshot) handed to the BatchedWriter of the feeds.
+"""
+import asyncio
+import logging
+
+import numpy as np
+from config import (
+    VWAP_DEPTHS_USD,
+    SNAPPER_MODE,
+    SNAPPER_INTERVAL_SECONDS,
+    SNAPPER_MIN_INTERVAL_SECONDS,
+)
+from metrics import METRICS
+from models import VwapSnapshot
+from timestamps import RECEIVE_CLOCK, NS_PER_SECOND, ns_to_datetime
+from vwap import VwapCache
+from vwap_store import pack_floats
+
+SNAPPER_MODES = ("interval", "on_change")
+
+VWAP_SNAPS = METRICS.counter("vwap_snaps_total", "VWAP ladders written", ("venue", "pair"))
+VWAP_SNAP_LATENCY_SECONDS = METRICS.histogram(
+    "vwap_snap_latency_seconds", "snap time - received_at of the last message applied to the book", ("venue",)
+)
+VWAP_CACHE_HIT_RATE = METRICS.gauge(
+    "vwap_cache_hit_rate", "share of the ladders answered without reading levels again", ("venue", "pair")
+)
+
+
+def vwap_row(book, ladder, depths_usd_packed, snapped_at_ns):
+    """vwap_snapshots row of a (2, n) VWAP ladder of a LiveBook with an L2Book"""
+
+    top_bid, top_ask = book.l2_book.bid, book.l2_book.ask
+    base, counter = book.internal_pair.split("-")
+    return {
+        "provider": book.provider,
+        "base": base,
+        "counter": counter,
+        "orderbook_snapshot_id": book.orderbook_snapshot_id,
+        "external_time": None if book.external_time_ns is None else ns_to_datetime(book.external_time_ns),
+        "external_time_ns": book.external_time_ns,
+        "received_at_ns": book.received_at_ns,
+        "snapped_at_ns": snapped_at_ns,
+        "mid_rate": None if top_bid is None or top_ask is None else (top_bid + top_ask) / 2,
+        "top_bid": top_bid,
+        "top_ask": top_ask,
+        "depths_usd_packed": depths_usd_packed,
+        "vwaps_packed": pack_floats(ladder),
+    }
+
+
+class _BookState:
+    __slots__ = ("l2_book", "cache", "version", "snapped_at_ns", "snaps", "latency_seconds")
+
+    def __init__(self, book, depths_usd):
+        self.l2_book = book.l2_book  # the cache is the only consumer of its take_dirty()
+        self.cache = VwapCache(depths_usd)
+        self.version = None  # LiveBook.version at the last snap
+        self.snapped_at_ns = 0
+        self.snaps = VWAP_SNAPS.labels(book.provider, book.internal_pair)
+        self.latency_seconds = VWAP_SNAP_LATENCY_SECONDS.labels(book.provider)
+
+
+class VwapSnapper:
+    """Writes the VWAP ladder of the books of `live_books` changed since their last snap.
+    every method must run on the thread that applies messages to the books (the DB thread)"""
+
+    def __init__(
+        self,
+        live_books,
+        writer,
+        depths_usd=VWAP_DEPTHS_USD,
+        mode=SNAPPER_MODE,
+        min_interval_seconds=SNAPPER_MIN_INTERVAL_SECONDS,
+        clock=RECEIVE_CLOCK,
+    ):
+        if mode not in SNAPPER_MODES:
+            raise ValueError(f"snapper mode must be one of {SNAPPER_MODES}, got {mode}")
+        self._live_books = live_books
+        self._writer = writer
+        self.depths_usd = np.asarray(depths_usd, dtype=np.float64)
+        self._depths_usd_packed = pack_floats(self.depths_usd)
+        self.mode = mode
+        self._min_interval_seconds = min_interval_seconds
+        self._clock = clock
+        self._states = {}  # (provider, internal pair) -> _BookState
+        self.snaps_count = 0  # For monitoring purpose
+
+        live_books.keep_l2_books()
+        if mode == "on_change":
+            live_books.add_listener(self._on_batch_applied)
+
+    def _state(self, book):
+        state = self._states.get((book.provider, book.internal_pair))
+        if state is None or state.l2_book is not book.l2_book:  # new book or L2Book rebuilt
+            state = self._states[(book.provider, book.internal_pair)] = _BookState(book, self.depths_usd)
+            VWAP_CACHE_HIT_RATE.set_callback(
+                (book.provider, book.internal_pair), lambda cache=state.cache: cache.hit_rate
+            )
+        return state
+
+    def snap(self, book, now_ns=None):
+        """Hands the vwap_snapshots row of the book to the writer and returns it"""
+
+        if now_ns is None:
+            now_ns = self._clock.now_ns()
+        state = self._state(book)
+        ladder = state.cache.ladder(book.l2_book)
+        row = vwap_row(book, ladder, self._depths_usd_packed, now_ns)
+        self._writer.add(VwapSnapshot, row)
+        state.version = book.version
+        state.snapped_at_ns = now_ns
+        state.snaps.inc()
+        if book.received_at_ns is not None:
+            state.latency_seconds.observe((now_ns - book.received_at_ns) / NS_PER_SECOND)
+        self.snaps_count += 1
+        return row
+
+    def snap_changed(self, min_interval_seconds=0):
+        """Snaps the books changed since their last snap and not snapped for `min_interval_seconds`.
+        returns the number of books snapped"""
+
+        now_ns = self._clock.now_ns()
+        min_interval_ns = int(min_interval_seconds * NS_PER_SECOND)
+        snapped = 0
+        for book in self._live_books:
+            state = self._state(book)
+            if book.version == state.version or now_ns - state.snapped_at_ns < min_interval_ns:
+                continue
+            self.snap(book, now_ns)
+            snapped += 1
+        return snapped
+
+    def _on_batch_applied(self):
+        self.snap_changed(self._min_interval_seconds)
+
+    def snap_due(self):
+        """snap_changed, then lets the writer flush on time. what `snap_periodically` runs"""
+
+        snapped = self.snap_changed()
+        self._writer.maybe_flush()
+        return snapped
+
+
+async def snap_periodically(snapper, db_executor, interval_seconds=SNAPPER_INTERVAL_SECONDS):
+    """Runs `snapper.snap_due` every `interval_seconds` on the DB thread, where the books are updated.
+    a failed snap is logged and retried on the next tick, the feeds keep running"""
+
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await loop.run_in_executor(db_executor, snapper.snap_due)
+        except Exception:
+            logging.exception("could not snap the VWAPs of the live books")
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backoff import ExponentialBackoff
+from config import (
+    DATABASE_URL,
+    SUPERVISOR_VENUE_PAIRS,
+    SUPERVISOR_STABLE_RUN_SECONDS,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    CHECKPOINT_ENABLED,
+    CHECKPOINT_PATH,
+    SNAPPER_ENABLED,
+)
+from sinks import make_sink
+from writer import BatchedWriter
+from metrics import METRICS, monitor_event_loop_lag, start_metrics_server
+from checkpoint import checkpoint_periodically, restore_live_books, write_checkpoint
+from live_books import LiveBooks
+from snapper import VwapSnapper, snap_periodically
+from coinbase import coinbase_orderbook_download
+from kraken import kraken_orderbook_download
+from bitstamp import bitstamp_orderbook_download
+
+# venue name -> download coroutine function(pairs_internal, writer, db_executor, live_books). new venues register here
+VENUE_DOWNLOADERS = {
+    "coinbase": coinbase_orderbook_download,
+    "kraken": kraken_orderbook_download,
+    "bitstamp": bitstamp_orderbook_download,
+}
+
+SUPERVISOR_RESTARTS = METRICS.counter("supervisor_restarts_total", "venue feed restarts", ("venue",))
+
+
+async def supervise_venue(venue, pairs_internal, writer, db_executor, live_books=None):
+    """Runs one venue feed forever. a failed feed is restarted on its own after an exponential backoff,
+    the other venues keep running. `live_books` outlive the restarts"""
+
+    download = VENUE_DOWNLOADERS[venue]
+    backoff = ExponentialBackoff()
+    restarts_count = 0
+    restarts = SUPERVISOR_RESTARTS.labels(venue)
+    while True:
+        started_at = time.monotonic()
+        try:
+            logging.info(f"starting {venue} feed for {pairs_internal}")
+            await download(pairs_internal, writer=writer, db_executor=db_executor, live_books=live_books)
+            logging.warning(f"{venue} feed stopped without errors")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception(f"{venue} feed failed")
+
+        if time.monotonic() - started_at >= SUPERVISOR_STABLE_RUN_SECONDS:
+            backoff.reset()
+        delay = backoff.next_delay()
+        restarts_count += 1
+        restarts.inc()
+        logging.warning(f"restarting {venue} feed in {delay:.1f}s. restart #{restarts_count}")
+        await asyncio.sleep(delay)
+
+
+async def run_supervisor(
+    venue_pairs=SUPERVISOR_VENUE_PAIRS,
+    database_url=DATABASE_URL,
+    metrics_enabled=METRICS_ENABLED,
+    checkpoint_path=CHECKPOINT_PATH if CHECKPOINT_ENABLED else None,
+    snapper_enabled=SNAPPER_ENABLED,
+):
+    """Runs every venue of `venue_pairs` (venue -> list of internal pairs) in this event loop.
+    all feeds share one sink, one BatchedWriter and the single DB thread that drives it.
+    with `metrics_enabled` the metrics endpoint and the event loop lag monitor run alongside.
+    with a `checkpoint_path` the feeds keep live books, restored from the checkpoint on startup,
+    checkpointed periodically and once more on exit.
+    with `snapper_enabled` the feeds keep live books (restored from the checkpoint if there is one) and
+    a VwapSnapper writes their VWAP ladders through the same writer (see snapper.py)"""
+
+    unknown_venues = set(venue_pairs) - set(VENUE_DOWNLOADERS)
+    if unknown_venues:
+        raise ValueError(f"Non implemented error. no downloader for venues {sorted(unknown_venues)}")
+
+    sink = make_sink(database_url)
+    writer = BatchedWriter(sink)
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+    loop = asyncio.get_running_loop()
+    live_books = None
+    if checkpoint_path is not None:
+        live_books = await loop.run_in_executor(db_executor, restore_live_books, checkpoint_path, sink.engine)
+    snapper = None
+    if snapper_enabled:
+        if live_books is None:
+            live_books = LiveBooks()
+        # the L2Book mirrors of the books are built on the DB thread, like every book update
+        snapper = await loop.run_in_executor(db_executor, VwapSnapper, live_books, writer)
+    tasks = [
+        asyncio.create_task(
+            supervise_venue(venue, pairs_internal, writer, db_executor, live_books), name=f"supervise-{venue}"
+        )
+        for venue, pairs_internal in venue_pairs.items()
+        if pairs_internal
+    ]
+    if checkpoint_path is not None:
+        tasks.append(
+            asyncio.create_task(
+                checkpoint_periodically(live_books, checkpoint_path, db_executor, writer, sink.engine),
+                name="checkpoint",
+            )
+        )
+    if snapper is not None:
+        tasks.append(asyncio.create_task(snap_periodically(snapper, db_executor), name="vwap-snapper"))
+    metrics_server = None
+    if metrics_enabled:
+        metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        tasks.append(asyncio.create_task(monitor_event_loop_lag(), name="event-loop-lag"))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+        if snapper is not None:
+            await loop.run_in_executor(db_executor, snapper.snap_changed)
+        await loop.run_in_executor(db_executor, writer.close)
+        if checkpoint_path is not None:
+            await loop.run_in_executor(
+                db_executor, write_checkpoint, live_books, checkpoint_path, writer, sink.engine
+            )
+        db_executor.shutdown(wait=True)
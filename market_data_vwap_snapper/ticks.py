@@ -0,0 +1,65 @@
+"""Fixed-point integer representation of venue prices and sizes.
+
+a price (size) is held as an int number of ticks (lots) at a decimal scale: '41000.5' at scale 2 is
+4100050. parsing never goes through float, so equal decimal strings always give the same int key
+('41000.5', '41000.50' -> 4100050) and `ticks_to_str` gives the exact decimal back. the scale of an
+instrument is its number of price (size) decimals, see `Instrument.price_decimals`/`size_decimals`.
+
+no intra-package imports: usable from the feeds and the storage code alike.
+"""
+from decimal import Decimal
+
+MAX_SCALE = 18  # 10**18 ticks still fit an int64 for values < 9.2
+
+
+def decimals(value):
+    """Number of decimals of a venue decimal string, trailing zeros included"""
+
+    dot_idx = value.find(".")
+    return 0 if dot_idx == -1 else len(value) - dot_idx - 1
+
+
+def significant_decimals(value):
+    """Number of decimals of a venue decimal string once trailing zeros are dropped"""
+
+    if "e" in value or "E" in value:
+        return max(0, -Decimal(value).normalize().as_tuple().exponent)
+    dot_idx = value.find(".")
+    if dot_idx == -1:
+        return 0
+    return len(value.rstrip("0")) - dot_idx - 1
+
+
+def to_ticks(value, scale):
+    """'41000.5', 2 -> 4100050 without going through float. ValueError if the value has non zero
+    digits beyond `scale` decimals"""
+
+    whole, _, fraction = value.partition(".")
+    if len(fraction) == scale:  # the venue string form of the instrument: no padding, no copy
+        return int(whole + fraction)
+    if "e" in value or "E" in value:
+        ticks = Decimal(value).scaleb(scale)
+        if ticks != ticks.to_integral_value():
+            raise ValueError(f"{value} has more than {scale} decimals")
+        return int(ticks)
+    if len(fraction) > scale:
+        if fraction[scale:].strip("0"):
+            raise ValueError(f"{value} has more than {scale} decimals")
+        fraction = fraction[:scale]
+    return int(whole + fraction.ljust(scale, "0"))
+
+
+def ticks_to_str(ticks, scale):
+    """4100050, 2 -> '41000.50', the decimal string of `scale` decimals"""
+
+    if scale == 0:
+        return str(ticks)
+    sign = "-" if ticks < 0 else ""
+    whole, fraction = divmod(abs(ticks), 10**scale)
+    return f"{sign}{whole}.{fraction:0{scale}d}"
+
+
+def rescale(ticks, scale, new_scale):
+    """Ticks at `scale` as ticks at a finer `new_scale`"""
+
+    return ticks * 10 ** (new_scale - scale)
@@ -0,0 +1,100 @@
+"""Integer UTC epoch-nanosecond timestamps.
+
+venue times are parsed straight into int nanoseconds (no float rounding, no datetime objects on the
+hot path) and receive times come from a monotonic clock anchored to the wall clock once at startup,
+so they never jump backwards when NTP adjusts the system time.
+"""
+import time
+from datetime import datetime, timedelta
+
+import dateutil.parser
+from config import STORE_EPOCH_NS
+
+NS_PER_SECOND = 1_000_000_000
+NS_PER_MICROSECOND = 1_000
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_DAYS_SINCE_EPOCH = {}  # 'YYYY-MM-DD' -> days since epoch
+
+
+class ReceiveClock:
+    """Wall clock in epoch ns derived from time.monotonic_ns()"""
+
+    def __init__(self):
+        self._anchor_ns = time.time_ns() - time.monotonic_ns()
+
+    def now_ns(self):
+        return time.monotonic_ns() + self._anchor_ns
+
+    def reanchor(self):
+        """Re-reads the wall clock, e.g. after a known clock correction"""
+
+        self._anchor_ns = time.time_ns() - time.monotonic_ns()
+
+
+RECEIVE_CLOCK = ReceiveClock()
+
+
+def ns_to_datetime(epoch_ns):
+    """Naive UTC datetime (microsecond precision) of an epoch ns timestamp"""
+
+    return _EPOCH + timedelta(microseconds=epoch_ns // NS_PER_MICROSECOND)
+
+
+def datetime_to_ns(value):
+    """Epoch ns of a datetime. naive datetimes are taken as UTC"""
+
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    delta = value - _EPOCH
+    return (delta.days * 86_400 + delta.seconds) * NS_PER_SECOND + delta.microseconds * NS_PER_MICROSECOND
+
+
+def _fraction_to_ns(fraction):
+    """'337123' (digits after the decimal point) -> 337123000"""
+
+    return int(fraction[:9].ljust(9, "0")) if fraction else 0
+
+
+def seconds_str_to_ns(seconds):
+    """'1534614248.456738' -> 1534614248456738000 without going through float"""
+
+    whole, _, fraction = seconds.partition(".")
+    return int(whole) * NS_PER_SECOND + _fraction_to_ns(fraction)
+
+
+def microseconds_str_to_ns(microseconds):
+    """bitstamp 'microtimestamp' -> epoch ns"""
+
+    return int(microseconds) * NS_PER_MICROSECOND
+
+
+def iso8601_to_ns(value):
+    """Epoch ns of an ISO-8601 UTC time.
+    fast path for the 'YYYY-MM-DDTHH:MM:SS[.fff...]Z' form coinbase sends, anything else
+    (offsets, missing 'Z', ...) goes through dateutil"""
+
+    if len(value) >= 20 and value[-1] == "Z" and value[4] == "-" and value[10] == "T":
+        try:
+            date = value[:10]
+            days = _DAYS_SINCE_EPOCH.get(date)
+            if days is None:  # once per calendar day
+                days = _DAYS_SINCE_EPOCH[date] = (
+                    datetime(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal() - _EPOCH_ORDINAL
+                )
+            seconds = days * 86_400 + int(value[11:13]) * 3_600 + int(value[14:16]) * 60 + int(value[17:19])
+            return seconds * NS_PER_SECOND + _fraction_to_ns(value[20:-1])
+        except ValueError:
+            pass
+    return datetime_to_ns(dateutil.parser.isoparse(value))
+
+
+def epoch_ns_columns(msg_classified):
+    """external_time_ns/received_at_ns row values of a classified message. empty if STORE_EPOCH_NS is off"""
+
+    if not STORE_EPOCH_NS:
+        return {}
+    return {
+        "external_time_ns": msg_classified.get("external_time_ns"),
+        "received_at_ns": msg_classified.get("received_at_ns"),
+    }
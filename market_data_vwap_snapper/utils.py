@@ -1,7 +1,7 @@
-import inspect
 import json
 import os
 import sqlite3
+import sys
 import psycopg2
 import requests
 from cachetools import LRUCache
@@ -43,10 +43,8 @@ def local_param(param_name: str):
     """
 
     try:
-        current_frame = inspect.currentframe()
-        if current_frame is None:
-            raise ValueError("Caller doesn't have frame info")
-        calling_function_filepath = inspect.getframeinfo(current_frame.f_back).filename  # type: ignore[arg-type]
+        # only the file name of the caller is needed. inspect.getframeinfo would also read its source lines
+        calling_function_filepath = sys._getframe(1).f_code.co_filename
     except BaseException as e:
         raise ValueError("Caller as not defined in a file") from e
 
@@ -117,6 +115,18 @@ def to_external_pair(pair_internal: str, external_provider_name: str) -> str:
         )
 
 
+_BITSTAMP_SYMBOL_TO_NAME_MAP = {}
+
+
+def _bitstamp_symbol_to_name_map():
+    """url_symbol -> name of bitstamp_trading_pairs.json, built on first use"""
+    if not _BITSTAMP_SYMBOL_TO_NAME_MAP:
+        _BITSTAMP_SYMBOL_TO_NAME_MAP.update(
+            {pair_info['url_symbol']:pair_info['name'] for pair_info in local_param('bitstamp_trading_pairs')}
+        )
+    return _BITSTAMP_SYMBOL_TO_NAME_MAP
+
+
 def to_internal_pair(pair_external: str, external_provider_name: str) -> str:
     """converts from external to internal pair string
 
@@ -135,8 +145,7 @@ def to_internal_pair(pair_external: str, external_provider_name: str) -> str:
         """
         bitstamp pairs do not have any separator. last 3 chars is the counter
         """
-        bitstamp_trading_pairs_symbol_to_name_map = {pair_info['url_symbol']:pair_info['name'] for pair_info in local_param('bitstamp_trading_pairs')}
-        pair_name = bitstamp_trading_pairs_symbol_to_name_map.get(pair_external,pair_external).upper()
+        pair_name = _bitstamp_symbol_to_name_map().get(pair_external,pair_external).upper()
         external_base,external_counter = pair_name.split('/')
         internal_base, internal_counter = decode_asset('bitstamp',external_base), decode_asset('bitstamp',external_counter)
         return f"{internal_base}-{internal_counter}"
@@ -0,0 +1,421 @@
+"""Vectorised VWAP depth ladder.
+
+the VWAP of a depth is the average price paid to fill that size walking the book from the best
+level, the last level only partially. for a whole ladder of depths both sides of the book go into one
+zero padded [bid size, bid notional, ask size, ask notional] array, so a single `np.cumsum` gives the
+cumulative size and notional of every level of both sides, and a single `np.searchsorted` finds the
+level completing every depth: ask depths are searched offset by the total bid size, past the bid
+levels. the VWAPs themselves are computed from the cumulative sums of their own side, so the offset
+costs no precision.
+
+a depth the side can not fill is NaN, like the notebook `get_vwap`.
+
+`batch_vwap_ladders` does the same for many books in one go: their top levels are packed into
+zero padded (2 * books, levels) arrays, one row per book side, and the ladders of every book come
+out of one cumsum and one searchsorted as well. each row is searched offset by its index, with its
+cumulative sizes normalised by the side total, so every search stays in its own row.
+
+`VwapCache` keeps the ladder of an L2Book between calls. it sums only the non empty levels of each
+side, read with `L2Book.levels_from` as deep as the largest depth needs (past the L2Book window if
+it must). with the shallowest level changed on each side since the last call (`L2Book.take_dirty`)
+it skips a side whose changes are all deeper than the levels its depths consumed, answers a mid move
+from the cumulative sums it has if their levels did not change, and reads the side again otherwise.
+
+no intra-package imports: usable from the feeds (`from vwap import vwap_ladder`) and from the
+notebooks (`from market_data_vwap_snapper.vwap import vwap_ladder`).
+"""
+import numpy as np
+
+BID = 0  # rows of a ladder
+ASK = 1
+
+
+def _as_levels(levels):
+    return np.asarray(levels, dtype=np.float64).reshape(-1, 2)
+
+
+def vwap_ladder(bids, asks, depths, out=None, price_scale=0, size_scale=0):
+    """(2, len(depths)) array of the bid (row BID) and ask (row ASK) VWAP of every depth.
+
+    bids/asks are (n, 2) [price, size] arrays (or lists), best level first. empty price levels
+    (size 0 rows of an L2Book view) are fine. `depths` are in base currency. `out` is filled in place
+    if given. int [ticks, lots] levels (see ticks.py) are taken with their price / size scales"""
+
+    bids, asks = _as_levels(bids), _as_levels(asks)
+    depths = np.asarray(depths, dtype=np.float64)
+    if out is None:
+        out = np.empty((2, depths.size))
+    n_bids, n_asks = len(bids), len(asks)
+    if n_bids + n_asks == 0:
+        out.fill(np.nan)
+        return out
+    if size_scale:
+        depths = depths * 10.0**size_scale
+
+    # rows [bid size, bid notional, ask size, ask notional], cumulated over the levels. column 0 is
+    # the empty prefix, the shorter side is padded with empty levels
+    n_columns = max(n_bids, n_asks) + 1
+    cumulative = np.zeros((4, n_columns))
+    prices = np.zeros((2, n_columns))
+    prices[BID, 1 : n_bids + 1] = bids[:, 0]
+    prices[ASK, 1 : n_asks + 1] = asks[:, 0]
+    cumulative[0, 1 : n_bids + 1] = bids[:, 1]
+    cumulative[2, 1 : n_asks + 1] = asks[:, 1]
+    cumulative[1::2] = prices * cumulative[0::2]
+    np.cumsum(cumulative, axis=1, out=cumulative)
+
+    n_depths = depths.size
+    bid_total_size = cumulative[0, -1]
+    # the level completing a depth is the first one whose cumulative size reaches it. one search for
+    # both sides: the ask sizes are searched offset by the total bid size, past the bid columns
+    search = cumulative[0::2].copy()
+    search[ASK] += bid_total_size
+    all_depths = np.concatenate((depths, depths + bid_total_size))
+    columns = np.searchsorted(search.ravel(), all_depths, side="left")
+    all_depths[n_depths:] = depths
+    side_offsets = np.repeat([0, n_columns], n_depths)
+    columns -= side_offsets
+    valid = (columns < n_columns) & (all_depths > 0)
+    columns[~valid] = 1
+    # the size / notional before the completing level, plus the part of it taken
+    size_idx = 2 * side_offsets + columns - 1
+    cumulative = cumulative.ravel()
+    notional = cumulative[size_idx + n_columns] + (all_depths - cumulative[size_idx]) * prices.ravel()[
+        side_offsets + columns
+    ]
+    vwaps = np.divide(notional, all_depths, out=np.full(2 * n_depths, np.nan), where=valid)
+    if price_scale:
+        vwaps /= 10.0**price_scale
+    out[...] = vwaps.reshape(2, n_depths)
+    return out
+
+
+def vwap_ladder_usd(bids, asks, depths_usd, out=None, price_scale=0, size_scale=0):
+    """vwap_ladder of depths in counter currency (USD), converted to base currency at the mid rate.
+    all NaN if a side is empty"""
+
+    bids, asks = _as_levels(bids), _as_levels(asks)
+    depths_usd = np.asarray(depths_usd, dtype=np.float64)
+    if out is None:
+        out = np.empty((2, depths_usd.size))
+    if not len(bids) or not len(asks):
+        out.fill(np.nan)
+        return out
+    mid_rate = (bids[0, 0] + asks[0, 0]) / 2 / 10.0**price_scale
+    return vwap_ladder(bids, asks, depths_usd / mid_rate, out, price_scale, size_scale)
+
+
+def _side_vwaps(cum_size, cum_notional, prices, depths, out):
+    """Fills `out` with the VWAPs of `depths` of one side from its (n + 1) cumulative size and
+    notional. returns the deepest level used, n if a depth could not be filled"""
+
+    n_levels = len(prices)
+    if n_levels == 0:
+        out.fill(np.nan)
+        return 0
+    rows = cum_size[1:].searchsorted(depths, side="left")
+    deepest = int(rows.max()) if rows.size else 0
+    if deepest >= n_levels:
+        filled = rows < n_levels
+        rows[~filled] = 0
+    np.divide(cum_notional[rows] + (depths - cum_size[rows]) * prices[rows], depths, out=out)
+    if deepest >= n_levels:
+        out[~filled] = np.nan
+        return n_levels
+    return deepest
+
+
+def pack_books(books, max_levels, prices=None, sizes=None):
+    """(prices, sizes) (2 * len(books), max_levels + 1) arrays of the top `max_levels` levels of
+    (bids, asks) pairs: row 2 * i the bids of book i, row 2 * i + 1 its asks. column 0 is left empty
+    and missing levels are 0. pass the arrays of a previous call to reuse them"""
+
+    shape = (2 * len(books), max_levels + 1)
+    if prices is None or prices.shape != shape:
+        prices, sizes = np.zeros(shape), np.zeros(shape)
+    else:
+        prices.fill(0.0)
+        sizes.fill(0.0)
+    row = 0
+    for book_levels in books:
+        for levels in book_levels:
+            levels = _as_levels(levels)[:max_levels]
+            prices[row, 1 : len(levels) + 1] = levels[:, 0]
+            sizes[row, 1 : len(levels) + 1] = levels[:, 1]
+            row += 1
+    return prices, sizes
+
+
+def batch_vwap_ladders_packed(prices, sizes, depths_usd, out=None):
+    """(books, 2, len(depths_usd)) VWAP ladders of books packed by `pack_books`, the USD depths of
+    each book converted at its own mid rate. a book with an empty side is all NaN"""
+
+    depths_usd = np.asarray(depths_usd, dtype=np.float64)
+    n_rows, n_columns = sizes.shape
+    n_books, n_depths = n_rows // 2, depths_usd.size
+    if out is None:
+        out = np.empty((n_books, 2, n_depths))
+    if n_books == 0:
+        return out
+
+    cum_size = np.cumsum(sizes, axis=1)
+    cum_notional = np.multiply(prices, sizes)
+    np.cumsum(cum_notional, axis=1, out=cum_notional)
+    totals = cum_size[:, -1].copy()
+    totals[totals == 0] = 1.0  # empty side: every depth searches past its row
+    row_idx = np.arange(n_rows, dtype=np.float64)[:, None]
+    # row r spans [r, r + 1]: depths deeper than the side total fall in a later row
+    search = np.divide(cum_size, totals[:, None])
+    search += row_idx
+
+    with np.errstate(invalid="ignore"):
+        mid_rates = (prices[0::2, 1] + prices[1::2, 1]) / 2
+    mid_rates[(sizes[0::2, 1] == 0) | (sizes[1::2, 1] == 0)] = np.nan
+    depths = np.repeat(depths_usd[None, :] / mid_rates[:, None], 2, axis=0)  # (rows, depths)
+    targets = row_idx + depths / totals[:, None]
+    # flat index of the level completing each depth. column 0 of a row is its empty prefix
+    flat_idx = np.searchsorted(search.ravel(), targets.ravel(), side="left").reshape(n_rows, n_depths)
+    columns = flat_idx - np.arange(n_rows)[:, None] * n_columns
+    valid = (columns >= 1) & (columns < n_columns) & (depths > 0)  # NaN depths compare False
+    flat_idx[~valid] = 1
+    before = flat_idx - 1
+    notional = cum_notional.ravel()[before]
+    notional += (depths - cum_size.ravel()[before]) * prices.ravel()[flat_idx]
+    vwaps = out.reshape(n_rows, n_depths)
+    vwaps.fill(np.nan)
+    np.divide(notional, depths, out=vwaps, where=valid)
+    return out
+
+
+def batch_vwap_ladders(books, depths_usd, max_levels, out=None):
+    """(len(books), 2, len(depths_usd)) VWAP ladders (BID / ASK rows) of (bids, asks) level pairs
+    of many books, e.g. `[(l2_book.levels("bid"), l2_book.levels("ask")), ...]`. only the top
+    `max_levels` levels of a side count, as in the notebooks. same values as vwap_ladder_usd"""
+
+    prices, sizes = pack_books(books, max_levels)
+    return batch_vwap_ladders_packed(prices, sizes, depths_usd, out)
+
+
+def _cumulative(levels):
+    """(n + 1, 3) [size, notional, non empty levels] cumulated over the levels before each row of
+    (n, 2) [price, size] levels"""
+
+    out = np.zeros((len(levels) + 1, 3))
+    sums = np.column_stack((levels[:, 1], levels[:, 0] * levels[:, 1], levels[:, 1] != 0))
+    np.cumsum(sums, axis=0, out=out[1:])
+    return out
+
+
+def _level_vwaps(cumulative):
+    """VWAP of taking each row whole, -inf where nothing was taken yet"""
+
+    level_vwaps = np.full(len(cumulative) - 1, -np.inf)
+    np.divide(cumulative[1:, 1], cumulative[1:, 0], out=level_vwaps, where=cumulative[1:, 0] > 0)
+    return level_vwaps
+
+
+def _max_sizes(cumulative, prices, side, limit_prices, average, level_vwaps=None):
+    """(sizes, levels) of `max_sizes_within` from the cumulative sums of one side"""
+
+    n_levels = len(prices)
+    sign = 1.0 if side == ASK else -1.0  # bids: walk prices down, as asks walking (-price) up
+    limits = sign * np.asarray(limit_prices, dtype=np.float64)
+    if average:
+        if level_vwaps is None:
+            level_vwaps = _level_vwaps(cumulative)
+        if side == BID:
+            # _level_vwaps is -inf on the empty prefix whatever the side
+            level_vwaps = np.where(np.isinf(level_vwaps), -np.inf, -level_vwaps)
+        whole = np.searchsorted(level_vwaps, limits, side="right")  # rows taken whole
+    else:
+        whole = np.searchsorted(sign * prices, limits, side="right")
+    sizes = cumulative[whole, 0].copy()
+    levels = cumulative[whole, 2].astype(np.int64)
+    if average:
+        partial = whole < n_levels
+        rows = whole[partial]
+        price = sign * prices[rows]
+        # (notional before + (size - size before) * price) / size = limit, solved for size. a level
+        # priced at the limit (its VWAP rounded above it) is taken whole
+        with np.errstate(divide="ignore", invalid="ignore"):
+            size = (cumulative[rows, 0] * price - sign * cumulative[rows, 1]) / (price - limits[partial])
+        size = np.where(price > limits[partial], size, cumulative[rows + 1, 0])
+        taken = size > cumulative[rows, 0]
+        sizes[partial] = np.where(taken, size, cumulative[rows, 0])
+        levels[partial] += taken
+    return sizes, levels
+
+
+def slippage_limits(side, slippage_bps, reference_price):
+    """Worst prices `slippage_bps` away from `reference_price`: above it for asks (buying), below it
+    for bids (selling)"""
+
+    slippage = np.asarray(slippage_bps, dtype=np.float64) / 1e4
+    return reference_price * (1 + slippage if side == ASK else 1 - slippage)
+
+
+def max_sizes_within(levels, side, slippage_bps, reference_price, average=True):
+    """Inverse VWAP: (sizes, levels) arrays of the largest size of one side that can be traded within
+    each of `slippage_bps` of `reference_price` (the mid, or the best price of the side for slippage
+    from the top of book), and the number of non empty levels it takes.
+
+    with `average` the VWAP of the size is within the limit, the last level taken partially. without
+    it every level taken is priced within the limit (price impact), taken whole. the whole side if it
+    all fits. `levels` is a (n, 2) [price, size] array of the side, best level first"""
+
+    levels = _as_levels(levels)
+    limits = slippage_limits(side, slippage_bps, reference_price)
+    return _max_sizes(_cumulative(levels), levels[:, 0], side, limits, average)
+
+
+_READ_MARGIN = 1.25  # levels read past the largest depth, so the mid can move before reading more
+
+
+class _SideCache:
+    __slots__ = (
+        "keys",
+        "prices",
+        "sums",
+        "complete",
+        "cumulative",
+        "level_vwaps",
+        "deepest_key",
+        "stale",
+        "changed",
+    )
+
+    def __init__(self):
+        self.keys = np.zeros(0)  # ticks of the non empty levels read, best first. negated for bids
+        self.prices = np.zeros(0)
+        self.sums = np.zeros((2, 1))  # [size, notional] of the levels before each row
+        self.complete = False  # the levels read are the whole side
+        self.cumulative = None  # see _cumulative, for max_sizes. computed on first use
+        self.level_vwaps = None  # _level_vwaps of the cumulative sums, computed on first use
+        self.deepest_key = np.inf  # key of the deepest level the cached VWAPs used
+        self.stale = True  # levels changed since they were read
+        self.changed = True  # a level the cached VWAPs used (or a better one) changed
+
+    def cumulative_sums(self):
+        """the (n + 1, 3) sums of _cumulative. every level read is non empty: the count is the row"""
+
+        if self.cumulative is None:
+            counts = np.arange(self.sums.shape[1], dtype=np.float64)
+            self.cumulative = np.column_stack((self.sums[0], self.sums[1], counts))
+        return self.cumulative
+
+
+class VwapCache:
+    """vwap_ladder_usd of an L2Book, recomputed only when it can have changed. `ladder(book)` returns
+    the (2, len(depths_usd)) ladder, owned by the cache: copy it to keep it. `max_sizes(book, ...)`
+    answers inverse VWAP queries (see max_sizes_within) from the same cumulative sums.
+
+    the cache must be the only consumer of the book `take_dirty()`. `hits` counts ladders answered
+    without reading levels (unchanged levels, or only the mid moved), `misses` ladders that read a
+    side again from its best level"""
+
+    def __init__(self, depths_usd):
+        self.depths_usd = np.asarray(depths_usd, dtype=np.float64)
+        self._depths_usd = np.where(self.depths_usd > 0, self.depths_usd, np.nan)  # no VWAP of nothing
+        self._max_depth_usd = self.depths_usd.max(initial=0.0)
+        self._ladder = np.full((2, self.depths_usd.size), np.nan)
+        self._sides = [_SideCache(), _SideCache()]
+        self._mid_rate = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+    def _take_dirty(self, book):
+        """Marks the sides updated since the last call stale, and changed if a level at or above the
+        deepest one their VWAPs used was. returns the best ticks of the book"""
+
+        dirty_ticks = book.take_dirty()
+        best_ticks = (book.best_bid_tick, book.best_ask_tick)
+        for side in (BID, ASK):
+            state, dirty_tick = self._sides[side], dirty_ticks[side]
+            if best_ticks[side] is None:
+                self._sides[side] = _SideCache()
+            elif dirty_tick is not None:
+                state.stale = True
+                if (-dirty_tick if side == BID else dirty_tick) <= state.deepest_key:
+                    state.changed = True
+        return best_ticks
+
+    def _read(self, side, book, min_size):
+        """Reads the non empty levels of the side from its best one, as deep as `min_size` needs
+        (None: the whole side)"""
+
+        state = self._sides[side]
+        target = None if min_size is None else min_size * _READ_MARGIN
+        if side == ASK:
+            levels, state.complete = book.levels_from("ask", book.best_ask_tick, target)
+        else:
+            levels, state.complete = book.levels_from("bid", book.best_bid_tick, target)
+        prices = levels[:, 0]
+        sums = np.zeros((2, len(levels) + 1))  # [size, notional]
+        sums[0, 1:] = levels[:, 1]
+        np.multiply(prices, levels[:, 1], out=sums[1, 1:])
+        sums.cumsum(axis=1, out=sums)
+        state.keys = np.rint(prices / (book.tick_size if side == ASK else -book.tick_size))
+        state.prices, state.sums, state.stale = prices, sums, False
+        state.cumulative = state.level_vwaps = None
+
+    def ladder(self, book):
+        best_ticks = self._take_dirty(book)
+        if best_ticks[BID] is None or best_ticks[ASK] is None:
+            self._mid_rate = None
+            self._ladder.fill(np.nan)
+            self.misses += 1
+            return self._ladder
+
+        mid_rate = (book.bid + book.ask) / 2
+        mid_moved = mid_rate != self._mid_rate
+        depths = self._depths_usd / mid_rate
+        max_depth = self._max_depth_usd / mid_rate
+        read = False
+        for side in (BID, ASK):
+            state = self._sides[side]
+            if not mid_moved and not state.changed:
+                continue  # the VWAPs only used levels above the changed ones
+            if state.stale or not (state.complete or state.sums[0, -1] >= max_depth):
+                self._read(side, book, max_depth)
+                read = True
+            state.changed = False
+            row = _side_vwaps(state.sums[0], state.sums[1], state.prices, depths, self._ladder[side])
+            state.deepest_key = state.keys[row] if row < len(state.keys) else np.inf
+        self._mid_rate = mid_rate
+        if read:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return self._ladder
+
+    def max_sizes(self, book, side, slippage_bps, reference="mid", average=True):
+        """max_sizes_within of one side of an L2Book (BID / ASK) from the cached cumulative sums,
+        `slippage_bps` away from the mid (`reference` "mid") or from the best price of the side
+        ("top"). zero sizes if the side (or the other side, for the mid) is empty"""
+
+        best_ticks = self._take_dirty(book)
+        slippage_bps = np.asarray(slippage_bps, dtype=np.float64)
+        if best_ticks[side] is None or (reference == "mid" and None in best_ticks):
+            return np.zeros(slippage_bps.shape), np.zeros(slippage_bps.shape, dtype=np.int64)
+        state = self._sides[side]
+        if state.stale or not state.complete:
+            self._read(side, book, None)
+        if reference == "mid":
+            reference_price = (book.bid + book.ask) / 2
+        elif reference == "top":
+            reference_price = state.prices[0]
+        else:
+            raise ValueError(f"reference must be 'mid' or 'top', got {reference}")
+        cumulative = state.cumulative_sums()
+        if average and state.level_vwaps is None:
+            state.level_vwaps = _level_vwaps(cumulative)
+        limits = slippage_limits(side, slippage_bps, reference_price)
+        return _max_sizes(cumulative, state.prices, side, limits, average, state.level_vwaps)
@@ -0,0 +1,234 @@
+"""Bulk writes and reads of the vwap_snapshots table.
+
+a vwap_snapshots row (see models.VwapSnapshot) holds the whole VWAP ladder of a book at one time:
+the depths and the (2, depths) [bid VWAPs, ask VWAPs] ladder are packed little endian float64 arrays,
+so a day of one ladder a second is 86,400 rows per instrument, not 25 times as many per depth rows.
+
+`write_vwap_ladders` writes the ladders of an instrument from arrays, `VWAP_WRITER_BATCH_ROWS` rows
+per transaction through a sink (COPY on postgresql, see sinks.py). rows computed one at a time
+(snapper.py, replay.py) go through a BatchedWriter instead.
+
+`read_vwap_snapshots` streams the rows of an instrument back into a `VwapHistory` of numpy arrays:
+the packed ladders are joined and read with one `np.frombuffer`, no per depth Python objects.
+`VwapHistory.to_frame()` gives a pandas DataFrame (pandas is only imported there).
+"""
+import numpy as np
+from config import VWAP_WRITER_BATCH_ROWS, REPLAY_CHUNK_ROWS
+from models import VwapSnapshot
+from sqlalchemy import select
+from timestamps import ns_to_datetime
+
+FLOAT64 = np.dtype("<f8")
+
+
+def pack_floats(values):
+    return np.ascontiguousarray(values, dtype=FLOAT64).tobytes()
+
+
+def unpack_floats(buffer):
+    return np.frombuffer(buffer, dtype=FLOAT64)
+
+
+def _optional(values, idx):
+    """values[idx] as a Python float / int, None if there are no values or it is NaN / -1"""
+
+    if values is None:
+        return None
+    value = values[idx].item()
+    return None if value != value or value == -1 else value
+
+
+def write_vwap_ladders(
+    sink,
+    provider,
+    internal_pair,
+    snapped_at_ns,
+    ladders,
+    depths_usd,
+    external_time_ns=None,
+    mid_rates=None,
+    top_bids=None,
+    top_asks=None,
+    orderbook_snapshot_ids=None,
+    batch_rows=VWAP_WRITER_BATCH_ROWS,
+):
+    """Writes m ladders of an instrument: `snapped_at_ns` (m,) int64, `ladders` (m, 2, len(depths_usd))
+    and the optional (m,) columns (NaN / -1 for a missing value). returns the rows written"""
+
+    snapped_at_ns = np.asarray(snapped_at_ns, dtype=np.int64)
+    ladders = np.asarray(ladders, dtype=FLOAT64)
+    depths_usd_packed = pack_floats(depths_usd)
+    if ladders.shape != (snapped_at_ns.size, 2, len(depths_usd)):
+        raise ValueError(f"ladders must be ({snapped_at_ns.size}, 2, {len(depths_usd)}), got {ladders.shape}")
+    base, counter = internal_pair.split("-")
+    table = VwapSnapshot.__table__
+    rows = []
+    for idx in range(snapped_at_ns.size):
+        time_ns = _optional(external_time_ns, idx)
+        rows.append(
+            {
+                "provider": provider,
+                "base": base,
+                "counter": counter,
+                "orderbook_snapshot_id": _optional(orderbook_snapshot_ids, idx),
+                "external_time": None if time_ns is None else ns_to_datetime(time_ns),
+                "external_time_ns": time_ns,
+                "received_at_ns": None,
+                "snapped_at_ns": snapped_at_ns[idx].item(),
+                "mid_rate": _optional(mid_rates, idx),
+                "top_bid": _optional(top_bids, idx),
+                "top_ask": _optional(top_asks, idx),
+                "depths_usd_packed": depths_usd_packed,
+                "vwaps_packed": ladders[idx].tobytes(),
+            }
+        )
+        if len(rows) == batch_rows:
+            sink.write({table: rows})
+            rows = []
+    if rows:
+        sink.write({table: rows})
+    return snapped_at_ns.size
+
+
+class VwapHistory:
+    """VWAP ladders of one instrument in time order. `vwaps` is (m, 2, len(depths_usd)): row BID (0)
+    / ASK (1) of every ladder, NaN where the book could not fill the depth. the other arrays are
+    (m,), NaN / -1 where the row has no value"""
+
+    __slots__ = (
+        "provider",
+        "internal_pair",
+        "depths_usd",
+        "vwaps",
+        "snapped_at_ns",
+        "external_time_ns",
+        "mid_rate",
+        "top_bid",
+        "top_ask",
+        "orderbook_snapshot_id",
+    )
+
+    def __init__(
+        self,
+        provider,
+        internal_pair,
+        depths_usd,
+        vwaps,
+        snapped_at_ns,
+        external_time_ns,
+        mid_rate,
+        top_bid,
+        top_ask,
+        orderbook_snapshot_id,
+    ):
+        self.provider = provider
+        self.internal_pair = internal_pair
+        self.depths_usd = depths_usd
+        self.vwaps = vwaps
+        self.snapped_at_ns = snapped_at_ns
+        self.external_time_ns = external_time_ns
+        self.mid_rate = mid_rate
+        self.top_bid = top_bid
+        self.top_ask = top_ask
+        self.orderbook_snapshot_id = orderbook_snapshot_id
+
+    def __len__(self):
+        return self.snapped_at_ns.size
+
+    def depth(self, depth_usd):
+        """(m, 2) bid / ask VWAPs of one depth of the ladder"""
+
+        matches = np.flatnonzero(self.depths_usd == depth_usd)
+        if not matches.size:
+            raise ValueError(f"{depth_usd} is not a depth of the ladders {self.depths_usd.tolist()}")
+        return self.vwaps[:, :, matches[0]]
+
+    def to_frame(self, long=False):
+        """DataFrame indexed by external_time (snapped_at when the venue sends no time). wide: one
+        (bid_vwap / ask_vwap, depth) column per VWAP. `long`: one row per ladder and depth with the
+        columns of the notebook generate_vwaps_list"""
+
+        import pandas as pd
+
+        time_ns = np.where(self.external_time_ns >= 0, self.external_time_ns, self.snapped_at_ns)
+        index = pd.to_datetime(time_ns, unit="ns").rename("external_time")
+        if not long:
+            columns = pd.MultiIndex.from_product(
+                [("bid_vwap", "ask_vwap"), self.depths_usd], names=(None, "depth_usd")
+            )
+            frame = pd.DataFrame(self.vwaps.reshape(len(self), -1), index=index, columns=columns)
+            for name in ("mid_rate", "top_bid", "top_ask"):
+                frame[(name, "")] = getattr(self, name)
+            return frame
+        depths_count = self.depths_usd.size
+        return pd.DataFrame(
+            {
+                "orderbook_snapshot_id": np.repeat(self.orderbook_snapshot_id, depths_count),
+                "vwap_depth_usd": np.tile(self.depths_usd, len(self)),
+                "bid_vwap": self.vwaps[:, 0, :].ravel(),
+                "ask_vwap": self.vwaps[:, 1, :].ravel(),
+                "top_bid": np.repeat(self.top_bid, depths_count),
+                "top_ask": np.repeat(self.top_ask, depths_count),
+            },
+            index=index.repeat(depths_count),
+        )
+
+
+def read_vwap_snapshots(engine, provider, internal_pair, start=None, end=None, chunk_rows=REPLAY_CHUNK_ROWS):
+    """VwapHistory of the ladders of an instrument with an external_time between `start` and `end`
+    (naive UTC datetimes, None for no bound). ValueError if the ladders are not all on the same depths"""
+
+    table = VwapSnapshot.__table__
+    base, counter = internal_pair.split("-")
+    statement = select(
+        table.c.depths_usd_packed,
+        table.c.vwaps_packed,
+        table.c.snapped_at_ns,
+        table.c.external_time_ns,
+        table.c.mid_rate,
+        table.c.top_bid,
+        table.c.top_ask,
+        table.c.orderbook_snapshot_id,
+    ).where((table.c.provider == provider) & (table.c.base == base) & (table.c.counter == counter))
+    if start is not None:
+        statement = statement.where(table.c.external_time >= start)
+    if end is not None:
+        statement = statement.where(table.c.external_time <= end)
+    statement = statement.order_by(table.c.external_time, table.c.id).execution_options(yield_per=chunk_rows)
+
+    depths_usd_packed = None
+    vwaps_chunks, scalar_rows = [], []
+    with engine.connect() as conn:
+        for row in conn.execute(statement):
+            if depths_usd_packed is None:
+                depths_usd_packed = row.depths_usd_packed
+            elif row.depths_usd_packed != depths_usd_packed:
+                raise ValueError(
+                    f"{provider} {internal_pair} ladders on different depths in the range. narrow start / end"
+                )
+            vwaps_chunks.append(row.vwaps_packed)
+            scalar_rows.append(
+                (
+                    row.snapped_at_ns,
+                    -1 if row.external_time_ns is None else row.external_time_ns,
+                    -1 if row.orderbook_snapshot_id is None else row.orderbook_snapshot_id,
+                    row.mid_rate,
+                    row.top_bid,
+                    row.top_ask,
+                )
+            )
+    depths_usd = unpack_floats(depths_usd_packed) if depths_usd_packed is not None else np.zeros(0)
+    integers = np.array([row[:3] for row in scalar_rows], dtype=np.int64).reshape(-1, 3)
+    floats = np.array([row[3:] for row in scalar_rows], dtype=np.float64).reshape(-1, 3)  # None -> NaN
+    return VwapHistory(
+        provider,
+        internal_pair,
+        depths_usd,
+        unpack_floats(b"".join(vwaps_chunks)).reshape(len(scalar_rows), 2, depths_usd.size),
+        integers[:, 0],
+        integers[:, 1],
+        floats[:, 0],
+        floats[:, 1],
+        floats[:, 2],
+        integers[:, 2],
+    )
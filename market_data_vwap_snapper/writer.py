@@ -0,0 +1,152 @@
+import logging
+import time
+
+from config import (
+    WRITER_FLUSH_EVERY_X_ROWS,
+    WRITER_FLUSH_EVERY_X_SECONDS,
+    COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT,
+)
+from metrics import METRICS
+
+WRITER_FLUSH_SECONDS = METRICS.histogram("writer_flush_seconds", "latency of one bulk insert + commit").labels()
+WRITER_ROWS_WRITTEN = METRICS.counter("writer_rows_written_total", "rows committed by the writer").labels()
+WRITER_FLUSH_EXCEPTIONS = METRICS.counter(
+    "writer_flush_exceptions_total", "failed flushes, rows are kept and retried"
+).labels()
+WRITER_BUFFERED_ROWS = METRICS.gauge("writer_buffered_rows", "rows waiting for the next flush")
+
+
+class BatchedWriter:
+    """Write-behind buffer for rows of the ORM models.
+    rows are kept as plain dicts and handed to the sink (see sinks.py) as one batch, one transaction,
+    every `flush_every_x_rows` rows or `flush_every_x_seconds` seconds, whichever comes first.
+    a failed flush keeps the rows in the buffer so they are retried on the next flush.
+    """
+
+    def __init__(
+        self,
+        sink,
+        flush_every_x_rows=WRITER_FLUSH_EVERY_X_ROWS,
+        flush_every_x_seconds=WRITER_FLUSH_EVERY_X_SECONDS,
+    ):
+        self._sink = sink
+        self._flush_every_x_rows = flush_every_x_rows
+        self._flush_every_x_seconds = flush_every_x_seconds
+
+        self._buffers = {}  # table -> list of row dicts, insertion ordered
+        self._buffered_rows = 0
+        self._last_flush_time = time.monotonic()
+
+        self._flush_exceptions_in_row_count = 0
+        self._flush_exceptions_total_count = 0  # For monitoring purpose
+        self._flush_count = 0  # For monitoring purpose
+        self._rows_written = 0  # For monitoring purpose
+        self._last_batch_size = 0  # For monitoring purpose
+        self._last_flush_latency_ms = 0.0  # For monitoring purpose
+        self._max_flush_latency_ms = 0.0  # For monitoring purpose
+        WRITER_BUFFERED_ROWS.set_callback((), lambda: self._buffered_rows)
+
+    def add(self, model, row):
+        """Buffers a row (dict of column name -> value) for the table of `model`"""
+
+        table = model.__table__
+        buffer = self._buffers.get(table)
+        if buffer is None:
+            buffer = self._buffers[table] = []
+        buffer.append(row)
+        self._buffered_rows += 1
+
+    def insert_now(self, model, row):
+        """Writes a single row immediately and returns its primary key.
+        used for rows whose id is needed straight away (e.g. orderbook snapshots)"""
+
+        return self._sink.insert_now(model, row)
+
+    def insert_snapshot(self, row):
+        """insert_now for an orderbook snapshot. the latest snapshot of the instrument is updated in
+        the same transaction"""
+
+        return self._sink.insert_snapshot(row)
+
+    def should_flush(self):
+        if self._buffered_rows == 0:
+            return False
+        if self._buffered_rows >= self._flush_every_x_rows:
+            return True
+        return (time.monotonic() - self._last_flush_time) >= self._flush_every_x_seconds
+
+    def maybe_flush(self):
+        """Flushes if the row count or the elapsed time threshold is reached"""
+
+        if self.should_flush():
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows in a single transaction.
+        on failure rows stay buffered and are retried on next flush. after
+        COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT failures in a row the exception is raised"""
+
+        if self._buffered_rows == 0:
+            self._last_flush_time = time.monotonic()
+            return 0
+
+        batch_size = self._buffered_rows
+        tick = time.perf_counter()
+        try:
+            self._sink.write(self._buffers)
+        except Exception as e:
+            self._flush_exceptions_total_count += 1
+            self._flush_exceptions_in_row_count += 1
+            WRITER_FLUSH_EXCEPTIONS.inc()
+            logging.warning(
+                f"exception while flushing {batch_size} rows to DB. {self._flush_exceptions_in_row_count} in a row: \n{e}\n"
+            )
+            if self._flush_exceptions_in_row_count > COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT:
+                raise ValueError(
+                    f"Too many flush exceptions in a row. crashing. {self._flush_exceptions_in_row_count}/{COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT}"
+                ) from e
+            return 0
+        flush_latency_ms = (time.perf_counter() - tick) * 1000
+        WRITER_FLUSH_SECONDS.observe(flush_latency_ms / 1000)
+        WRITER_ROWS_WRITTEN.inc(batch_size)
+
+        self._buffers = {}
+        self._buffered_rows = 0
+        self._last_flush_time = time.monotonic()
+        self._flush_exceptions_in_row_count = 0
+        self._flush_count += 1
+        self._rows_written += batch_size
+        self._last_batch_size = batch_size
+        self._last_flush_latency_ms = flush_latency_ms
+        self._max_flush_latency_ms = max(self._max_flush_latency_ms, flush_latency_ms)
+        logging.debug(f"flushed {batch_size} rows in {flush_latency_ms:.2f}ms")
+        return batch_size
+
+    def close(self):
+        """Flushes whatever is left. to be called on shutdown"""
+
+        if self._buffered_rows:
+            logging.info(f"flushing {self._buffered_rows} buffered rows before shutdown")
+        while self._buffered_rows:  # a failing DB raises after COMMIT_EXCEPTIONS_IN_ROW_COUNT_LIMIT
+            if not self.flush():
+                time.sleep(0.1)
+        self._sink.close()
+
+    @property
+    def buffered_rows(self):
+        return self._buffered_rows
+
+    @property
+    def stats(self):
+        """Batch size and flush latency figures"""
+
+        return {
+            "buffered_rows": self._buffered_rows,
+            "flush_count": self._flush_count,
+            "rows_written": self._rows_written,
+            "last_batch_size": self._last_batch_size,
+            "avg_batch_size": self._rows_written / self._flush_count if self._flush_count else 0,
+            "last_flush_latency_ms": self._last_flush_latency_ms,
+            "max_flush_latency_ms": self._max_flush_latency_ms,
+            "flush_exceptions_total_count": self._flush_exceptions_total_count,
+        }
@@ -1,21 +1,51 @@
 from bintrees import FastAVLTree
+from collections import namedtuple
+from itertools import islice
 import pickle
 
+# One fill. the maker is the resting order, the taker the incoming one; the price is the maker's
+Trade = namedtuple(
+    "Trade",
+    ["price", "size", "taker_side", "maker_order_id", "taker_order_id", "maker_owner", "taker_owner"],
+)
 
-class OrderBook:
-    """Limit order book able to process LMT and MKT orders
-    MKT orders are disassembled to LMT orders up to current liquidity situation
+
+class RestingOrder:
+    """Order store record of a resting order. `orders` is its price level ({order id: size}) and
+    `totals` the [total size, order count] of that level, so cancel and modify never look the price
+    up in the tree"""
+
+    __slots__ = ("price", "side", "owner", "orders", "totals")
+
+    def __init__(self, price, side, owner, orders, totals):
+        self.price = price
+        self.side = side
+        self.owner = owner
+        self.orders = orders
+        self.totals = totals
+
+
+class LevelBook:
+    """Price levels, level aggregates and order store of a limit order book: queueing, cancel,
+    modify and depth. subclasses add the order submission (OrderBook matches, the
+    non_executable_order_book one only queues)
     """
 
     def __init__(self):
-        # AVL trees are used as a main structure due its optimal performance features for this purpose
-
-        self._participants = FastAVLTree()
-        self._order_owners = FastAVLTree()  # Assigning ID -> Owner
+        # Order store. keyed by ids that never need ordering, so plain dicts: O(1) lookup and delete
+        self._orders = {}  # Assigning ID -> RestingOrder
+        self._participants = {}  # Assigning Owner -> {ID: None}, in submission order
 
+        # AVL trees are used for the price levels due its optimal performance features for this purpose
+        # price -> {order_id: size}. dicts keep insertion order, so each level is a FIFO queue
         self._asks = FastAVLTree()  # MIN Heap
         self._bids = FastAVLTree()  # MAX Heap
-        self._price_ids = FastAVLTree()  # Assigning ID -> Price
+
+        # Level aggregates kept up to date on submit, cancel and fill: price -> [total size, order count]
+        self._ask_levels = {}
+        self._bid_levels = {}
+        self._best_ask = None  # None when the side is empty
+        self._best_bid = None
 
         self._total_ask_size = 0  # For monitoring purpose
         self._total_bid_size = 0  # For monitoring purpose
@@ -36,183 +66,190 @@ class OrderBook:
         for attr_name, attr_val in state.items():
             setattr(self, attr_name, attr_val)
 
+        for levels in (self._asks, self._bids):
+            for price, orders in list(levels.items()):
+                if not isinstance(orders, dict):  # pickled with order trees as levels
+                    levels[price] = dict(orders.items())
+
+        if "_ask_levels" not in state:  # pickled before the level aggregates existed
+            self._rebuild_levels()
+
+        if "_orders" not in state:  # pickled with the AVL tree order store
+            self._rebuild_order_store()
+
+    def _rebuild_levels(self):
+        """Recomputes the level aggregates and best prices from the orders in the levels"""
+
+        self._ask_levels = {
+            price: [sum(level.values()), len(level)] for price, level in self._asks.items()
+        }
+        self._bid_levels = {
+            price: [sum(level.values()), len(level)] for price, level in self._bids.items()
+        }
+        self._best_ask = self._asks.min_key() if not self._asks.is_empty() else None
+        self._best_bid = self._bids.max_key() if not self._bids.is_empty() else None
+
+    def _rebuild_order_store(self):
+        """Builds the order store from the levels and the order owners tree of an old pickle"""
+
+        order_owners = self.__dict__.pop("_order_owners")
+        self.__dict__.pop("_price_ids", None)
+        self._orders = {}
+        for side, levels, level_totals in (
+            ("ask", self._asks, self._ask_levels),
+            ("bid", self._bids, self._bid_levels),
+        ):
+            for price, orders in levels.items():
+                for order_id in orders:
+                    self._orders[order_id] = RestingOrder(
+                        price, side, order_owners[order_id], orders, level_totals[price]
+                    )
+        self._participants = {}
+        for order_id in sorted(self._orders):
+            self._participants.setdefault(self._orders[order_id].owner, {})[order_id] = None
+
+    def _delete_level(self, side, price):
+        """Removes an (emptied) price level from its tree and aggregates, moving the best price on"""
+
+        if side == "ask":
+            del self._asks[price]
+            del self._ask_levels[price]
+            if price == self._best_ask:
+                self._best_ask = self._asks.min_key() if not self._asks.is_empty() else None
+        else:
+            del self._bids[price]
+            del self._bid_levels[price]
+            if price == self._best_bid:
+                self._best_bid = self._bids.max_key() if not self._bids.is_empty() else None
+
     def _get_order_id(self):
         """Orders id managment"""
 
         self._last_order_id += 1
         return self._last_order_id
 
-    def _balance(self, trades_stack):
-        """Executes trades if it finds liquidity for them"""
-
-        # No liquidity at all
-        if self._asks.is_empty() or self._bids.is_empty():
-            return trades_stack
-
-        min_ask = self._asks.min_key()
-        max_bid = self._bids.max_key()
-
-        # Check liquidity situation
-        if max_bid >= min_ask:
-            ask_orders = self._asks.get(min_ask)
-            bid_orders = self._bids.get(max_bid)
-
-            for ask_order in ask_orders:
-                for bid_order in bid_orders:
-                    if not ask_order in ask_orders or not bid_order in bid_orders:
-                        continue
-
-                    traded = min(ask_orders[ask_order], bid_orders[bid_order])
-
-                    ask_orders[ask_order] -= traded
-                    bid_orders[bid_order] -= traded
-
-                    self._total_ask_size -= traded
-                    self._total_bid_size -= traded
-
-                    self._total_volume_traded += traded
-                    self._total_volume_pending -= 2 * traded
-
-                    ask_owner = self._order_owners[ask_order]
-                    bid_owner = self._order_owners[bid_order]
-
-                    # Buy side order fully liquidated
-                    if bid_orders[bid_order] == 0:
-                        # print("BID ORDER LIQUIDATED")
-                        self._cleared_orders_count += 1
-                        del bid_orders[bid_order]
-                        del self._price_ids[bid_order]
-
-                        del self._order_owners[bid_order]
-                        owner_ids = self._participants[bid_owner]
-                        owner_ids.remove(bid_order)
-
-                        del self._participants[bid_owner]
-                        self._participants.insert(bid_owner, owner_ids)
-
-                    # Sell side order fully liquidated
-                    if ask_orders[ask_order] == 0:
-                        # print("ASK ORDER LIQUIDATED")
-                        self._cleared_orders_count += 1
-                        del ask_orders[ask_order]
-                        del self._price_ids[ask_order]
-
-                        del self._order_owners[ask_order]
-                        owner_ids = self._participants[ask_owner]
-                        owner_ids.remove(ask_order)
-
-                        del self._participants[ask_owner]
-                        self._participants.insert(ask_owner, owner_ids)
-
-                    # Inform sides about state of their orders
-                    trades_stack.append((0, traded, max_bid))
-                    trades_stack.append((1, ask_order, traded, max_bid, ask_owner, "ask"))
-                    trades_stack.append((1, bid_order, traded, max_bid, bid_owner, "bid"))
-
-            # Whole ASK price level were liquidated, remove it from three and let it rebalance
-            if self._asks[min_ask].is_empty():
-                # print("ASK level liquidated")
-                del self._asks[min_ask]
-
-            # Whole BID price level were liquidated, remove it from three and let it rebalance
-            if self._bids[max_bid].is_empty():
-                # print("BID level liquidated")
-                del self._bids[max_bid]
-        else:
-            return trades_stack
-
-        return self._balance(trades_stack)
-
-    def _submit_mkt(self, side, size, participant_id):
-        """Find liquidity for mkt order - put multiple lmt orders to extract liquidity for order execution"""
-
-        orders_list = []
-        trades_stack = []
-
-        while size > 0:
-            if side == "ask":
-                second_side_size = self.bid_size
-                second_side_price = self.bid
-            else:
-                second_side_size = self.ask_size
-                second_side_price = self.ask
-
-            # We could only taky liquidity which exists
-            trade_size = min([second_side_size, size])
-            orders_list.append(
-                self._submit_lmt(side, trade_size, second_side_price, participant_id)
-            )
-            trades_stack = self._balance(trades_stack)
-
-            size -= trade_size
-
-        return 0, trades_stack
-
-    def _submit_lmt(self, side, size, price, participant_id):
-        """Submits LMT order to book"""
-
-        # Assign order ID
-        order_id = self._get_order_id()
+    def _add_order(self, order_id, side, size, price, participant_id):
+        """Queues an order at the back of its price level and records it in the order store"""
 
         # Pending volume monitoring
         self._total_volume_pending += size
-        self._price_ids.insert(order_id, (price, side))
-
-        # Keep track of participant orders, book will be asked for sure
-        if participant_id not in self._participants:
-            self._participants.insert(participant_id, [order_id])
-        else:
-            owner_trades = self._participants.get(participant_id, [])
-            owner_trades.append(order_id)
-
-        self._order_owners.insert(order_id, participant_id)
 
         # Assign to right (correct) side
         if side == "ask":
             self._total_ask_size += size
-            ask_level = self._asks.get(price, FastAVLTree())
-            ask_level.insert(order_id, size)
-
-            if price not in self._asks:
-                self._asks.insert(price, ask_level)
+            orders = self._asks.get(price)
+            if orders is None:
+                orders = {}
+                self._asks.insert(price, orders)
+                totals = self._ask_levels[price] = [0, 0]
+                if self._best_ask is None or price < self._best_ask:
+                    self._best_ask = price
+            else:
+                totals = self._ask_levels[price]
         else:  # bid
             self._total_bid_size += size
-            bid_level = self._bids.get(price, FastAVLTree())
-            bid_level.insert(order_id, size)
+            orders = self._bids.get(price)
+            if orders is None:
+                orders = {}
+                self._bids.insert(price, orders)
+                totals = self._bid_levels[price] = [0, 0]
+                if self._best_bid is None or price > self._best_bid:
+                    self._best_bid = price
+            else:
+                totals = self._bid_levels[price]
 
-            if price not in self._bids:
-                self._bids.insert(price, bid_level)
+        orders[order_id] = size
+        totals[0] += size
+        totals[1] += 1
+        self._orders[order_id] = RestingOrder(price, side, participant_id, orders, totals)
 
-        return order_id
+        # Keep track of participant orders, book will be asked for sure
+        owner_orders = self._participants.get(participant_id)
+        if owner_orders is None:
+            self._participants[participant_id] = {order_id: None}
+        else:
+            owner_orders[order_id] = None
+
+    def _forget_order(self, order_id):
+        """Drops an order that left its level from the order store. returns its record"""
+
+        order = self._orders.pop(order_id)
+        owner_orders = self._participants[order.owner]
+        del owner_orders[order_id]
+        if not owner_orders:
+            del self._participants[order.owner]
+        return order
 
     def cancel(self, order_id):
-        """Cancel order"""
+        """Cancel order. O(1) unless it was the last order of its price level"""
+
+        order = self._forget_order(order_id)
+        size = order.orders.pop(order_id)
+        order.totals[0] -= size
+        order.totals[1] -= 1
+        self._total_volume_pending -= size
+        if order.side == "ask":
+            self._total_ask_size -= size
+        else:
+            self._total_bid_size -= size
+
+        if not order.orders:
+            self._delete_level(order.side, order.price)
+
+    def modify(self, order_id, size):
+        """Amends the size of a resting order. a smaller size keeps its place in the price level queue,
+        a larger one sends it to the back. size 0 cancels it"""
+
+        if size <= 0:
+            self.cancel(order_id)
+            return
+
+        order = self._orders[order_id]
+        orders = order.orders
+        old_size = orders[order_id]
+        if size > old_size:
+            del orders[order_id]
+        orders[order_id] = size
+
+        order.totals[0] += size - old_size
+        self._total_volume_pending += size - old_size
+        if order.side == "ask":
+            self._total_ask_size += size - old_size
+        else:
+            self._total_bid_size += size - old_size
 
-        # Finds and cancels order
+    def has_order(self, order_id):
+        """True if `order_id` is resting in the book"""
 
-        order = self._price_ids[order_id]
+        return order_id in self._orders
 
-        if order[1] == "ask":
-            del self._asks[order[0]][order_id]
+    def remove_level(self, side, price):
+        """Cancels every order resting at `price` on `side`. nothing happens if there is no such level"""
 
-            if self._asks[order[0]].is_empty():
-                del self._asks[order[0]]
+        if side == "ask":
+            orders, levels = self._asks.get(price), self._ask_levels
         else:
-            del self._bids[order[0]][order_id]
-
-            if self._bids[order[0]].is_empty():
-                del self._bids[order[0]]
+            orders, levels = self._bids.get(price), self._bid_levels
+        if orders is None:
+            return
+
+        for order_id in orders:
+            self._forget_order(order_id)
+        size = levels[price][0]
+        self._total_volume_pending -= size
+        if side == "ask":
+            self._total_ask_size -= size
+        else:
+            self._total_bid_size -= size
+        self._delete_level(side, price)
 
     @property
     def ask_size(self):
         """Volume waiting on ask side bottom level - liquidity level size for ask price"""
 
-        best_ask = self.get_mkt_depth(1)[0]
-
-        if len(best_ask) == 0:
+        if self._best_ask is None:
             return 0
-        else:
-            return best_ask[0][1]
+        return self._ask_levels[self._best_ask][0]
 
     @property
     def total_ask_size(self):
@@ -222,11 +259,9 @@ class OrderBook:
     def bid_size(self):
         """Volume waiting on bid side top level - liquidity level size for bid price"""
 
-        best_bid = self.get_mkt_depth(1)[1]
-        if len(best_bid) == 0:
+        if self._best_bid is None:
             return 0
-        else:
-            return best_bid[0][1]
+        return self._bid_levels[self._best_bid][0]
 
     @property
     def total_volume_traded(self):
@@ -248,19 +283,13 @@ class OrderBook:
     def ask(self):
         """Best ask"""
 
-        try:
-            return self.get_mkt_depth(1)[0][0][0]
-        except:
-            return -1
+        return self._best_ask if self._best_ask is not None else -1
 
     @property
     def bid(self):
         """Best bid"""
 
-        try:
-            return self.get_mkt_depth(1)[1][0][0]
-        except:
-            return -1
+        return self._best_bid if self._best_bid is not None else -1
 
     @property
     def spread(self):
@@ -271,28 +300,135 @@ class OrderBook:
     def get_participant_orders(self, participant_id):
         """Orders of given participant"""
 
-        orders_list = self._participants.get_value(participant_id)
+        orders_list = list(self._participants.get(participant_id, ()))
 
         order_prices = {}
         for order_id in orders_list:
-            order = self._price_ids.get_value(order_id)
-
-            if order[1] == "ask":
-                order_size = self._asks.get_value(order[0]).get_value(order_id)
-            else:
-                order_size = self._bids.get_value(order[0]).get_value(order_id)
+            order = self._orders[order_id]
 
             # price, side, size
-            order_prices[order_id] = (order[0], order[1], order_size)
+            order_prices[order_id] = (order.price, order.side, order.orders[order_id])
 
         return orders_list, order_prices
 
+    def get_level_order_count(self, side, price):
+        """Number of orders resting at `price` on `side`. 0 if there is no such level"""
+
+        levels = self._ask_levels if side == "ask" else self._bid_levels
+        level = levels.get(price)
+        return level[1] if level is not None else 0
+
+    def get_mkt_depth(self, depth):
+        """Liquidity levels size for both bid and ask. walks the best `depth` prices of each side
+        reading the level totals, the orders in the levels are not visited"""
+
+        ask_levels = self._ask_levels
+        ask_side = [[price, ask_levels[price][0]] for price in islice(self._asks.keys(), depth)]
+
+        bid_levels = self._bid_levels
+        bid_side = [
+            [price, bid_levels[price][0]] for price in islice(self._bids.keys(reverse=True), depth)
+        ]
+
+        return [ask_side, bid_side]
+
+
+class OrderBook(LevelBook):
+    """Limit order book able to process LMT and MKT orders
+    incoming orders are matched iteratively against the opposite side, best price first and FIFO
+    within a price level. MKT orders sweep the opposite side in one pass and never rest.
+    every fill is priced at the resting (maker) order's price, like on the venues: a bid crossing asks
+    below its limit pays their prices. the recursive engine this one replaced priced every fill at the
+    best bid, so an incoming bid paid its own limit
+    """
+
+    def _match(self, side, size, limit_price, order_id, participant_id, trades):
+        """Fills up to `size` of an incoming `side` order against the opposite side while its best
+        price is within `limit_price` (None for a MKT order), appending a Trade per fill.
+        returns the size left unfilled"""
+
+        if side == "ask":
+            opposite_side, opposite, opposite_levels = "bid", self._bids, self._bid_levels
+        else:
+            opposite_side, opposite, opposite_levels = "ask", self._asks, self._ask_levels
+
+        traded_total = 0
+        while size > 0:
+            best_price = self._best_bid if side == "ask" else self._best_ask
+            if best_price is None:
+                break
+            if limit_price is not None and (
+                best_price < limit_price if side == "ask" else best_price > limit_price
+            ):
+                break
+
+            orders = opposite[best_price]
+            level = opposite_levels[best_price]
+            filled = []
+            for maker_order_id, maker_size in orders.items():
+                traded = min(size, maker_size)
+                maker_owner = self._orders[maker_order_id].owner
+                if traded == maker_size:
+                    filled.append(maker_order_id)
+                else:
+                    orders[maker_order_id] = maker_size - traded  # existing key, safe while iterating
+                level[0] -= traded
+                traded_total += traded
+                size -= traded
+                trades.append(
+                    Trade(best_price, traded, side, maker_order_id, order_id, maker_owner, participant_id)
+                )
+                if size <= 0:
+                    break
+
+            level[1] -= len(filled)
+            self._cleared_orders_count += len(filled)
+            for maker_order_id in filled:
+                del orders[maker_order_id]
+                self._forget_order(maker_order_id)
+            if not orders:
+                self._delete_level(opposite_side, best_price)
+
+        if traded_total:
+            if side == "ask":
+                self._total_bid_size -= traded_total
+            else:
+                self._total_ask_size -= traded_total
+            self._total_volume_traded += traded_total
+            self._total_volume_pending -= traded_total
+        return size
+
+    def _submit_mkt(self, side, size, participant_id):
+        """Sweeps the opposite side for `size` in one pass. the caller checks the liquidity is there"""
+
+        order_id = self._get_order_id()
+        trades = []
+        self._match(side, size, None, order_id, participant_id, trades)
+        self._cleared_orders_count += 1
+        return 0, trades
+
+    def _submit_lmt(self, side, size, price, participant_id, trades):
+        """Submits LMT order to book. the part crossing the opposite side trades straight away, the
+        rest is queued at the back of its price level"""
+
+        # Assign order ID
+        order_id = self._get_order_id()
+
+        size = self._match(side, size, price, order_id, participant_id, trades)
+        if size <= 0:
+            self._cleared_orders_count += 1
+            return order_id
+
+        self._add_order(order_id, side, size, price, participant_id)
+        return order_id
+
     def submit_order(self, order_type, side, size, price, participant_id):
-        """Abstraction on order placement - boht LMT and MKT"""
+        """Abstraction on order placement - boht LMT and MKT. returns (order id, [Trade, ...]) for
+        LMT orders, (0, [Trade, ...]) for MKT orders and (-1, []) if there is not enough liquidity"""
 
         if order_type == "lmt":
-            order_id = self._submit_lmt(side, size, price, participant_id)
-            trades = self._balance([])
+            trades = []
+            order_id = self._submit_lmt(side, size, price, participant_id, trades)
             return order_id, trades
 
         if order_type == "mkt":
@@ -307,35 +443,3 @@ class OrderBook:
             else:
                 # Insufficient liquidity
                 return -1, []
-
-    def get_mkt_depth(self, depth):
-        """Liquidity levels size for both bid and ask"""
-
-        ask_side = []
-        if not self._asks.is_empty():
-            for price in self._asks.keys():
-                ask_level = self._asks.get(price)
-                ask_size = 0
-                for order_id in ask_level.keys():
-                    # print(ask_size, order_id, ask_level.get(order_id))
-                    ask_size += ask_level.get(order_id)
-
-                ask_side.append([price, ask_size])
-
-                if len(ask_side) >= depth:
-                    break
-
-        bid_side = []
-        if not self._bids.is_empty():
-            for price in self._bids.keys(reverse=True):
-                bid_level = self._bids.get(price)
-                bid_size = 0
-                for order_id in bid_level.keys():
-                    bid_size += bid_level.get(order_id)
-
-                bid_side.append([price, bid_size])
-
-                if len(bid_side) >= depth:
-                    break
-
-        return [ask_side, bid_side]